@@ -0,0 +1,24 @@
+"""
+    python -m pycronius <command> [options], see python -m pycronius <command> --help
+
+        annotate    annotate the timestamps of a CSV or JSONL event log with the matching rules
+"""
+import sys
+
+import annotate
+
+
+COMMANDS = {
+    "annotate": annotate.main
+}
+
+
+def main(argv):
+    if not argv or argv[0] not in COMMANDS:
+        sys.stderr.write(__doc__.strip() + "\n")
+        return 2
+    return COMMANDS[argv[0]](argv[1:])
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,247 @@
+"""
+    Annotates event logs with the rules that applied at each event's timestamp.
+
+        python -m pycronius annotate --config schedule.json --column timestamp events.csv > annotated.csv
+        python -m pycronius annotate --config schedule.json --column ts --input-format jsonl --processes 4 events.jsonl
+
+    schedule.json holds the arguments to Scheduler:
+        {"rules": [["open", "7:30 19:00 * * 1-5 *"]], "exceptions": [["closed", "* * 25 12 * *"]], "stop_year": 2030}
+
+    Input is read lazily in chunks of --chunk-size lines.  With --processes, chunks are annotated by a process pool
+        whose workers build the Scheduler once, and at most two chunks per worker are in flight, so memory stays
+        bounded and output is written in input order.  CSV rows get an extra column, JSONL objects an extra key.
+"""
+import argparse
+from collections import deque
+import csv
+from datetime import datetime, timedelta
+from itertools import islice
+import json
+import multiprocessing
+import sys
+
+from scheduler import Scheduler
+
+
+class Annotator(object):
+    """
+        Annotates the rows of a chunk with scheduler.get_matching_rules at their timestamp.
+
+        timestamp_format is "iso" (e.g. "2014-12-19T12:00:00", only the first 16 characters are used),
+            "epoch" (seconds since the epoch, UTC) or a strptime format.
+
+        The first timestamp of a day computes the whole day with Scheduler.get_timeline, so every other
+            timestamp that day is a list lookup.  At most memo_days days are kept.
+    """
+
+    memo_days = 366
+
+    def __init__(self, scheduler, timestamp_format="iso", separator="|"):
+        self.scheduler = scheduler
+        self.timestamp_format = timestamp_format
+        self.separator = separator
+        self._names = {}        # day -> [names for every minute of the day]
+        self._csv_fields = {}   # day -> [CSV field for every minute of the day]
+
+
+    def day_and_minute(self, value):
+        """
+            Returns (day, minute of the day) for a timestamp, where day is a key for the date
+        """
+        if self.timestamp_format == "iso":
+            return value[:10], int(value[11:13]) * 60 + int(value[14:16])
+        elif self.timestamp_format == "epoch":
+            return divmod(int(float(value)) // 60, 1440)
+        time_obj = datetime.strptime(value, self.timestamp_format)
+        return time_obj.date(), time_obj.hour * 60 + time_obj.minute
+
+
+    def midnight(self, day):
+        if self.timestamp_format == "iso":
+            return datetime(int(day[0:4]), int(day[5:7]), int(day[8:10]))
+        elif self.timestamp_format == "epoch":
+            return datetime.utcfromtimestamp(day * 86400)
+        return datetime.combine(day, datetime.min.time())
+
+
+    def _day(self, memo, day, fmt):
+        """
+            Returns the list of fmt(names) for every minute of day, from (and stored in) memo
+        """
+        minutes = memo.get(day)
+        if minutes is None:
+            if len(memo) >= self.memo_days:
+                memo.clear()
+
+            midnight = self.midnight(day)
+            minutes = memo[day] = []
+            formatted = {}
+            for start, end, names in self.scheduler.get_timeline(midnight, midnight + timedelta(days=1)):
+                key = tuple(names)
+                if key not in formatted:
+                    formatted[key] = fmt(names)
+                minutes.extend([formatted[key]] * ((end - start).seconds // 60 or 1440))
+        return minutes
+
+
+    def names(self, value):
+        """
+            Returns get_matching_rules for the timestamp value
+        """
+        day, minute_of_day = self.day_and_minute(value)
+        return self._day(self._names, day, list)[minute_of_day]
+
+
+    def csv_field(self, names):
+        """
+            Returns names as a (quoted if necessary) CSV field
+        """
+        text = self.separator.join(name if isinstance(name, basestring) else str(name) for name in names)
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        if "," in text or '"' in text or "\n" in text:
+            text = '"{}"'.format(text.replace('"', '""'))
+        return text
+
+
+    def annotate_csv(self, lines, column):
+        """
+            Returns lines (CSV rows, with line endings) with the names for the timestamp in column appended
+        """
+        memo = self._csv_fields
+        day_and_minute = self.day_and_minute
+        current_day = fields = None
+        out = []
+        for line in lines:
+            row = line.rstrip("\r\n")
+            if '"' in row:
+                value = next(csv.reader([row]))[column]
+            else:
+                value = row.split(",", column + 1)[column]
+
+            day, minute_of_day = day_and_minute(value)
+            if day != current_day:
+                current_day, fields = day, self._day(memo, day, self.csv_field)
+            out.append(row + "," + fields[minute_of_day] + "\n")
+        return out
+
+
+    def annotate_jsonl(self, lines, key, output_key):
+        """
+            Returns lines (JSON objects) with the names for the timestamp under key added as output_key
+        """
+        out = []
+        for line in lines:
+            if not line.strip():
+                continue
+            obj = json.loads(line)
+            obj[output_key] = self.names(str(obj[key]))
+            out.append(json.dumps(obj) + "\n")
+        return out
+
+
+    def annotate(self, lines, input_format, column, output_key):
+        if input_format == "csv":
+            return self.annotate_csv(lines, column)
+        return self.annotate_jsonl(lines, column, output_key)
+
+
+_worker_annotator = None
+
+def _init_worker(config, timestamp_format, separator):
+    global _worker_annotator
+    _worker_annotator = Annotator(Scheduler(**config), timestamp_format, separator)
+
+
+def _annotate_chunk(lines, input_format, column, output_key):
+    return _worker_annotator.annotate(lines, input_format, column, output_key)
+
+
+def iter_chunks(lines, chunk_size):
+    """
+        Yields lists of chunk_size lines (the last one may be shorter), reading lines lazily
+    """
+    lines = iter(lines)
+    while True:
+        chunk = list(islice(lines, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def annotate_stream(lines, config, input_format="csv", column=0, output_key="state", timestamp_format="iso",
+                    separator="|", chunk_size=10000, processes=0):
+    """
+        Yields annotated chunks (lists of output lines) for lines, in input order.
+
+        config is a dictionary of arguments to Scheduler.  For CSV, column is the index of the timestamp column
+            and lines must not include the header.  For JSONL, column is the key of the timestamp.
+            If processes is positive, chunks are annotated by a pool of that many processes.
+    """
+    chunks = iter_chunks(lines, chunk_size)
+    args = (input_format, column, output_key)
+
+    if processes <= 0:
+        annotator = Annotator(Scheduler(**config), timestamp_format, separator)
+        for chunk in chunks:
+            yield annotator.annotate(chunk, *args)
+        return
+
+    pool = multiprocessing.Pool(processes, _init_worker, (config, timestamp_format, separator))
+    try:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_annotate_chunk, (chunk,) + args))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pycronius annotate", description="Annotate event timestamps with the matching rules")
+    parser.add_argument("input", nargs="?", help="input file, - or omitted for stdin")
+    parser.add_argument("--config", required=True, help="JSON file with the arguments to Scheduler")
+    parser.add_argument("--column", required=True, help="timestamp column (CSV header name or index) or key (JSONL)")
+    parser.add_argument("--input-format", choices=["csv", "jsonl"], default="csv")
+    parser.add_argument("--timestamp-format", default="iso", help='"iso", "epoch" or a strptime format')
+    parser.add_argument("--output", help="output file, defaults to stdout")
+    parser.add_argument("--output-key", default="state", help="name of the added column / key")
+    parser.add_argument("--separator", default="|", help="separator between names in CSV output")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument("--processes", type=int, default=0, help="size of the process pool, 0 to annotate in this process")
+    args = parser.parse_args(argv)
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    infile = sys.stdin if args.input in (None, "-") else open(args.input, "rb")
+    outfile = sys.stdout if args.output is None else open(args.output, "wb")
+    try:
+        column = args.column
+        if args.input_format == "csv":
+            header = infile.readline()
+            fields = next(csv.reader([header]))
+            column = int(column) if column.isdigit() else fields.index(column)
+            outfile.write("{},{}\n".format(header.rstrip("\r\n"), args.output_key))
+
+        for chunk in annotate_stream(infile, config, args.input_format, column, args.output_key, args.timestamp_format,
+                                     args.separator, args.chunk_size, args.processes):
+            outfile.write("".join(chunk))
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+"""
+    Vectorized evaluation of a Scheduler over arrays of timestamps.
+
+    Requires numpy, which is otherwise not a dependency of pycronius.
+"""
+import numpy as np
+
+from utils import Bunch
+
+
+def epoch_minutes(times):
+    """
+        times is anything numpy can turn into an array of datetime64 (any unit, truncated to minutes),
+            or an array of integer minutes since the epoch.  Returns the latter
+    """
+    times = np.asarray(times)
+    if times.dtype.kind in "MO":
+        return times.astype("datetime64[m]").astype(np.int64)
+    return times.astype(np.int64)
+
+
+def to_local(minutes, table):
+    """
+        Shifts an array of epoch minutes in UTC to local time, through a timezones.OffsetTable
+    """
+    starts = np.array(table.starts, dtype="datetime64[m]").astype(np.int64)
+    offsets = np.array([int(delta.total_seconds()) // 60 for delta in table.deltas], dtype=np.int64)
+    local = minutes + offsets[np.maximum(np.searchsorted(starts, minutes, side="right") - 1, 0)]
+
+    #Outside of the table, ask the tzinfo itself
+    stop = np.datetime64(table.stop, "m").astype(np.int64)
+    for i in np.nonzero((minutes < starts[0]) | (minutes >= stop))[0]:
+        utc = np.datetime64(int(minutes[i]), "m").astype(object)
+        local[i] = minutes[i] + int(table.interval(utc)[2].total_seconds()) // 60
+    return local
+
+
+def decompose(times):
+    """
+        Splits times into arrays of year, month, dom, dow (1=Monday), minute of day and the length of the month.
+
+        times is anything epoch_minutes accepts
+    """
+    minutes = epoch_minutes(times)
+    days = minutes // 1440
+    months = days.astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+    first_of_month = months.astype("datetime64[M]").astype("datetime64[D]").astype(np.int64)
+    first_of_next_month = (months + 1).astype("datetime64[M]").astype("datetime64[D]").astype(np.int64)
+
+    return Bunch(
+        year=months // 12 + 1970,
+        month=months % 12 + 1,
+        dom=days - first_of_month + 1,
+        dow=(days + 3) % 7 + 1,     # 1970-01-01 was a Thursday
+        minute_of_day=minutes - days * 1440,
+        days_in_month=first_of_next_month - first_of_month
+    )
+
+
+def _table(values, size):
+    table = np.zeros(size, dtype=bool)
+    table[[v for v in values if 0 <= v < size]] = True
+    return table
+
+
+class RuleArrays(object):
+    """
+        Array-backed copy of a rule's rulesets, so that it can be tested against decomposed timestamps
+    """
+
+    def __init__(self, rule):
+        nth = rule.rulesets.get("nth")
+        if nth is None:
+            self.nth = None
+        else:
+            self.nth = np.zeros((8, 7), dtype=bool)    # [weekday, n], n = 6 for the last weekday of the month
+            for dow, n in nth:
+                self.nth[dow, 6 if n == -1 else n] = True
+
+        years = rule.rulesets["year"]
+        if rule.unbounded_years():
+            self.year_step, self.year_offset, self.years = years.step, years.offset, None
+        else:
+            self.years = np.array(sorted(years), dtype=np.int64)
+        self.month = _table(rule.rulesets["month"], 13)
+        self.dom = _table(rule.rulesets["dom"], 32)
+        self.dow = _table(rule.rulesets["dow"], 8)
+        self.minute_of_day = _table(rule.minutes_of_day(), 1440)
+
+
+    def contains(self, fields):
+        """
+            Returns a boolean array, True where the decomposed timestamp is contained in the rule
+        """
+        if self.years is None:
+            years = fields.year % self.year_step == self.year_offset
+        else:
+            years = np.in1d(fields.year, self.years)
+        matched = self.month[fields.month] & self.dom[fields.dom] & self.dow[fields.dow] &\
+            self.minute_of_day[fields.minute_of_day] & years
+        if self.nth is not None:
+            matched &= self.nth[fields.dow, (fields.dom - 1) // 7 + 1] | (self.nth[fields.dow, 6] & (fields.dom + 7 > fields.days_in_month))
+        return matched
+
+
+class BatchMatcher(object):
+    """
+        Array-backed version of a Scheduler's holidays, exceptions and rules.
+
+        Build it once and reuse it; it does not follow later changes to the Scheduler.
+    """
+
+    def __init__(self, scheduler):
+        self.tz_table = scheduler.tz_table
+        self.names = []
+        columns = {}
+        for name in list(scheduler.exceptions) + list(scheduler.rules) + list(scheduler.holiday_exceptions.values()):
+            if name not in columns:
+                columns[name] = len(self.names)
+                self.names.append(name)
+
+        holidays = sorted((y * 10000 + m * 100 + d, columns[name]) for (d, m, y), name in scheduler.holiday_exceptions.items())
+        self.holiday_keys = np.array([k for k, c in holidays], dtype=np.int64)
+        self.holiday_columns = np.array([c for k, c in holidays], dtype=np.int64)
+
+        self.exceptions = [(columns[ename], RuleArrays(exception))
+            for ename, exceptions in scheduler.exceptions.items() for exception in exceptions]
+        self.rules = [(columns[rname], RuleArrays(rule))
+            for rname, rules in scheduler.rules.items() for rule in rules]
+
+
+    def match(self, times):
+        """
+            Returns a boolean matrix with one row per timestamp and one column per name in self.names.
+                Cell [i, j] is True if self.names[j] is in Scheduler.get_matching_rules(times[i])
+        """
+        if self.tz_table is not None:
+            times = to_local(epoch_minutes(times), self.tz_table)
+        fields = decompose(times)
+        matches = np.zeros((len(fields.year), len(self.names)), dtype=bool)
+        rows = np.arange(len(fields.year))
+
+        #Holiday exceptions
+        pending = np.ones(len(fields.year), dtype=bool)
+        if len(self.holiday_keys):
+            keys = fields.year * 10000 + fields.month * 100 + fields.dom
+            pos = np.minimum(np.searchsorted(self.holiday_keys, keys), len(self.holiday_keys) - 1)
+            hit = self.holiday_keys[pos] == keys
+            matches[rows[hit], self.holiday_columns[pos[hit]]] = True
+            pending &= ~hit
+
+        #Exceptions, the first match wins
+        for column, exception in self.exceptions:
+            hit = pending & exception.contains(fields)
+            matches[hit, column] = True
+            pending &= ~hit
+
+        #No exceptions match, so all rules are available
+        for column, rule in self.rules:
+            matches[:, column] |= pending & rule.contains(fields)
+
+        return matches
@@ -1,7 +1,35 @@
+"""
+    Benchmarks for Scheduler.
+
+        python benchmark.py                                   # full sweep, prints a table
+        python benchmark.py --counts 10,1000 --mixes range    # part of the sweep
+        python benchmark.py --output results.json             # also write machine-readable results
+        python benchmark.py --baseline results.json           # compare with earlier results, exit 1 on regression
+        python benchmark.py --basic                           # the original single scenario
+        python benchmark.py --memory --counts 100000          # bytes per rule instead of query speed
+
+    Each scenario (rule count x rule mix x query pattern x scheduler mode) runs in its own process,
+        so that peak memory can be measured per scenario.
+"""
 from datetime import *
+import argparse
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import time
+
 from scheduler import Scheduler
 
 
+COUNTS = [10, 100, 1000, 10000, 100000]
+MIXES = ["basic", "range", "holiday", "wildcard-year", "mixed"]
+PATTERNS = ["random", "sequential", "same-day"]
+MODES = ["scalar", "compiled"]
+
+
 def benchmark_basic_scheduler():
     import time
 
@@ -49,5 +77,217 @@ def benchmark_basic_scheduler():
     print "Difference: {:>33f}s".format(delta_get_matching_rules - delta_dtos)
 
 
+def make_rules(mix, count, rng):
+    """
+        Returns (rules, exceptions) with count entries in total, of the kind given by mix:
+            basic           "* 7-19 * * 1-5 *" style rules and exceptions
+            range           "7:30 19:15 * * 1-5 *" style rules and exceptions
+            holiday         a few rules, the rest "* * 25 12 * 2015" holidays
+            wildcard-year   a few rules, the rest "* * 25 12 * *" exceptions
+            mixed           all of the above, in equal parts
+    """
+    kinds = ["basic", "range", "holiday", "wildcard-year"] if mix == "mixed" else [mix]
+    rules = []
+    exceptions = []
+
+    for i in xrange(count):
+        kind = kinds[i % len(kinds)]
+        name = "state%d" % rng.randint(0, 9)
+        dow = rng.randint(1, 7)
+        dow = "%d-%d" % (dow, rng.randint(dow, 7))
+
+        if kind == "basic" or (i < 3 and kind in ("holiday", "wildcard-year")):
+            h = rng.randint(0, 23)
+            cron = "* %d-%d * * %s *" % (h, rng.randint(h, 23), dow)
+        elif kind == "range":
+            start = rng.randint(0, 1438)
+            stop = rng.randint(start, 1439)
+            cron = "%d:%02d %d:%02d * * %s *" % (start // 60, start % 60, stop // 60, stop % 60, dow)
+        elif kind == "holiday":
+            cron = "* * %d %d * %d" % (rng.randint(1, 28), rng.randint(1, 12), rng.randint(2000, 2025))
+        else:
+            cron = "* * %d %d * *" % (rng.randint(1, 28), rng.randint(1, 12))
+
+        #Holiday style strings only make sense as exceptions, the rest are split between rules and exceptions
+        if kind in ("holiday", "wildcard-year") and i >= 3:
+            exceptions.append((name, cron))
+        elif i % 4 == 3:
+            exceptions.append((name, cron))
+        else:
+            rules.append((name, cron))
+
+    return rules, exceptions
+
+
+def make_queries(pattern, n, rng):
+    """
+        random      minutes spread over 2014
+        sequential  consecutive minutes, starting 2014-06-01
+        same-day    random minutes of 2014-06-02
+    """
+    if pattern == "random":
+        start = datetime(2014, 1, 1)
+        return [start + timedelta(minutes=rng.randint(0, 365 * 24 * 60 - 1)) for i in xrange(n)]
+    elif pattern == "sequential":
+        start = datetime(2014, 6, 1)
+        return [start + timedelta(minutes=i) for i in xrange(n)]
+    else:
+        start = datetime(2014, 6, 2)
+        return [start + timedelta(minutes=rng.randint(0, 24 * 60 - 1)) for i in xrange(n)]
+
+
+def run_scenario(count, mix, pattern, mode, n_queries, time_budget, seed=0):
+    """
+        Builds a Scheduler and queries it, returns a dictionary of measurements.
+            Queries stop early once time_budget seconds are spent on them.
+    """
+    rng = random.Random(seed)
+    rules, exceptions = make_rules(mix, count, rng)
+    queries = make_queries(pattern, n_queries, rng)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.time()
+    cp = Scheduler(rules, exceptions, compiled=(mode == "compiled"), cache_size=(64 if mode == "cached" else 0),
+        adaptive=(mode == "adaptive"))
+    build_seconds = time.time() - start
+
+    done = 0
+    start = time.time()
+    deadline = start + time_budget
+    for time_obj in queries:
+        cp.get_matching_rules(time_obj)
+        done += 1
+        if done % 64 == 0 and time.time() > deadline:
+            break
+    query_seconds = time.time() - start
+
+    return {
+        "count": count,
+        "mix": mix,
+        "pattern": pattern,
+        "mode": mode,
+        "build_seconds": build_seconds,
+        "queries": done,
+        "query_seconds": query_seconds,
+        "seconds_per_query": query_seconds / done,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "peak_rss_delta_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    }
+
+
+def run_memory(count, mix, seed=0):
+    """
+        Builds a Scheduler with count rules and exceptions, returns how much the peak RSS grew per rule
+    """
+    rng = random.Random(seed)
+    rules, exceptions = make_rules(mix, count, rng)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    cp = Scheduler(rules, exceptions)
+    rss_delta_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+
+    return {
+        "count": count,
+        "mix": mix,
+        "rules": sum(len(r) for r in cp.rules.values()) + sum(len(e) for e in cp.exceptions.values()),
+        "peak_rss_delta_kb": rss_delta_kb,
+        "bytes_per_rule": rss_delta_kb * 1024.0 / count
+    }
+
+
+def _run_in_child(queue, fn, args):
+    queue.put(fn(*args))
+
+
+def run_isolated(*args, **kwargs):
+    """
+        run_scenario (or kwargs["fn"]) in a separate process, so that peak memory isn't shared between scenarios
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_in_child, args=(queue, kwargs.get("fn", run_scenario), args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def key(result):
+    return "{count}/{mix}/{pattern}/{mode}".format(**result)
+
+
+def compare(results, baseline, threshold):
+    """
+        Returns a list of (key, measurement, baseline value, new value) for every measurement (build time, time per
+            query and peak memory growth) that got worse than the baseline by more than threshold (a fraction,
+            e.g. 0.2 for 20%)
+    """
+    previous = dict((key(r), r) for r in baseline["results"])
+    regressions = []
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        for measurement in ("build_seconds", "seconds_per_query", "peak_rss_delta_kb"):
+            if result[measurement] > old[measurement] * (1 + threshold):
+                regressions.append((key(result), measurement, old[measurement], result[measurement]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark pycronius Schedulers")
+    split = lambda s: s.split(",")
+    parser.add_argument("--counts", type=lambda s: map(int, s.split(",")), default=COUNTS)
+    parser.add_argument("--mixes", type=split, default=MIXES)
+    parser.add_argument("--patterns", type=split, default=PATTERNS)
+    parser.add_argument("--modes", type=split, default=MODES, help="any of scalar, compiled, cached, adaptive")
+    parser.add_argument("--queries", type=int, default=2000, help="queries per scenario")
+    parser.add_argument("--time-budget", type=float, default=2.0, help="maximum seconds of queries per scenario")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare with results from this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown against the baseline, 0.2 = 20%%")
+    parser.add_argument("--basic", action="store_true", help="run the original single scenario benchmark")
+    parser.add_argument("--memory", action="store_true", help="measure bytes per rule for every count and mix")
+    args = parser.parse_args(argv)
+
+    if args.basic:
+        benchmark_basic_scheduler()
+        return 0
+
+    if args.memory:
+        print "{:>7} {:>14} {:>10} {:>14}".format("rules", "mix", "parsed", "bytes/rule")
+        for count in args.counts:
+            for mix in args.mixes:
+                result = run_isolated(count, mix, fn=run_memory)
+                print "{:>7} {:>14} {:>10} {:>14.0f}".format(count, mix, result["rules"], result["bytes_per_rule"])
+                sys.stdout.flush()
+        return 0
+
+    print "{:>7} {:>14} {:>11} {:>9} {:>10} {:>12} {:>10}".format("rules", "mix", "pattern", "mode", "build s", "us/query", "peak MB")
+    results = []
+    for count in args.counts:
+        for mix in args.mixes:
+            for pattern in args.patterns:
+                for mode in args.modes:
+                    result = run_isolated(count, mix, pattern, mode, args.queries, args.time_budget)
+                    results.append(result)
+                    print "{:>7} {:>14} {:>11} {:>9} {:>10.4f} {:>12.2f} {:>10.1f}".format(count, mix, pattern, mode,
+                        result["build_seconds"], result["seconds_per_query"] * 1e6, result["peak_rss_kb"] / 1024.0)
+                    sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(), "results": results}, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for scenario, measurement, old, new in regressions:
+            print "REGRESSION {} {}: {:f} -> {:f}".format(scenario, measurement, old, new)
+        if regressions:
+            return 1
+
+    return 0
+
+
 if __name__ == "__main__":
-    benchmark_basic_scheduler()
+    sys.exit(main())
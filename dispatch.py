@@ -0,0 +1,181 @@
+"""
+    Runs callbacks when Schedulers match, without polling every rule every minute.
+
+        dispatcher = Dispatcher()
+        dispatcher.add(Scheduler([("backup", "0 3 * * * *")]), "backup", run_backup)
+        dispatcher.run()
+
+    The dispatcher keeps a heap of every job's next fire time (see Scheduler.next_match), sleeps until the earliest
+        one, hands the due callbacks to an executor and only reschedules the jobs that fired.
+"""
+from datetime import datetime, timedelta
+from heapq import heappop, heappush
+from itertools import count
+from multiprocessing.pool import ThreadPool
+import sys
+import threading
+import time
+
+
+class SystemClock(object):
+    """
+        The wall clock.  Dispatcher only uses now() and sleep(seconds), so tests can pass a fake one
+    """
+
+    def now(self):
+        return datetime.now()
+
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class Job(object):
+    """
+        callback(name, fire_time) is called whenever scheduler.get_matching_rules contains name
+    """
+
+    def __init__(self, scheduler, name, callback):
+        self.scheduler = scheduler
+        self.name = name
+        self.callback = callback
+        self.next_fire_time = None
+        self.cancelled = False
+
+
+class Dispatcher(object):
+    """
+        Fire times are whole minutes.  If the dispatcher falls behind (e.g. the process was suspended), a job fires
+            once for the minutes it missed and is then rescheduled after the current time.
+
+        executor(fn, args) must run fn(*args), now or later, in any thread.  By default a ThreadPool of
+            max_concurrency threads is used.  At most max_concurrency callbacks run at the same time; once that many
+            are running, dispatching waits for one of them to finish.
+
+        on_error(job, fire_time, exc_info) is called if a callback raises.
+
+        Jobs should be added and removed from the thread that calls run(), or while it isn't running.
+    """
+
+    def __init__(self, clock=None, executor=None, max_concurrency=8, on_error=None):
+        self.clock = clock or SystemClock()
+        self.executor = executor
+        self.max_concurrency = max_concurrency
+        self.on_error = on_error
+
+        self._heap = []         # (next fire time, seq, job)
+        self._counter = count()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._pool = None
+        self._stopped = False
+
+
+    def __len__(self):
+        return sum(1 for fire_time, seq, job in self._heap if not job.cancelled)
+
+
+    def add(self, scheduler, name, callback):
+        """
+            Returns a Job calling callback(name, fire_time) at every minute, from now on, for which
+                scheduler.get_matching_rules contains name
+        """
+        job = Job(scheduler, name, callback)
+        #Include the current minute if it has only just started
+        self._schedule(job, self.clock.now() - timedelta(microseconds=1))
+        return job
+
+
+    def remove(self, job):
+        """
+            Stops job from firing again.  It is dropped from the heap when it comes up
+        """
+        job.cancelled = True
+
+
+    def _schedule(self, job, after):
+        job.next_fire_time = job.scheduler.next_match(after, job.name)
+        if job.next_fire_time is not None:
+            heappush(self._heap, (job.next_fire_time, next(self._counter), job))
+
+
+    def next_fire_time(self):
+        """
+            Returns the earliest fire time of any job, or None if no job will fire again
+        """
+        while self._heap and self._heap[0][2].cancelled:
+            heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+
+    def run_pending(self):
+        """
+            Dispatches every job that is due, returns the number of callbacks dispatched
+        """
+        now = self.clock.now()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            fire_time, seq, job = heappop(self._heap)
+            if not job.cancelled:
+                due.append((fire_time, job))
+
+        for fire_time, job in due:
+            self._dispatch(job, fire_time)
+            self._schedule(job, max(fire_time, now))
+
+        return len(due)
+
+
+    def run(self, until=None):
+        """
+            Sleeps until the next fire time and dispatches the jobs that are due, until stop() is called,
+                no job will fire again, or the next fire time is after until (a datetime)
+        """
+        self._stopped = False
+        while not self._stopped:
+            fire_time = self.next_fire_time()
+            if fire_time is None or (until is not None and fire_time > until):
+                break
+
+            wait = (fire_time - self.clock.now()).total_seconds()
+            if wait > 0:
+                self.clock.sleep(wait)
+            else:
+                self.run_pending()
+
+
+    def stop(self):
+        self._stopped = True
+
+
+    def _dispatch(self, job, fire_time):
+        self._slots.acquire()
+        try:
+            if self.executor is not None:
+                self.executor(self._call, (job, fire_time))
+            else:
+                if self._pool is None:
+                    self._pool = ThreadPool(self.max_concurrency)
+                self._pool.apply_async(self._call, (job, fire_time))
+        except:
+            self._slots.release()
+            raise
+
+
+    def _call(self, job, fire_time):
+        try:
+            job.callback(job.name, fire_time)
+        except Exception:
+            if self.on_error is not None:
+                self.on_error(job, fire_time, sys.exc_info())
+        finally:
+            self._slots.release()
+
+
+    def close(self):
+        """
+            Waits for the running callbacks of the default executor to finish
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
@@ -0,0 +1,371 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, OrderedDict
+from heapq import heappush, heappop
+from itertools import count
+
+from rules import month_shape, YearCycle
+from utils import iter_bits
+
+
+class RuleIndex(object):
+    """
+        Inverted index over a collection of named rules.
+
+        For every field (year, month, dom, dow and minute of day) there is a table from value to a bitmask
+            whose bit i is set if the rule in slot i accepts that value.  Unbounded year fields (rules.YearCycle)
+            get one bitmask per distinct cycle instead, which is ORed in for the years in the cycle.  Rules with
+            "#n" / "L" weekdays (rules.NthWeekdayRule) also get a table from (weekday, n) to bitmask, n being the
+            occurrence of the weekday in the month or -1 for the last one, and every other rule is in every_occurrence.  A lookup ANDs five integers, so the
+            cost depends on the number of matches rather than the number of rules.
+
+        Hours and minutes are combined into one minute-of-day table so that CronRangeRule (HH:MM) rules can be
+            indexed the same way as traditional cron rules.  That table is stored as segments between the
+            minutes at which any rule starts or stops matching, so adding a rule only touches the segments it spans.
+
+        Slots are ordered like Scheduler.rules / Scheduler.exceptions: by the order in which a name was first
+            added, then by the order in which rules were added under that name.
+    """
+
+    def __init__(self):
+        self.years = defaultdict(int)
+        self.year_cycles = {}               # YearCycle -> mask
+        self.occurrences = defaultdict(int) # (weekday, n) -> mask, for rules with an "nth" field
+        self.every_occurrence = 0           # mask of the rules without one
+        self.months = [0] * 13
+        self.dom = [0] * 32
+        self.dow = [0] * 8
+        self.minute_bounds = [0]            # start of each segment of the day, in minutes since midnight
+        self.minute_masks = [0]             # mask of each segment
+
+        self.entries = {}                   # slot -> (rank, seq, name, rule)
+        self.slots = defaultdict(list)      # name -> [slot, ...]
+        self.ranks = {}                     # name -> rank
+
+        self._free = []
+        self._next_slot = 0
+        self._counter = count()
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def _fields(self, rule):
+        rulesets = rule.rulesets
+        return [
+            (self.months, rulesets["month"]),
+            (self.dom, rulesets["dom"]),
+            (self.dow, rulesets["dow"])
+        ]
+
+
+    def _split(self, minute_of_day):
+        """
+            Makes sure a segment starts at minute_of_day, returns its index
+        """
+        if minute_of_day >= 1440:
+            return len(self.minute_bounds)
+
+        i = bisect_right(self.minute_bounds, minute_of_day) - 1
+        if self.minute_bounds[i] != minute_of_day:
+            i += 1
+            self.minute_bounds.insert(i, minute_of_day)
+            self.minute_masks.insert(i, self.minute_masks[i - 1])
+        return i
+
+
+    def _segments(self, rule):
+        """
+            Yields the indexes of the segments covered by rule
+        """
+        for start, stop in rule.minute_intervals():
+            for i in xrange(self._split(start), self._split(stop + 1)):
+                yield i
+
+
+    def add(self, name, rule):
+        """
+            Indexes rule under name, returns the slot it was given
+        """
+        if self._free:
+            slot = heappop(self._free)
+        else:
+            slot = self._next_slot
+            self._next_slot += 1
+
+        self.reserve(name)
+        self.entries[slot] = (self.ranks[name], next(self._counter), name, rule)
+        self.slots[name].append(slot)
+
+        bit = 1 << slot
+        years = rule.rulesets["year"]
+        if isinstance(years, YearCycle):
+            self.year_cycles[years] = self.year_cycles.get(years, 0) | bit
+        else:
+            for y in years:
+                self.years[y] |= bit
+
+        for table, values in self._fields(rule):
+            for v in values:
+                if 0 <= v < len(table):
+                    table[v] |= bit
+
+        nth = rule.rulesets.get("nth")
+        if nth is None:
+            self.every_occurrence |= bit
+        else:
+            for key in nth:
+                self.occurrences[key] |= bit
+
+        for i in self._segments(rule):
+            self.minute_masks[i] |= bit
+
+        return slot
+
+
+    def reserve(self, name):
+        """
+            Fixes name's place in the order, as if a rule called name was added now, unless it already has one
+        """
+        if name not in self.ranks:
+            self.ranks[name] = next(self._counter)
+
+
+    def remove(self, slot):
+        """
+            Removes the rule in slot from every table and frees the slot
+        """
+        rank, seq, name, rule = self.entries.pop(slot)
+        self.slots[name].remove(slot)
+        if not self.slots[name]:
+            del self.slots[name]
+            del self.ranks[name]
+
+        mask = ~(1 << slot)
+        years = rule.rulesets["year"]
+        if isinstance(years, YearCycle):
+            self.year_cycles[years] &= mask
+            if not self.year_cycles[years]:
+                del self.year_cycles[years]
+        else:
+            for y in years:
+                self.years[y] &= mask
+                if not self.years[y]:
+                    del self.years[y]
+
+        for table, values in self._fields(rule):
+            for v in values:
+                if 0 <= v < len(table):
+                    table[v] &= mask
+
+        nth = rule.rulesets.get("nth")
+        if nth is None:
+            self.every_occurrence &= mask
+        else:
+            for key in nth:
+                self.occurrences[key] &= mask
+                if not self.occurrences[key]:
+                    del self.occurrences[key]
+
+        for i in self._segments(rule):
+            self.minute_masks[i] &= mask
+
+        heappush(self._free, slot)
+
+
+    def replace(self, name, rules):
+        """
+            Replaces every rule indexed under name with rules, keeping name's place in the order
+        """
+        rank = self.ranks.get(name)
+        for slot in list(self.slots.get(name, [])):
+            self.remove(slot)
+
+        self.ranks.pop(name, None)
+        if rank is not None and rules:
+            self.ranks[name] = rank
+        for rule in rules:
+            self.add(name, rule)
+
+
+    def year_mask(self, year):
+        """
+            Returns the bitmask of slots whose rules accept year
+        """
+        mask = self.years.get(year, 0)
+        for cycle, cycle_mask in self.year_cycles.iteritems():
+            if year in cycle:
+                mask |= cycle_mask
+        return mask
+
+
+    def match(self, time_obj):
+        """
+            Returns the bitmask of slots whose rules contain time_obj
+        """
+        mask = self.year_mask(time_obj.year) & self.months[time_obj.month] & self.dom[time_obj.day] &\
+            self.dow[time_obj.isoweekday()] &\
+            self.minute_masks[bisect_right(self.minute_bounds, time_obj.hour * 60 + time_obj.minute) - 1]
+
+        if self.occurrences and mask:
+            dow, day = time_obj.isoweekday(), time_obj.day
+            occurrence_mask = self.every_occurrence | self.occurrences.get((dow, (day - 1) // 7 + 1), 0)
+            if day + 7 > month_shape(time_obj.year, time_obj.month)[1]:
+                occurrence_mask |= self.occurrences.get((dow, -1), 0)
+            mask &= occurrence_mask
+        return mask
+
+
+    def overlapping(self, rule):
+        """
+            Returns the bitmask of slots whose rules share at least one value with rule in every field
+                (they may still not overlap, e.g. if the only common day is February 30th, or if they accept
+                different occurrences of a weekday)
+        """
+        mask = 0
+        years = rule.rulesets["year"]
+        if isinstance(years, YearCycle):
+            for y, year_mask in self.years.iteritems():
+                if y in years:
+                    mask |= year_mask
+            for cycle, cycle_mask in self.year_cycles.iteritems():
+                if cycle & years:
+                    mask |= cycle_mask
+        else:
+            for y in years:
+                mask |= self.year_mask(y)
+
+        for table, values in self._fields(rule):
+            if not mask:
+                return 0
+            field_mask = 0
+            for v in values:
+                if 0 <= v < len(table):
+                    field_mask |= table[v]
+            mask &= field_mask
+
+        minute_mask = 0
+        for start, stop in rule.minute_intervals():
+            for i in xrange(bisect_right(self.minute_bounds, start) - 1, bisect_right(self.minute_bounds, stop)):
+                minute_mask |= self.minute_masks[i]
+        return mask & minute_mask
+
+
+    def names(self, mask):
+        """
+            Returns the names of the slots in mask, ordered like Scheduler.get_matching_rules would return them
+        """
+        return [entry[2] for entry in sorted(self.entries[slot] for slot in iter_bits(mask))]
+
+
+    def first(self, mask):
+        """
+            Returns the name of the first slot in mask (in Scheduler order), or None for an empty mask
+        """
+        if not mask:
+            return None
+        return min(self.entries[slot] for slot in iter_bits(mask))[2]
+
+
+class IntervalIndex(object):
+    """
+        Minute-of-day intervals of a list of rules (typically CronRangeRules), grouped by the dates they apply to.
+
+        Within a group, the day is split into segments at every interval's start and end, and each segment holds
+            the sorted positions of the rules covering it, so finding every rule that contains a time is one
+            date check and one bisect per group.  If a group's intervals overlap so much that the segments would
+            hold more than max_coverage positions per interval, segments hold bitmasks over the group's intervals
+            instead, which keeps the group's size quadratic in bits rather than in positions.
+    """
+
+    max_coverage = 8
+
+    def __init__(self, rules):
+        """
+            rules is a list of (position, rule), positions are returned by match()
+        """
+        groups = OrderedDict()
+        for position, rule in rules:
+            rulesets = rule.rulesets
+            key = (rulesets["year"], rulesets["month"], rulesets["dom"], rulesets["dow"])
+            intervals = groups.setdefault(key, [])
+            for start, stop in rule.minute_intervals():
+                intervals.append((start, stop, position))
+
+        self.groups = [group_key + self._segments(group_intervals) for group_key, group_intervals in groups.items()]
+
+
+    def _segments(self, intervals):
+        """
+            Returns (bounds, covering, positions) for a group.  covering[i] is the tuple of positions covering the
+                segment starting at bounds[i], or, if positions is not None, a bitmask whose bit b stands for positions[b]
+        """
+        bounds = sorted(set([0] + [start for start, stop, position in intervals] +
+            [stop + 1 for start, stop, position in intervals if stop < 1439]))
+        positions = sorted(position for start, stop, position in intervals)
+
+        #Sweep the day, adding the intervals that start at a segment and dropping those that ended before it
+        starts = defaultdict(int)
+        stops = defaultdict(int)
+        changes = [0] * (len(bounds) + 1)
+        for bit, (start, stop, position) in enumerate(sorted(intervals, key=lambda interval: interval[2])):
+            first, last = bisect_left(bounds, start), bisect_left(bounds, stop + 1)
+            starts[first] |= 1 << bit
+            stops[last] |= 1 << bit
+            changes[first] += 1
+            changes[last] -= 1
+
+        masks = []
+        mask = size = active = 0
+        for i in xrange(len(bounds)):
+            mask = (mask & ~stops.get(i, 0)) | starts.get(i, 0)
+            masks.append(mask)
+            active += changes[i]
+            size += active
+
+        if size > self.max_coverage * len(intervals):
+            return bounds, masks, positions
+        return bounds, [tuple(positions[bit] for bit in iter_bits(segment_mask)) for segment_mask in masks], None
+
+
+    def match(self, time_obj):
+        """
+            Returns the sorted positions of the rules that contain time_obj
+        """
+        year, month, day, dow = time_obj.year, time_obj.month, time_obj.day, time_obj.isoweekday()
+        minute_of_day = time_obj.hour * 60 + time_obj.minute
+
+        matched = []
+        n_groups = 0
+        for years, months, doms, dows, bounds, covering, positions in self.groups:
+            if year in years and month in months and day in doms and dow in dows:
+                covered = covering[bisect_right(bounds, minute_of_day) - 1]
+                if positions is not None:
+                    covered = [positions[bit] for bit in iter_bits(covered)]
+                if covered:
+                    matched.extend(covered)
+                    n_groups += 1
+
+        if n_groups > 1:
+            matched.sort()
+        return matched
+
+
+    def first(self, time_obj):
+        """
+            Returns the lowest position of a rule that contains time_obj, or None
+        """
+        year, month, day, dow = time_obj.year, time_obj.month, time_obj.day, time_obj.isoweekday()
+        minute_of_day = time_obj.hour * 60 + time_obj.minute
+
+        first = None
+        for years, months, doms, dows, bounds, covering, positions in self.groups:
+            if year in years and month in months and day in doms and dow in dows:
+                covered = covering[bisect_right(bounds, minute_of_day) - 1]
+                if not covered:
+                    continue
+                position = covered[0] if positions is None else positions[(covered & -covered).bit_length() - 1]
+                if first is None or position < first:
+                    first = position
+
+        return first
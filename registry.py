@@ -0,0 +1,157 @@
+from collections import defaultdict
+
+from index import RuleIndex
+from rules import *
+from utils import iter_bits
+
+
+class _Shard(object):
+    """
+        Indexes for a group of tenants.  Keeping every index at most SchedulerRegistry.shard_size slots wide keeps
+            the bitmasks short, so adding or removing a tenant doesn't copy masks covering every tenant.
+    """
+
+    def __init__(self):
+        self.rule_index = RuleIndex()           # slots are named (tenant, name)
+        self.exception_index = RuleIndex()
+        self.state_masks = defaultdict(int)     # name -> mask of the rule slots with that name
+        self.n_tenants = 0
+
+
+    def size(self):
+        return max(len(self.rule_index), len(self.exception_index))
+
+
+class SchedulerRegistry(object):
+    """
+        Rules and exceptions of many tenants (e.g. one Scheduler per business) in shared indexes,
+            so that "which tenants are open right now" is a single query:
+
+            registry = SchedulerRegistry()
+            registry.add_tenant("bakery", rules, exceptions)
+            ...
+            registry.match_all(datetime.now(), "open") -> set(["bakery", ...])
+
+        For every tenant, match_all gives the same answer as that tenant's own Scheduler.get_matching_rules.
+    """
+
+    shard_size = 4096
+
+    def __init__(self, start_year=None, stop_year=None):
+        """
+            start_year and stop_year are applied to every tenant's rules, see Scheduler
+        """
+        self.start_year = start_year
+        self.stop_year = stop_year
+
+        self._shards = []
+        self._holidays = defaultdict(dict)      # (dd, mm, yyyy) -> {tenant: name}
+        self._tenants = {}                      # tenant -> (shard, rule slots, exception slots, holiday keys)
+
+
+    def __len__(self):
+        return len(self._tenants)
+
+
+    def __contains__(self, tenant):
+        return tenant in self._tenants
+
+
+    def add_tenant(self, tenant, rules=list(), exceptions=list()):
+        """
+            rules and exceptions look like the arguments to Scheduler.  If tenant is already registered,
+                its rules and exceptions are replaced.  Only this tenant's entries are touched.
+        """
+        if tenant in self._tenants:
+            self.remove_tenant(tenant)
+
+        #Parse everything first, so that an invalid string doesn't leave the tenant half registered
+        rules = [(rname, get_rule(rule, self.start_year, self.stop_year)) for rname, rule in rules]
+        holidays = []
+        general = []
+        for ename, exception in exceptions:
+            if BasicCronRule.is_holiday(exception):
+                holidays.append((BasicCronRule.holiday_tuple(exception), ename))
+            else:
+                general.append((ename, get_rule(exception, self.start_year, self.stop_year)))
+
+        for shard in self._shards:
+            if shard.size() + max(len(rules), len(general)) <= self.shard_size:
+                break
+        else:
+            shard = _Shard()
+            self._shards.append(shard)
+
+        rule_slots = []
+        for rname, rule in rules:
+            slot = shard.rule_index.add((tenant, rname), rule)
+            shard.state_masks[rname] |= 1 << slot
+            rule_slots.append(slot)
+
+        exception_slots = [shard.exception_index.add((tenant, ename), exception) for ename, exception in general]
+        shard.n_tenants += 1
+
+        for key, ename in holidays:
+            self._holidays[key][tenant] = ename
+
+        self._tenants[tenant] = (shard, rule_slots, exception_slots, [key for key, ename in holidays])
+
+
+    def remove_tenant(self, tenant):
+        """
+            Removes tenant's rules, exceptions and holidays.  Raises KeyError if tenant is not registered
+        """
+        shard, rule_slots, exception_slots, holiday_keys = self._tenants.pop(tenant)
+
+        for slot in rule_slots:
+            rname = shard.rule_index.entries[slot][2][1]
+            shard.state_masks[rname] &= ~(1 << slot)
+            if not shard.state_masks[rname]:
+                del shard.state_masks[rname]
+            shard.rule_index.remove(slot)
+
+        for slot in exception_slots:
+            shard.exception_index.remove(slot)
+
+        shard.n_tenants -= 1
+        if not shard.n_tenants:
+            self._shards.remove(shard)
+
+        for key in holiday_keys:
+            self._holidays[key].pop(tenant, None)
+            if not self._holidays[key]:
+                del self._holidays[key]
+
+
+    def match_all(self, time_obj, state):
+        """
+            Returns the set of tenants for which get_matching_rules(time_obj) would contain state,
+                with each tenant's holidays and exceptions taking precedence over its rules.
+
+            Only matching holidays, exceptions and rules are visited, so apart from a handful of integer ANDs per
+                shard_size tenants, the cost grows with the number of tenants that match rather than the number
+                of tenants registered.
+        """
+        holidays = self._holidays.get((time_obj.day, time_obj.month, time_obj.year), {})
+        matched = set(tenant for tenant, hname in holidays.items() if hname == state)
+
+        for shard in self._shards:
+            #The first matching exception of every tenant (entries sort in each tenant's Scheduler order)
+            first_exceptions = {}
+            entries = shard.exception_index.entries
+            for slot in iter_bits(shard.exception_index.match(time_obj)):
+                entry = entries[slot]
+                tenant = entry[2][0]
+                if tenant not in first_exceptions or entry < first_exceptions[tenant]:
+                    first_exceptions[tenant] = entry
+
+            matched.update(tenant for tenant, entry in first_exceptions.items() if entry[2][1] == state and tenant not in holidays)
+
+            #No exceptions match, so all rules are available
+            entries = shard.rule_index.entries
+            for slot in iter_bits(shard.rule_index.match(time_obj) & shard.state_masks.get(state, 0)):
+                tenant = entries[slot][2][0]
+                if tenant not in holidays and tenant not in first_exceptions:
+                    matched.add(tenant)
+
+        return matched
@@ -1,8 +1,13 @@
+from bisect import bisect_left, bisect_right
+from calendar import monthrange
+from collections import namedtuple
+from datetime import date, datetime
+from fractions import gcd
+from operator import attrgetter, methodcaller
 import re
+from weakref import WeakValueDictionary
 
-from utils import Bunch
-
-#TODO: consider adding "* * last 11 4 *" style strings (last thursday of november)
+from utils import minute_after, minute_before
 
 class InvalidFieldError(Exception):
     pass
@@ -11,21 +16,148 @@ class InvalidCronStringError(Exception):
     pass
 
 
+#Compiled once, see BasicCronRule.parse_field
+_field_patterns = [
+    (re.compile(r"^(\d{1,4})$"), lambda g, minimum, maximum: {int(g[0])}),
+    (re.compile(r"^(\d{1,4})-(\d{1,4})$"), lambda g, minimum, maximum: set(xrange(int(g[0]), int(g[1])+1))),
+    (re.compile(r"^(\d{1,4})-(\d{1,4})\/(\d{1,4})$"), lambda g, minimum, maximum: set(xrange(int(g[0]), int(g[1])+1, int(g[2])))),
+    (re.compile(r"^\*$"), lambda g, minimum, maximum: set(xrange(minimum, maximum+1))),
+    (re.compile(r"^\*\/(\d{1,4})$"), lambda g, minimum, maximum: set(xrange(minimum, maximum+1, int(g[0]))))
+]
+_list_pattern = re.compile(r"^([\d\-\/]+),([\d\-\/,]+)$")
+_year_cycle_pattern = re.compile(r"^\*(?:\/(\d{1,4}))?$")
+_nth_weekday_pattern = re.compile(r"^([1-7])(?:#([1-5])|(L))$")
+
+
+_MATCHED = frozenset([1])
+
+HourMinute = namedtuple("HourMinute", ["hour", "minute"])
+
+_month_shapes = {}  # (yyyy, mm) -> (weekday of the 1st, 0 for Monday, number of days)
+
+def month_shape(year, month):
+    """
+        Returns calendar.monthrange(year, month), cached
+    """
+    shape = _month_shapes.get((year, month))
+    if shape is None:
+        shape = _month_shapes[year, month] = monthrange(year, month)
+    return shape
+
+#Every distinct field value is stored once, e.g. all wildcard minute fields share one 60 element frozenset
+_interned_fields = WeakValueDictionary()
+
+def intern_field(values):
+    """
+        Returns a frozenset equal to values (or values, if it is a YearCycle), shared with every other rule holding
+            the same values
+    """
+    if not isinstance(values, YearCycle):
+        values = frozenset(values)
+    return _interned_fields.setdefault(values, values)
+
+
+class YearCycle(object):
+    """
+        Unbounded year field: the years y with y % step == offset, so "*" is YearCycle(1, 0) and "*/4" counted from
+            2001 is YearCycle(4, 1).  Membership is arithmetic, so the field takes the same memory for any span
+            of years.  Supports `in` and `&` (with another YearCycle or a set of years) like the other fields' frozensets
+    """
+    __slots__ = ("step", "offset", "__weakref__")
+
+    #The Gregorian calendar repeats every 400 years, so a search that finds nothing in 400 cycles never will
+    calendar_cycle = 400
+
+    def __init__(self, step=1, offset=0):
+        if step < 1:
+            raise InvalidFieldError("*/{}".format(step))
+        self.step = step
+        self.offset = offset % step
+
+    def __contains__(self, year):
+        return year % self.step == self.offset
+
+    def __eq__(self, other):
+        return isinstance(other, YearCycle) and self.step == other.step and self.offset == other.offset
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((YearCycle, self.step, self.offset))
+
+    def __repr__(self):
+        return "YearCycle({}, {})".format(self.step, self.offset)
+
+    def __reduce__(self):
+        return YearCycle, (self.step, self.offset)
+
+    def __and__(self, other):
+        if isinstance(other, YearCycle):
+            step = self.step * other.step // gcd(self.step, other.step)
+            for y in xrange(self.offset, step, self.step):
+                if y in other:
+                    return YearCycle(step, y)
+            return frozenset()
+        return frozenset(y for y in other if y in self)
+
+    __rand__ = __and__
+
+    def next(self, year):
+        """
+            Returns the first year in the cycle that is >= year
+        """
+        return year + (self.offset - year) % self.step
+
+    def previous(self, year):
+        """
+            Returns the last year in the cycle that is <= year
+        """
+        return year - (year - self.offset) % self.step
+
+    def between(self, first, last):
+        """
+            Returns the years in the cycle from first to last (inclusive), in order
+        """
+        return range(self.next(first), last + 1, self.step)
+
+
 class BasicCronRule(object):
 
+    __slots__ = ("rulesets", "_derived")
+
     start_year = 2000
     stop_year = 2025
     holiday_re = "[\*]\s[\*]\s(\d{1,2})\s(\d{1,2})\s[\*]\s(\d{4})"
+    _holiday_pattern = re.compile(holiday_re)
+
+    parse_cache_size = 10000
+    _parse_cache = {}  # (class, cron_string, start_year, stop_year) -> (rulesets, derived), shared by all subclasses
 
     def __init__(self, cron_string, start_year=None, stop_year=None):
         """
             cron_string should look like: "* */6 * * 6-7 2015"
 
-            start_year and stop_year are integers that determine the inclusive range of years that will be checked
-                default is the class variables start_year and stop_year
+            start_year and stop_year are integers, default is the class variables start_year and stop_year.
+                Wildcard year fields ("*" and "*/n") are YearCycles that match any year, "*/n" counting from start_year.
+                The other fields ("2015", "2010-2020/2", ...) match the years they list.  stop_year only bounds
+                sorted_field("year") and iter_dates() for wildcard years.
+
+            Rules built from the same cron_string and years share their (frozen) rulesets, see parse_cached()
         """
 
-        self.rulesets = self.parse(cron_string, start_year, stop_year)
+        self.rulesets, self._derived = self.parse_cached(cron_string, start_year, stop_year)
+
+
+    def __getstate__(self):
+        #Only the rulesets are pickled, the derived values (some of which are closures) are recomputed when needed
+        return self.rulesets
+
+
+    def __setstate__(self, rulesets):
+        self.rulesets = {field: intern_field(v) if isinstance(v, (set, frozenset, YearCycle)) else v
+            for field, v in rulesets.items()}
+        self._derived = {}
 
 
     @classmethod
@@ -40,26 +172,56 @@ class BasicCronRule(object):
 
             handles rules that look like: "12", "1-10", "1-10/2", "*", "*/10", "1-10/3,12,14-16"
         """
-        regexes = [
-            ("^(\d{1,2})$", lambda d: {int(d)}),
-            ("^(\d{1,2})-(\d{1,2})$", lambda t: set(xrange(int(t[0]), int(t[1])+1))),
-            ("^(\d{1,2})-(\d{1,2})\/(\d{1,2})$", lambda t: set(xrange(int(t[0]), int(t[1])+1, int(t[2])))),
-            ("^\*$", lambda wc: set(xrange(minimum, maximum+1))),
-            ("^\*\/(\d{1,2})$", lambda d: set(xrange(minimum, maximum+1, int(d)))),
-            ("^([\d\-\/]+),([\d\-\/,]+)$", lambda t: cls.parse_field(t[0]).union(cls.parse_field(t[1])))
-        ]
+        for pattern, fn in _field_patterns:
+            match = pattern.match(f)
+            if match is not None:
+                return fn(match.groups(), minimum, maximum)
 
-
-        for regex, fn in regexes:
-            matches = re.findall(regex, f)
-            if len(matches) > 0:
-                v = fn(matches[0])
-                return v
+        match = _list_pattern.match(f)
+        if match is not None:
+            return cls.parse_field(match.group(1)).union(cls.parse_field(match.group(2)))
 
         #If none of the regexes match, this field is not valid
         raise InvalidFieldError(f)
 
 
+    @classmethod
+    def parse_year_field(cls, f, start_year, stop_year):
+        """
+            Same as parse_field for the year field, except that "*" and "*/n" return an (unbounded) YearCycle,
+                with "*/n" counting from start_year
+        """
+        match = _year_cycle_pattern.match(f)
+        if match is not None:
+            return YearCycle(int(match.group(1) or 1), start_year)
+        return cls.parse_field(f, start_year, stop_year)
+
+
+    @classmethod
+    def parse_cached(cls, cron_string, start_year=None, stop_year=None):
+        """
+            Same as parse(), but results are kept in a bounded, process-wide cache (see parse_cache_size), so identical
+                strings only get parsed once.  When the cache is full an arbitrary entry is evicted.  The field sets are
+                interned frozensets (see intern_field()), and both the returned rulesets and the dictionary of values
+                derived from them (sorted fields etc.) are shared, so they must not be modified.
+
+            returns (rulesets, derived)
+        """
+        key = (cls, cron_string, start_year or cls.start_year, stop_year or cls.stop_year)
+        cache = BasicCronRule._parse_cache
+
+        entry = cache.get(key)
+        if entry is None:
+            rulesets = cls.parse(cron_string, start_year, stop_year)
+            entry = {field: intern_field(v) if isinstance(v, (set, frozenset, YearCycle)) else v
+                for field, v in rulesets.items()}, {}
+            if len(cache) >= BasicCronRule.parse_cache_size:
+                cache.popitem()
+            cache[key] = entry
+
+        return entry
+
+
     @classmethod
     def parse(cls, cron_string, start_year=None, stop_year=None):
         """
@@ -77,7 +239,7 @@ class BasicCronRule(object):
                 "dom": cls.parse_field(fields[2], 1, 31),
                 "month": cls.parse_field(fields[3], 1, 12),
                 "dow": cls.parse_field(fields[4], 1, 7),
-                "year": cls.parse_field(fields[5], start_year, stop_year)  #What is a sensible year here?
+                "year": cls.parse_year_field(fields[5], start_year, stop_year)
             }
         except InvalidFieldError as e:
             raise InvalidCronStringError("{}:  ({})".format(cron_string, e.args[0]))
@@ -90,7 +252,7 @@ class BasicCronRule(object):
 
             e.g. Easter: "* * 5 4 * 2015"
         """
-        return re.compile(BasicCronRule.holiday_re).match(rule.strip()) is not None
+        return BasicCronRule._holiday_pattern.match(rule.strip()) is not None
 
 
     @staticmethod
@@ -99,7 +261,7 @@ class BasicCronRule(object):
             assumes hrule is a holiday
             returns tuple: (dd, mm, yyyy)
         """
-        return tuple([ int(d) for d in re.findall(BasicCronRule.holiday_re, hrule.strip())[0] ])
+        return tuple([ int(d) for d in BasicCronRule._holiday_pattern.search(hrule.strip()).groups() ])
 
 
     @classmethod
@@ -147,20 +309,376 @@ class BasicCronRule(object):
         return self.contains(time_obj)
 
 
+    def minutes_of_day(self):
+        """
+            Returns the set of minutes since midnight (0..1439) that this rule matches on a matching day
+        """
+        return {h * 60 + m for h in self.rulesets["hours"] for m in self.rulesets["minutes"] if h < 24 and m < 60}
+
+
+    def minute_intervals(self):
+        """
+            Returns minutes_of_day() as a sorted list of inclusive (start, stop) runs of consecutive minutes
+        """
+        if "intervals" not in self._derived:
+            intervals = []
+            for m in self.sorted_field("minutes_of_day"):
+                if intervals and intervals[-1][1] == m - 1:
+                    intervals[-1] = (intervals[-1][0], m)
+                else:
+                    intervals.append((m, m))
+            self._derived["intervals"] = intervals
+
+        return self._derived["intervals"]
+
+
+    def interval_containing(self, minute_of_day):
+        """
+            Returns the (start, stop) run from minute_intervals() that contains minute_of_day, or None
+        """
+        intervals = self.minute_intervals()
+        i = bisect_right(intervals, (minute_of_day, 1440)) - 1
+        if i >= 0 and intervals[i][1] >= minute_of_day:
+            return intervals[i]
+        return None
+
+
+    def sorted_field(self, field):
+        """
+            Returns the values of a field ("year", "month", "dom", "dow" or "minutes_of_day") as a sorted list.
+                The years of a YearCycle are listed from start_year to stop_year (the class variables).
+        """
+        if field not in self._derived:
+            if field == "minutes_of_day":
+                values = self.minutes_of_day()
+            elif field == "year" and isinstance(self.rulesets["year"], YearCycle):
+                values = self.rulesets["year"].between(self.start_year, self.stop_year)
+            elif field == "year":
+                values = [y for y in self.rulesets["year"] if 1 <= y <= 9999]
+            else:
+                values = self.rulesets[field]
+            self._derived[field] = sorted(values)
+
+        return self._derived[field]
+
+
+    def unbounded_years(self):
+        """
+            Returns True if the year field is a YearCycle, i.e. the rule matches years without limit
+        """
+        return isinstance(self.rulesets["year"], YearCycle)
+
+
+    def _next_year(self, year):
+        """
+            Returns the first year >= year in the year field, or None
+        """
+        years = self.rulesets["year"]
+        if isinstance(years, YearCycle):
+            year = years.next(year)
+            return year if year <= 9999 else None
+
+        years = self.sorted_field("year")
+        i = bisect_left(years, year)
+        return years[i] if i < len(years) else None
+
+
+    def _previous_year(self, year):
+        """
+            Returns the last year <= year in the year field, or None
+        """
+        years = self.rulesets["year"]
+        if isinstance(years, YearCycle):
+            year = years.previous(year)
+            return year if year >= 1 else None
+
+        years = self.sorted_field("year")
+        i = bisect_right(years, year) - 1
+        return years[i] if i >= 0 else None
+
+
+    def _year_limit(self, year, direction):
+        """
+            Returns the year at which next_match (direction 1) or previous_match (direction -1), having started from
+                year, can give up: a full calendar cycle later for a YearCycle, the end of the datetime range otherwise
+        """
+        years = self.rulesets["year"]
+        if isinstance(years, YearCycle):
+            return year + direction * YearCycle.calendar_cycle * years.step
+        return 9999 if direction > 0 else 1
+
+
+    def selective_checks(self):
+        """
+            Returns the tests contains() makes, as [(getter, values), ...] where a time_obj passes if getter(time_obj)
+                is in values.  The most selective test (the one accepting the smallest share of its field) comes first,
+                so that times outside the rule are usually rejected by the first test.
+        """
+        if "checks" not in self._derived:
+            checks = self._time_checks() + self._calendar_checks() + [
+                (self._year_share(), attrgetter("year"), self.rulesets["year"]),
+                (len(self.rulesets["month"]) / 12.0, attrgetter("month"), self.rulesets["month"]),
+                (len(self.rulesets["dom"]) / 31.0, attrgetter("day"), self.rulesets["dom"]),
+                (len(self.rulesets["dow"]) / 7.0, methodcaller("isoweekday"), self.rulesets["dow"])
+            ]
+            self._derived["checks"] = [(getter, values) for selectivity, getter, values in sorted(checks, key=lambda c: c[0])]
+
+        return self._derived["checks"]
+
+
+    def _year_share(self):
+        """
+            The share of years the year field accepts, for selective_checks()
+        """
+        years = self.rulesets["year"]
+        if isinstance(years, YearCycle):
+            return 1.0 / years.step
+        return len(years) / float(self.stop_year - self.start_year + 1)
+
+
+    def _calendar_checks(self):
+        """
+            The (selectivity, getter, values) tests of selective_checks() that involve more than one date field
+        """
+        return []
+
+
+    def _time_checks(self):
+        """
+            The (selectivity, getter, values) tests of selective_checks() for the time of day
+        """
+        return [
+            (len(self.rulesets["hours"]) / 24.0, attrgetter("hour"), self.rulesets["hours"]),
+            (len(self.rulesets["minutes"]) / 60.0, attrgetter("minute"), self.rulesets["minutes"])
+        ]
+
+
+    def contains_selective(self, time_obj):
+        """
+            Same as contains(), but makes the tests in the order of selective_checks()
+        """
+        for getter, values in self.selective_checks():
+            if getter(time_obj) not in values:
+                return False
+        return True
+
+
+    def may_overlap(self, other):
+        """
+            Returns False if no datetime can be contained in both this rule and other, by intersecting their fields.
+                True means they might overlap (each field has values in common).
+        """
+        return bool(self.rulesets["year"] & other.rulesets["year"]) and bool(self.rulesets["month"] & other.rulesets["month"]) and\
+            bool(self.rulesets["dom"] & other.rulesets["dom"]) and bool(self.rulesets["dow"] & other.rulesets["dow"]) and\
+            not self.minutes_of_day().isdisjoint(other.minutes_of_day())
+
+
+    def first_overlap(self, other):
+        """
+            Returns the first datetime (to the minute) contained in both this rule and other, or None if they don't
+                overlap.  Unlike may_overlap(), this takes the calendar into account, e.g. "* * 30 2 * *" overlaps
+                nothing and "* * 13 * 5 *" only overlaps "* * * 2 * 2015" if some February 13th is a Friday.
+        """
+        #First minute of the day in both, by merging the two sorted lists of intervals
+        mod = None
+        intervals, other_intervals = self.minute_intervals(), other.minute_intervals()
+        i = j = 0
+        while i < len(intervals) and j < len(other_intervals):
+            start = max(intervals[i][0], other_intervals[j][0])
+            if start <= min(intervals[i][1], other_intervals[j][1]):
+                mod = start
+                break
+            if intervals[i][1] < other_intervals[j][1]:
+                i += 1
+            else:
+                j += 1
+        if mod is None:
+            return None
+
+        months = sorted(self.rulesets["month"] & other.rulesets["month"])
+        doms = sorted(self.rulesets["dom"] & other.rulesets["dom"])
+        dows = self.rulesets["dow"] & other.rulesets["dow"]
+        if not months or not doms or not dows:
+            return None
+
+        years = self.rulesets["year"] & other.rulesets["year"]
+        if isinstance(years, YearCycle):
+            #The first overlap from start_year on, one calendar cycle is enough to rule out any overlap
+            years = years.between(self.start_year, self.start_year + YearCycle.calendar_cycle * years.step)
+
+        for y in sorted(years):
+            if not 1 <= y <= 9999:
+                continue
+            for m in months:
+                last_day = monthrange(y, m)[1]
+                for d in doms:
+                    if d > last_day:
+                        break
+                    if date(y, m, d).isoweekday() in dows and self.matches_date(date(y, m, d)) and\
+                            other.matches_date(date(y, m, d)):
+                        return datetime(y, m, d, mod // 60, mod % 60)
+
+        return None
+
+
+    def is_full_day(self):
+        """
+            Returns True if this rule matches every minute of the days it matches, e.g. "* * 25 12 * *"
+        """
+        return self.rulesets["hours"].issuperset(xrange(24)) and self.rulesets["minutes"].issuperset(xrange(60))
+
+
+    def iter_dates(self, years=None):
+        """
+            Yields, in order, every date whose year, month, dom and dow are in the ruleset.
+                years, if given, is the list of years to go through instead of sorted_field("year")
+        """
+        months = self.sorted_field("month")
+        doms = self.sorted_field("dom")
+        dows = self.rulesets["dow"]
+        every_dow = dows.issuperset(xrange(1, 8))
+        for y in (self.sorted_field("year") if years is None else years):
+            if y not in self.rulesets["year"]:
+                continue
+            for m in months:
+                if not 1 <= m <= 12:
+                    continue
+                first_dow, last_day = monthrange(y, m)  # first_dow is 0 for Monday
+                for d in doms:
+                    if d > last_day:
+                        break
+                    if d >= 1 and (every_dow or (first_dow + d - 1) % 7 + 1 in dows):
+                        yield date(y, m, d)
+
+
+    def matches_date(self, date_obj):
+        """
+            Returns True/False if the year, month, dom and dow of date_obj (a date or datetime) are in the ruleset
+        """
+        return date_obj.year in self.rulesets["year"] and date_obj.month in self.rulesets["month"] and\
+            date_obj.day in self.rulesets["dom"] and date_obj.isoweekday() in self.rulesets["dow"]
+
+
+    def next_match(self, after):
+        """
+            Returns the first datetime (to the minute) strictly after `after` that this rule contains,
+                or None if there is none.
+
+            Whole years, months and days are skipped at a time, so sparse rules (e.g. "* * 29 2 * *") are cheap.
+        """
+        months = self.sorted_field("month")
+        doms = self.sorted_field("dom")
+        minutes = self.sorted_field("minutes_of_day")
+        if not minutes:
+            return None
+
+        t = minute_after(after)
+        year, month, day, mod = t.year, t.month, t.day, t.hour * 60 + t.minute
+        limit = self._year_limit(year, 1)
+
+        while True:
+            found = self._next_year(year)
+            if found is None or found > limit:
+                return None
+            if found != year:
+                year, month, day, mod = found, 1, 1, 0
+
+            i = bisect_left(months, month)
+            if i == len(months):
+                year, month, day, mod = year + 1, 1, 1, 0
+                continue
+            if months[i] != month:
+                month, day, mod = months[i], 1, 0
+
+            last = monthrange(year, month)[1]
+            for d in doms[bisect_left(doms, day):bisect_right(doms, last)]:
+                if self.matches_date(date(year, month, d)):
+                    break
+            else:
+                year, month, day, mod = (year, month + 1, 1, 0) if month < 12 else (year + 1, 1, 1, 0)
+                continue
+            if d != day:
+                day, mod = d, 0
+
+            i = bisect_left(minutes, mod)
+            if i == len(minutes):
+                if day < last:
+                    day, mod = day + 1, 0
+                else:
+                    year, month, day, mod = (year, month + 1, 1, 0) if month < 12 else (year + 1, 1, 1, 0)
+                continue
+
+            return datetime(year, month, day, minutes[i] // 60, minutes[i] % 60)
+
+
+    def previous_match(self, before):
+        """
+            Returns the last datetime (to the minute) strictly before `before` that this rule contains,
+                or None if there is none.
+        """
+        months = self.sorted_field("month")
+        doms = self.sorted_field("dom")
+        minutes = self.sorted_field("minutes_of_day")
+        if not minutes:
+            return None
+
+        t = minute_before(before)
+        year, month, day, mod = t.year, t.month, t.day, t.hour * 60 + t.minute
+        limit = self._year_limit(year, -1)
+
+        while True:
+            found = self._previous_year(year)
+            if found is None or found < limit:
+                return None
+            if found != year:
+                year, month, day, mod = found, 12, 31, 1439
+
+            i = bisect_right(months, month) - 1
+            if i < 0:
+                year, month, day, mod = year - 1, 12, 31, 1439
+                continue
+            if months[i] != month:
+                month, day, mod = months[i], 31, 1439
+
+            day = min(day, monthrange(year, month)[1])
+            for d in reversed(doms[bisect_left(doms, 1):bisect_right(doms, day)]):
+                if self.matches_date(date(year, month, d)):
+                    break
+            else:
+                year, month, day, mod = (year, month - 1, 31, 1439) if month > 1 else (year - 1, 12, 31, 1439)
+                continue
+            if d != day:
+                day, mod = d, 1439
+
+            i = bisect_right(minutes, mod) - 1
+            if i < 0:
+                if day > 1:
+                    day, mod = day - 1, 1439
+                else:
+                    year, month, day, mod = (year, month - 1, 31, 1439) if month > 1 else (year - 1, 12, 31, 1439)
+                continue
+
+            return datetime(year, month, day, minutes[i] // 60, minutes[i] % 60)
+
+
 
 class CronRangeRule(BasicCronRule):
 
+    __slots__ = ()
+
     hhmm_re = "(\d{1,2}):(\d{1,2})"
+    _hhmm_pattern = re.compile(hhmm_re)
 
     @classmethod
     def parse_field(cls, f, minimum=0, maximum=0):
         #Try to find HH:MM fields
-        try:
-            hour, minute = map(int, re.findall(CronRangeRule.hhmm_re, f.strip())[0])
-            return Bunch(hour=hour, minute=minute)
-        except:
-            #Otherwise assume nomal cron field
-            return super(CronRangeRule, cls).parse_field(f, minimum, maximum)
+        match = CronRangeRule._hhmm_pattern.search(f.strip())
+        if match is not None:
+            hour, minute = map(int, match.groups())
+            return HourMinute(hour, minute)
+
+        #Otherwise assume nomal cron field
+        return super(CronRangeRule, cls).parse_field(f, minimum, maximum)
 
 
     @classmethod
@@ -180,7 +698,7 @@ class CronRangeRule(BasicCronRule):
                 "dom": cls.parse_field(fields[2], 1, 31),
                 "month": cls.parse_field(fields[3], 1, 12),
                 "dow": cls.parse_field(fields[4], 1, 7),
-                "year": cls.parse_field(fields[5], start_year, stop_year)  #What is a sensible year here?
+                "year": cls.parse_year_field(fields[5], start_year, stop_year)
             }
         except InvalidFieldError as e:
             raise InvalidCronStringError("{}:  ({})".format(cron_string, e.args[0]))
@@ -216,6 +734,34 @@ class CronRangeRule(BasicCronRule):
         return True
 
 
+    def minutes_of_day(self):
+        start = self.rulesets["start"].hour * 60 + self.rulesets["start"].minute
+        stop = self.rulesets["stop"].hour * 60 + self.rulesets["stop"].minute
+        return set(xrange(start, min(stop, 1439) + 1))
+
+
+    def minute_intervals(self):
+        if "intervals" not in self._derived:
+            start = self.rulesets["start"].hour * 60 + self.rulesets["start"].minute
+            stop = min(self.rulesets["stop"].hour * 60 + self.rulesets["stop"].minute, 1439)
+            self._derived["intervals"] = [(start, stop)] if start <= stop else []
+
+        return self._derived["intervals"]
+
+
+    def is_full_day(self):
+        start, stop = self.rulesets["start"], self.rulesets["stop"]
+        return start.hour == start.minute == 0 and stop.hour * 60 + stop.minute >= 1439
+
+
+    def _time_checks(self):
+        #One byte per minute of the day is much smaller than a set of up to 1440 ints
+        matched = bytearray(1440)
+        for mod in self.minutes_of_day():
+            matched[mod] = 1
+        return [(sum(matched) / 1440.0, lambda time_obj: matched[time_obj.hour * 60 + time_obj.minute], _MATCHED)]
+
+
     @staticmethod
     def looks_like_range_rule(cron_string):
         """
@@ -223,5 +769,115 @@ class CronRangeRule(BasicCronRule):
             It doesn't go through the logic of checking each field.  Parsing is equivalent to validating
         """
         fields = cron_string.split(" ")
-        hhmm_re = re.compile(CronRangeRule.hhmm_re)
-        return (hhmm_re.match(fields[0]) is not None) and (hhmm_re.match(fields[1]) is not None)
+        return (CronRangeRule._hhmm_pattern.match(fields[0]) is not None) and (CronRangeRule._hhmm_pattern.match(fields[1]) is not None)
+
+
+class NthWeekdayRule(BasicCronRule):
+    """
+        BasicCronRule whose dow field may also name the n-th or the last given weekday of the month:
+
+            "* * * 11 4#4 *"    fourth Thursday of November
+            "* * * 5 1L *"      last Monday of May
+            "* 9-17 * * 5#3 *"  every third Friday, 9:00 to 17:59
+            "* * * * 1#1,5L *"  first Monday and last Friday of every month (plain weekdays can be listed too)
+
+        rulesets["dow"] holds every weekday the field names, and rulesets["nth"] the (weekday, n) pairs it accepts,
+            n being 1 to 5 or -1 for the last one.  Whether a date is accepted is looked up in a table of the days
+            of a month that match, kept per month shape (weekday of the 1st, length), so there are at most 28.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def parse_dow_field(cls, f):
+        """
+            Returns (weekdays, (weekday, n) pairs) for a dow field, plain weekdays accept every n from 1 to 5
+        """
+        dows = set()
+        nth = set()
+        for part in f.split(","):
+            match = _nth_weekday_pattern.match(part)
+            if match is not None:
+                dow, n, last = match.groups()
+                dows.add(int(dow))
+                nth.add((int(dow), -1 if last else int(n)))
+            else:
+                plain = cls.parse_field(part, 1, 7)
+                dows.update(plain)
+                nth.update((dow, n) for dow in plain for n in xrange(1, 6))
+        return dows, nth
+
+
+    @classmethod
+    def parse(cls, cron_string, start_year=None, stop_year=None):
+        fields = cron_string.split(" ")
+        if len(fields) != 6:
+            raise InvalidCronStringError(cron_string)
+
+        rulesets = super(NthWeekdayRule, cls).parse(" ".join(fields[:4] + ["*"] + fields[5:]), start_year, stop_year)
+        try:
+            rulesets["dow"], rulesets["nth"] = cls.parse_dow_field(fields[4])
+        except InvalidFieldError as e:
+            raise InvalidCronStringError("{}:  ({})".format(cron_string, e.args[0]))
+        return rulesets
+
+
+    @staticmethod
+    def looks_like_nth_rule(cron_string):
+        fields = cron_string.strip().split(" ")
+        return len(fields) == 6 and ("#" in fields[4] or "L" in fields[4])
+
+
+    def days_of_month(self, year, month):
+        """
+            Returns the set of days of the month that the dow field accepts (ignoring the other fields)
+        """
+        shape = month_shape(year, month)
+        tables = self._derived.get("nth_days")
+        if tables is None:
+            tables = self._derived["nth_days"] = {}
+
+        days = tables.get(shape)
+        if days is None:
+            first_dow, last_day = shape
+            nth = self.rulesets["nth"]
+            days = tables[shape] = frozenset(d for d in xrange(1, last_day + 1)
+                if ((first_dow + d - 1) % 7 + 1, (d - 1) // 7 + 1) in nth or
+                    (d + 7 > last_day and ((first_dow + d - 1) % 7 + 1, -1) in nth))
+        return days
+
+
+    def _occurs(self, date_obj):
+        return date_obj.day in self.days_of_month(date_obj.year, date_obj.month)
+
+
+    def contains(self, time_obj):
+        return super(NthWeekdayRule, self).contains(time_obj) and self._occurs(time_obj)
+
+
+    def matches_date(self, date_obj):
+        return super(NthWeekdayRule, self).matches_date(date_obj) and self._occurs(date_obj)
+
+
+    def iter_dates(self, years=None):
+        for day in super(NthWeekdayRule, self).iter_dates(years):
+            if self._occurs(day):
+                yield day
+
+
+    def _calendar_checks(self):
+        return [(len(self.rulesets["nth"]) / 35.0, self._occurs, _MATCHED)]
+
+
+
+def get_rule(cron_string, start_year=None, stop_year=None):
+    """
+        Returns the right kind of rule for cron_string: CronRangeRule for "HH:MM HH:MM ..." strings, NthWeekdayRule
+            for strings with "#n" or "L" weekdays, BasicCronRule otherwise
+    """
+    if NthWeekdayRule.looks_like_nth_rule(cron_string):
+        return NthWeekdayRule(cron_string, start_year=start_year, stop_year=stop_year)
+    elif CronRangeRule.looks_like_range_rule(cron_string):
+        return CronRangeRule(cron_string, start_year=start_year, stop_year=stop_year)
+    else:
+        return BasicCronRule(cron_string, start_year=start_year, stop_year=stop_year)
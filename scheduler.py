@@ -1,8 +1,32 @@
-from collections import defaultdict
+from array import array
+from calendar import monthrange
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, namedtuple, OrderedDict
 from datetime import *
+from heapq import heapify, heappop, heappush
+from itertools import islice
 import re
+from timeit import default_timer
 
+from index import IntervalIndex, RuleIndex
 from rules import *
+from stats import SchedulerStats
+from timezones import OffsetTable
+from utils import OrderedDefaultDict, iter_bits, minute_after, minute_before
+
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+Overlap = namedtuple("Overlap", ["first", "second", "example"])
+
+
+class OverlappingExceptionsError(Exception):
+    """
+        Raised by Scheduler(..., strict=True) if exceptions with different names overlap, see Scheduler.find_overlaps()
+    """
+
+    def __init__(self, overlaps):
+        Exception.__init__(self, "{} overlapping exceptions, e.g. {} and {} at {}".format(len(overlaps), *overlaps[0]))
+        self.overlaps = overlaps
 
 
 class Scheduler(object):
@@ -14,48 +38,323 @@ class Scheduler(object):
         allows "*", "-", "/", "[0-9]", and ","
     """
     fields = ["minute", "hour", "dom", "month", "dow", "year"]
+    adapt_every = 1000  # queries between reorderings of the exceptions, in adaptive mode
+    lazy_bucket_years = 16  # in lazy mode, strings matching more years than this are parsed by the first query
+    expiry_horizon = 31     # days get_matching_rules_with_expiry looks ahead for the next change
 
-    def __init__(self, rules=list(), exceptions=list(), start_year=None, stop_year=None):
+    def __init__(self, rules=list(), exceptions=list(), start_year=None, stop_year=None, compiled=False, cache_size=0,
+                 adaptive=False, strict=False, lazy=False, tz=None):
         """
             rules and exeptions should look like:
             [("name", "* * * * * *"), ...]
 
-            start_year and stop_year are integers that determine the inclusive range of years that will be checked
-                default is the class variables start_year and stop_year for the Rule class
+            start_year and stop_year are integers, default is the class variables start_year and stop_year for the
+                Rule class.  Wildcard years ("*" and "*/n") match any year, "*/n" counting from start_year
+
+            if compiled is True, rules and exceptions are also kept in a per-field bitset index (see index.RuleIndex),
+                which makes get_matching_rules independent of the number of rules
+
+            if cache_size is positive, get_matching_rules keeps a minute-by-minute profile of the last cache_size
+                days it was asked about, so repeated queries for the same day are a single array lookup
+
+            if adaptive is True, every rule tests its most selective field first, and every adapt_every queries the
+                exceptions that matched most often are moved to the front.  Exceptions with different names are only
+                reordered if none of them can overlap, so results are always the same as without adaptive
+
+            if strict is True, OverlappingExceptionsError is raised if exceptions with different names overlap
+
+            if lazy is True, cron strings are only parsed once a query could reach them: strings pinned to a few
+                years are parsed by the first query for one of those years, the others by the first query.
+                Invalid strings then raise InvalidCronStringError from that query rather than from here.
+
+            if tz is a tzinfo (e.g. from pytz or dateutil), get_matching_rules, get_matching_rules_with_expiry and
+                get_matching_rules_batch take UTC timestamps (naive, or aware) and match them in tz's local time,
+                using a timezones.OffsetTable of the changes of offset between start_year and stop_year.  The other
+                methods take and return local times, self.tz_table.utc() converts them back
         """
 
-        self.rules = defaultdict(list)
-        self.exceptions = defaultdict(list)
+        self.rules = OrderedDefaultDict(list)
+        self.exceptions = OrderedDefaultDict(list)
         self.holiday_exceptions = {}  # Optimization to reduce the effect of one day exceptions on the runtime
                                       #  Looks like {(dd,mm,yyyy): name}
+        self._holiday_keys = defaultdict(set)  # name -> keys of holiday_exceptions, so holidays can be removed by name
+        self._holiday_owners = {}   # (dd,mm,yyyy) -> names with a holiday on that date, the last one is in holiday_exceptions
 
         self.start_year = start_year
         self.stop_year = stop_year
 
+        self.tz = tz
+        self.tz_table = None if tz is None else\
+            OffsetTable(tz, start_year or BasicCronRule.start_year, stop_year or BasicCronRule.stop_year)
+
+        self.compiled = compiled
+        self._rule_index = RuleIndex() if compiled else None
+        self._exception_index = RuleIndex() if compiled else None
+        self._batch_matcher = None
+        self._holiday_dates = None
+        self._flat = None
+        self._day_exceptions = None     # see _index_day_exceptions()
+        self._yearly_day_exceptions = None
+        self._full_day_exceptions = None
+        self._shadowed_days = None
+        self._exception_ranks = None
+        self._partial_base = None
+        self._ranges = None             # see _index_ranges()
+        self._exception_ranges = None
+        self._rule_ranges = None
+        self._expiry_memo = None        # (start, expires, names) of the last get_matching_rules_with_expiry
+        self._stats = None
+        self._stats_callback = None
+        self._stats_entry_keys = None   # keys of the entries of self._flat in self._stats.rules
+
+        self.lazy = lazy
+        self._pending = {}              # year (None for any year) -> [[is_exception, name, cron_string, parsed], ...]
+
+        self.adaptive = adaptive
+        self._adaptive = None           # ([[hits, name, checks], ...] for exceptions, [(name, checks), ...] for rules)
+        self._adaptive_queries = 0
+        self._adaptive_free = None      # whether exceptions may be reordered across names
+
+        self.cache_size = cache_size
+        self._day_cache = OrderedDict()     # (yyyy, mm, dd) -> array of 1440 ids into self._day_cache_results
+        self._day_cache_results = []        # interned results, e.g. [[], ["open"], ["closed"]]
+        self._day_cache_ids = {}            # tuple(result) -> id
+        self._day_cache_memo = {}
+        self._day_cache_hits = 0
+        self._day_cache_misses = 0
+
         self.add_rules(rules)
         self.add_exceptions(exceptions)
 
+        if strict:
+            overlaps = self.find_overlaps()
+            if overlaps:
+                raise OverlappingExceptionsError(overlaps)
+
+
+    def __getstate__(self):
+        #The adaptive order holds each rule's checks, which are closures, so it is learned again after unpickling
+        state = self.__dict__.copy()
+        state["_adaptive"] = None
+        return state
+
 
     def add_rules(self, rules):
         for rname, rule in rules:
-            self.rules[rname].append(self.get_rule(rule))
+            if self.lazy:
+                self._defer(False, rname, rule)
+                continue
+            rule = self.get_rule(rule)
+            self.rules[rname].append(rule)
+            if self.compiled:
+                self._rule_index.add(rname, rule)
+        self._changed(exceptions=False)
 
 
     def add_exceptions(self, exceptions):
+        edited = set()
         for ename, exception in exceptions:
             #Holidays can be queried faster than more general rules
             if BasicCronRule.is_holiday(exception):
-                self.holiday_exceptions[BasicCronRule.holiday_tuple(exception)] = ename
+                self._add_holiday(ename, BasicCronRule.holiday_tuple(exception))
+            elif self.lazy:
+                self._defer(True, ename, exception)
             else:
-                self.exceptions[ename].append(self.get_rule(exception))
+                exception = self.get_rule(exception)
+                self.exceptions[ename].append(exception)
+                edited.add(ename)
+                if self.compiled:
+                    self._exception_index.add(ename, exception)
+        self._changed(rules=False, exceptions=edited)
 
 
-    def get_rule(self, cron_string):
-        #Try range rule
-        if CronRangeRule.looks_like_range_rule(cron_string):
-            return CronRangeRule(cron_string, start_year=self.start_year, stop_year=self.stop_year)
+    def _add_holiday(self, ename, key):
+        owners = self._holiday_owners.setdefault(key, [])
+        if ename in owners:
+            owners.remove(ename)
+        owners.append(ename)
+        self.holiday_exceptions[key] = ename
+        self._holiday_keys[ename].add(key)
+
+
+    def _remove_holiday(self, ename, key):
+        """
+            Removes ename's holiday on key, the date then goes back to the previous name with a holiday on it
+        """
+        owners = self._holiday_owners[key]
+        owners.remove(ename)
+        if owners:
+            self.holiday_exceptions[key] = owners[-1]
+        else:
+            del self._holiday_owners[key]
+            del self.holiday_exceptions[key]
+
+
+    def _defer(self, is_exception, name, cron_string):
+        """
+            Keeps cron_string for _parse_pending(), in the bucket of every year it can match
+        """
+        (self.exceptions if is_exception else self.rules)[name]     # fixes name's place in the order
+        if self.compiled:
+            (self._exception_index if is_exception else self._rule_index).reserve(name)
+        entry = [is_exception, name, cron_string, False]
+
+        fields = cron_string.split(" ")
+        try:
+            if fields[5].isdigit():
+                years = (int(fields[5]),)
+            else:
+                years = BasicCronRule.parse_year_field(fields[5], self.start_year or BasicCronRule.start_year,
+                                                       self.stop_year or BasicCronRule.stop_year)
+        except (IndexError, InvalidFieldError):
+            years = ()      # left for the first query to reject
+
+        if isinstance(years, YearCycle) or not years or len(years) > self.lazy_bucket_years:
+            years = [None]
+        for year in years:
+            self._pending.setdefault(year, []).append(entry)
+
+
+    def _parse_pending(self, years=None):
+        """
+            Parses the deferred cron strings (see lazy) that can match any of years, or all of them if years is None
+        """
+        if years is None:
+            buckets = self._pending.keys()
+        else:
+            buckets = [None] + list(years)
+
+        parsed = parsed_rules = False
+        edited = set()
+        for year in buckets:
+            for entry in self._pending.pop(year, ()):
+                is_exception, name, cron_string, done = entry
+                if done:
+                    continue
+                entry[3] = parsed = True
+
+                rule = self.get_rule(cron_string)
+                if is_exception:
+                    self.exceptions[name].append(rule)
+                    edited.add(name)
+                    if self.compiled:
+                        self._exception_index.add(name, rule)
+                else:
+                    self.rules[name].append(rule)
+                    parsed_rules = True
+                    if self.compiled:
+                        self._rule_index.add(name, rule)
+
+        if parsed:
+            self._changed(rules=parsed_rules, exceptions=edited or False)
+
+
+    def _drop_pending(self, is_exception, name):
+        """
+            Forgets the deferred cron strings of the rules (or exceptions) called name
+        """
+        for entries in self._pending.values():
+            for entry in entries:
+                if entry[0] == is_exception and entry[1] == name:
+                    entry[3] = True
+
+
+    def remove_rules(self, name):
+        """
+            Removes every rule called name.  Raises KeyError if there is none
+        """
+        del self.rules[name]
+        self._drop_pending(False, name)
+        if self.compiled:
+            self._rule_index.replace(name, [])
+        self._changed(exceptions=False)
+
+
+    def replace_rules(self, name, cron_strings):
+        """
+            Replaces the rules called name with cron_strings (a list of cron strings), keeping name's place in the
+                order of rules.  Only the rules called name are parsed and (re)indexed.
+        """
+        rules = [self.get_rule(cron_string) for cron_string in cron_strings]
+        self._drop_pending(False, name)
+
+        if not rules:
+            self.rules.pop(name, None)
         else:
-            return BasicCronRule(cron_string, start_year=self.start_year, stop_year=self.stop_year)
+            self.rules[name] = rules
+        if self.compiled:
+            self._rule_index.replace(name, rules)
+        self._changed(exceptions=False)
+
+
+    def remove_exceptions(self, name):
+        """
+            Removes every exception (including holidays) called name.  Raises KeyError if there is none
+        """
+        if name not in self.exceptions and name not in self._holiday_keys:
+            raise KeyError(name)
+        self.replace_exceptions(name, [])
+
+
+    def replace_exceptions(self, name, cron_strings):
+        """
+            Replaces the exceptions (including holidays) called name with cron_strings, keeping name's place
+                in the order of exceptions.  Only the exceptions called name are parsed and (re)indexed.
+        """
+        holidays = [BasicCronRule.holiday_tuple(s) for s in cron_strings if BasicCronRule.is_holiday(s)]
+        exceptions = [self.get_rule(s) for s in cron_strings if not BasicCronRule.is_holiday(s)]
+        self._drop_pending(True, name)
+
+        for key in self._holiday_keys.pop(name, ()):
+            self._remove_holiday(name, key)
+        for key in holidays:
+            self._add_holiday(name, key)
+
+        if not exceptions:
+            self.exceptions.pop(name, None)
+        else:
+            self.exceptions[name] = exceptions
+        if self.compiled:
+            self._exception_index.replace(name, exceptions)
+        self._changed(rules=False, exceptions=[name])
+
+
+    def _changed(self, rules=True, exceptions=True):
+        """
+            Called whenever rules or exceptions change, drops state that was derived from them.
+
+            rules is False if no rules changed.  exceptions is False if only rules changed, or the names of the
+                exceptions that changed, whose dates are then swapped in the table of full-day exceptions
+                (see _update_day_exceptions()) instead of dropping it
+        """
+        self._batch_matcher = None
+        self._flat = None
+        self._ranges = None
+        if rules:
+            self._rule_ranges = None
+        self._stats_entry_keys = None
+        self._adaptive = None
+        self._expiry_memo = None
+
+        if exceptions is not False:
+            self._holiday_dates = None
+            self._adaptive_free = None
+            self._exception_ranges = None
+            if exceptions is True:
+                self._day_exceptions = None
+                self._yearly_day_exceptions = None
+            elif exceptions and self._day_exceptions is not None:
+                self._update_day_exceptions(exceptions)
+
+        #Cached days are recomputed, but the statistics are kept
+        self._day_cache.clear()
+        del self._day_cache_results[:]
+        self._day_cache_ids.clear()
+        self._day_cache_memo.clear()
+
+
+    def get_rule(self, cron_string):
+        return get_rule(cron_string, start_year=self.start_year, stop_year=self.stop_year)
 
 
     def get_matching_rules(self, time_obj):
@@ -64,13 +363,31 @@ class Scheduler(object):
 
             time_obj is a datetime object.
 
-            if self.in_utc is defined, then the time_obj will be converted to UTC
+            if self.tz is defined, then time_obj is in UTC and will be converted to local time
 
             If rules overlap, the time_obj will belong to multiple rules.
             Therefore return is a list:
                 e.g.
                 [], ["2001"], ["weekday_afternoons", "every_thursday"],
         """
+        if self.tz_table is not None:
+            time_obj = self.tz_table.local(time_obj)
+        return self._get_local_matching_rules(time_obj)
+
+
+    def _get_local_matching_rules(self, time_obj):
+        """
+            get_matching_rules for time_obj in local time
+        """
+
+        if self._pending and (None in self._pending or time_obj.year in self._pending):
+            self._parse_pending((time_obj.year,))
+
+        if self._stats is not None:
+            return self._get_instrumented_matching_rules(time_obj)
+
+        if self.cache_size > 0:
+            return self._get_cached_matching_rules(time_obj)
 
         rule_list = []
 
@@ -80,16 +397,895 @@ class Scheduler(object):
         if holiday_exc_name is not None:
             return [holiday_exc_name]
 
-        #Check exceptions
-        for ename, exceptions in self.exceptions.items():
-            for exception in exceptions:
-                if time_obj in exception:
-                    return [ename]
+        if self.compiled:
+            return self._get_compiled_matching_rules(time_obj)
+
+        if self.adaptive:
+            return self._get_adaptive_matching_rules(time_obj)
+
+        days, partial = self._day_exceptions or self._index_day_exceptions()
+        if self._yearly_day_exceptions is not None and time_obj.year not in self._yearly_day_exceptions:
+            self._index_yearly_day_exceptions(time_obj.year)
+        exceptions, exception_positions, exception_ranges, rules, rule_positions, rule_ranges, flat_rules =\
+            self._ranges or self._index_ranges()
+
+        #Check exceptions, only those before the first full-day exception for this date need to be checked
+        day_exception = days.get((time_obj.day, time_obj.month, time_obj.year))
+        limit = len(partial) if day_exception is None else day_exception[0]
+
+        range_exception = None
+        if exception_ranges is not None:
+            first = exception_ranges.first(time_obj)
+            if first is not None and first < limit:
+                range_exception = limit = first
+
+        for ename, exception in islice(exceptions, bisect_left(exception_positions, limit)):
+            if time_obj in exception:
+                return [ename]
+
+        if range_exception is not None:
+            return [partial[range_exception][0]]
+        if day_exception is not None:
+            return [day_exception[1]]
 
         #No exceptions match, so all rules are available
-        for rname, rules in self.rules.items():
-            for rule in rules:
+        if rule_ranges is None:
+            for rname, rule in rules:
                 if time_obj in rule:
                     rule_list.append(rname)
+            return rule_list
+
+        matched = rule_ranges.match(time_obj)
+        if rules:
+            matched.extend(rule_positions[i] for i, (rname, rule) in enumerate(rules) if time_obj in rule)
+            matched.sort()
+
+        return [flat_rules[position][0] for position in matched]
+
+
+    def _index_day_exceptions(self):
+        """
+            Exceptions that match whole days within the year bounds (e.g. "* * 24-31 12 * 2015" or "* * * * 7 *")
+                are expanded into a date -> (n, name) table, where n is the number of other exceptions checked before
+                the first full-day exception for that date.  Returns (that table, [(name, exception), ...] of the
+                other exceptions), so get_matching_rules only scans exceptions that can't be looked up by date.
+
+            The full-day exceptions that lose a date to an earlier one are kept too, so that editing the exceptions
+                of a name only swaps that name's dates (see _update_day_exceptions())
+        """
+        self._day_exceptions = {}, []
+        self._full_day_exceptions = []      # (n, name, exception) of every full-day exception, in order
+        self._shadowed_days = {}            # date -> [(n, name), ...] of the full-day exceptions it loses, in order
+        self._yearly_day_exceptions = None  # years expanded so far, if any full-day exception has unbounded years
+        self._exception_ranks = {}          # name -> place in self.exceptions
+        self._partial_base = {}             # name -> number of other exceptions before name's
+        self._update_day_exceptions(self.exceptions.keys())
+        return self._day_exceptions
+
+
+    def _update_day_exceptions(self, names):
+        """
+            Replaces the dates of the exceptions called names (e.g. after replace_exceptions) in the table of
+                _index_day_exceptions(), so an edit costs the dates it touches and a pass renumbering the table,
+                rather than expanding every full-day exception again
+        """
+        names = set(names)
+        days, partial = self._day_exceptions
+        years = self._yearly_day_exceptions
+
+        #Drop the old dates, the next full-day exception in order takes over the dates they won
+        shadowed = self._shadowed_days
+        for n, ename, exception in self._full_day_exceptions:
+            if ename not in names:
+                continue
+            for day in self._full_dates(exception, years):
+                key = (day.day, day.month, day.year)
+                losers = [entry for entry in shadowed.pop(key, ()) if entry[1] not in names]
+                if days.get(key, (0, None))[1] in names:
+                    if losers:
+                        days[key] = losers.pop(0)
+                    else:
+                        del days[key]
+                if losers:
+                    shadowed[key] = losers
+
+        ranks = self._exception_ranks
+        if any((name in ranks) != (name in self.exceptions) for name in names):
+            ranks = self._exception_ranks = dict((ename, i) for i, ename in enumerate(self.exceptions))
+
+        start_year = self.start_year or BasicCronRule.start_year
+        stop_year = self.stop_year or BasicCronRule.stop_year
+        full_days = [entry for entry in self._full_day_exceptions if entry[1] not in names]
+        partial = [entry for entry in partial if entry[0] not in names]
+        added = []  # (n, name, exception), n only counting name's own other exceptions for now
+        for ename in names:
+            n = 0
+            for exception in self.exceptions.get(ename, ()):
+                bounded = not exception.unbounded_years() and exception.sorted_field("year")
+                if exception.is_full_day() and not (bounded and (bounded[0] < start_year or bounded[-1] > stop_year)):
+                    added.append((n, ename, exception))
+                else:
+                    partial.append((ename, exception))
+                    n += 1
+        partial.sort(key=lambda entry: ranks[entry[0]])
+
+        old_base, base = self._partial_base, {}
+        counts = defaultdict(int)
+        for ename, exception in partial:
+            counts[ename] += 1
+        n = 0
+        for ename in self.exceptions:
+            base[ename] = n
+            n += counts[ename]
+        self._partial_base = base
+
+        #Renumber the other entries if the number of exceptions before them changed
+        if any(base[ename] != old for ename, old in old_base.iteritems() if ename not in names and ename in base):
+            renumber = lambda entry: (entry[0] + base[entry[1]] - old_base[entry[1]],) + entry[1:]
+            for key, entry in days.iteritems():
+                days[key] = renumber(entry)
+            for key, losers in shadowed.iteritems():
+                shadowed[key] = map(renumber, losers)
+            full_days = map(renumber, full_days)
+
+        added = sorted(((base[ename] + n, ename, exception) for n, ename, exception in added),
+                       key=lambda entry: (entry[0], ranks[entry[1]]))
+        full_days.extend(added)
+        full_days.sort(key=lambda entry: (entry[0], ranks[entry[1]]))
+        self._full_day_exceptions = full_days
+        self._day_exceptions = days, partial
+
+        #Unbounded years (e.g. "* * 25 12 * *") are expanded one year at a time, as queries reach them
+        if years is None and any(exception.unbounded_years() for n, ename, exception in added):
+            self._yearly_day_exceptions = years = set()
+        for n, ename, exception in added:
+            self._cover_days((n, ename), self._full_dates(exception, years))
+
+
+    @staticmethod
+    def _full_dates(exception, years):
+        """
+            Returns the dates in the table of _index_day_exceptions() that come from the full-day exception,
+                i.e. only those in the years expanded so far, if its years are unbounded
+        """
+        if not exception.unbounded_years():
+            return exception.iter_dates()
+        return exception.iter_dates(sorted(years)) if years else ()
+
+
+    def _cover_days(self, entry, dates):
+        """
+            Adds entry, (n, name) of a full-day exception, to the table of _index_day_exceptions() for dates,
+                wherever it comes before the exception that has the date so far
+        """
+        days, shadowed, ranks = self._day_exceptions[0], self._shadowed_days, self._exception_ranks
+        order = lambda other: (other[0], ranks[other[1]])
+        entry_order = order(entry)
+        for day in dates:
+            key = (day.day, day.month, day.year)
+            current = days.setdefault(key, entry)
+            if current is entry:
+                continue
+            if entry_order < order(current):
+                days[key], loser = entry, current
+            else:
+                loser = entry
+            losers = shadowed.get(key)
+            if losers is None:
+                shadowed[key] = [loser]
+            else:
+                losers.append(loser)
+                if order(loser) < order(losers[-2]):
+                    losers.sort(key=order)
+
+
+    def _index_yearly_day_exceptions(self, year):
+        """
+            Adds the dates of year to the table of _index_day_exceptions() for the full-day exceptions with
+                unbounded years
+        """
+        self._yearly_day_exceptions.add(year)
+        for n, ename, exception in self._full_day_exceptions:
+            if exception.unbounded_years():
+                self._cover_days((n, ename), exception.iter_dates([year]))
+
+
+    def _index_ranges(self):
+        """
+            Splits the exceptions left by _index_day_exceptions() and the rules into CronRangeRules, which go into
+                an index.IntervalIndex, and the others, which are checked one by one.  Returns
+                (exceptions, their positions, IntervalIndex or None, rules, their positions, IntervalIndex or None,
+                [(name, rule), ...] of every rule), positions being indexes into the lists the entries came from.
+
+            The exception and rule halves are kept apart, so an edit only rebuilds the half of the side it changed.
+        """
+        def split(entries):
+            ranges = [(position, rule) for position, (name, rule) in enumerate(entries) if isinstance(rule, CronRangeRule)]
+            others = [(position, name, rule) for position, (name, rule) in enumerate(entries) if not isinstance(rule, CronRangeRule)]
+            return [(name, rule) for position, name, rule in others], [position for position, name, rule in others],\
+                IntervalIndex(ranges) if ranges else None
+
+        if self._exception_ranges is None:
+            self._exception_ranges = split((self._day_exceptions or self._index_day_exceptions())[1])
+        if self._rule_ranges is None:
+            flat_rules = (self._flat or self._flatten())[1]
+            self._rule_ranges = split(flat_rules) + (flat_rules,)
+        self._ranges = self._exception_ranges + self._rule_ranges
+        return self._ranges
+
+
+    def _get_adaptive_matching_rules(self, time_obj):
+        """
+            The exception and rule checks of get_matching_rules, with each rule's tests in order of selectivity
+                and the exceptions in order of how often they matched
+        """
+        if self._adaptive is None:
+            exceptions, rules = self._flat or self._flatten()
+            self._adaptive = (
+                [[0, ename, exception.selective_checks()] for ename, exception in exceptions],
+                [(rname, rule.selective_checks()) for rname, rule in rules]
+            )
+        exceptions, rules = self._adaptive
+
+        self._adaptive_queries += 1
+        if self._adaptive_queries >= self.adapt_every:
+            self._reorder_exceptions()
+
+        #Check exceptions
+        for entry in exceptions:
+            for getter, values in entry[2]:
+                if getter(time_obj) not in values:
+                    break
+            else:
+                entry[0] += 1
+                return [entry[1]]
+
+        #No exceptions match, so all rules are available
+        rule_list = []
+        for rname, checks in rules:
+            for getter, values in checks:
+                if getter(time_obj) not in values:
+                    break
+            else:
+                rule_list.append(rname)
 
         return rule_list
+
+
+    def _reorder_exceptions(self):
+        """
+            Moves the exceptions that matched most often to the front.  If any two exceptions with different names
+                may overlap, their relative order decides the result, so then only exceptions with the same name
+                are reordered (within their group).  Ties keep their current order, so the result is deterministic.
+        """
+        self._adaptive_queries = 0
+        exceptions = self._adaptive[0]
+
+        if self._adaptive_free is None:
+            #Same pruning as find_overlaps(): only exceptions that share a value in every field may overlap
+            exception_index = RuleIndex()
+            flat = [(ename, exception_index.add(ename, exception), exception)
+                for ename, exception in (self._flat or self._flatten())[0]]
+            name_masks = defaultdict(int)
+            for ename, slot, exception in flat:
+                name_masks[ename] |= 1 << slot
+            self._adaptive_free = not any(exception_index.overlapping(exception) & ~name_masks[ename]
+                for ename, slot, exception in flat)
+
+        if self._adaptive_free:
+            exceptions.sort(key=lambda entry: -entry[0])
+        else:
+            groups = OrderedDict()
+            for entry in exceptions:
+                groups.setdefault(entry[1], []).append(entry)
+            exceptions[:] = [entry for group in groups.values() for entry in sorted(group, key=lambda entry: -entry[0])]
+
+
+    def enable_stats(self, callback=None):
+        """
+            Starts collecting a fresh stats.SchedulerStats in get_matching_rules: per-rule evaluations, matches and time,
+                the holiday hit rate and how many exceptions are checked before one matches.
+
+            While stats are enabled, get_matching_rules always checks every holiday, exception and rule itself
+                (bypassing the compiled index and the per-day cache), so that the counters describe the rules.
+                When disabled, the only overhead is one attribute check per call.
+
+            callback, if given, is called after every query as callback(time_obj, result, exceptions_checked, seconds)
+        """
+        self._stats = SchedulerStats()
+        self._stats_callback = callback
+
+
+    def disable_stats(self):
+        self._stats = None
+        self._stats_callback = None
+
+
+    def stats(self):
+        """
+            Returns the stats.SchedulerStats collected since enable_stats(), or None if stats are disabled
+        """
+        return self._stats
+
+
+    def _get_instrumented_matching_rules(self, time_obj):
+        """
+            get_matching_rules, counting and timing every check into self._stats
+        """
+        stats = self._stats
+        started = default_timer()
+        stats.queries += 1
+
+        exceptions, rules = self._flat or self._flatten()
+        if self._stats_entry_keys is None:
+            self._stats_entry_keys = (self._stats_keys("exception", exceptions), self._stats_keys("rule", rules))
+        exception_keys, rule_keys = self._stats_entry_keys
+
+        depth = 0
+        result = None
+
+        #Check holiday exceptions:
+        stats.holiday_lookups += 1
+        holiday_exc_name = self.holiday_exceptions.get((time_obj.day, time_obj.month, time_obj.year), None)
+        if holiday_exc_name is not None:
+            stats.holiday_hits += 1
+            stats.exception_depths[0] += 1
+            result = [holiday_exc_name]
+
+        #Check exceptions
+        if result is None:
+            for key, (ename, exception) in zip(exception_keys, exceptions):
+                depth += 1
+                if self._timed_contains(stats.rules[key], exception, time_obj):
+                    stats.exception_depths[depth] += 1
+                    result = [ename]
+                    break
+
+        #No exceptions match, so all rules are available
+        if result is None:
+            result = [rname for key, (rname, rule) in zip(rule_keys, rules)
+                if self._timed_contains(stats.rules[key], rule, time_obj)]
+
+        seconds = default_timer() - started
+        stats.seconds += seconds
+        if self._stats_callback is not None:
+            self._stats_callback(time_obj, result, depth, seconds)
+
+        return result
+
+
+    @staticmethod
+    def _stats_keys(kind, entries):
+        counts = defaultdict(int)
+        keys = []
+        for name, rule in entries:
+            keys.append((kind, name, counts[name]))
+            counts[name] += 1
+        return keys
+
+
+    @staticmethod
+    def _timed_contains(rule_stats, rule, time_obj):
+        started = default_timer()
+        matched = time_obj in rule
+        rule_stats.seconds += default_timer() - started
+        rule_stats.evaluations += 1
+        rule_stats.matches += matched
+        return matched
+
+
+    def _flatten(self):
+        """
+            Lists every (name, exception) and (name, rule) in order, so that get_matching_rules doesn't have to walk
+                the ordered dictionaries on every call
+        """
+        self._flat = (
+            [(ename, exception) for ename, exceptions in self.exceptions.items() for exception in exceptions],
+            [(rname, rule) for rname, rules in self.rules.items() for rule in rules]
+        )
+        return self._flat
+
+
+    def find_overlaps(self):
+        """
+            Returns a list of Overlap(first, second, example) for every pair of exceptions with different names
+                that match a common datetime.  first is the exception get_matching_rules returns (it is checked
+                first), second is the one it shadows, and example is the first datetime at which both match.
+                Exceptions are identified as (name, n), n being the position among the exceptions called name,
+                and holidays as (name, (dd, mm, yyyy)).
+
+            Candidate pairs come from ANDing, for every field, the union of the bitmasks (see index.RuleIndex) of
+                the values an exception accepts, so only exceptions that share a value in every field are compared.
+        """
+        self._parse_pending()
+        exception_index = RuleIndex()
+        positions = {}
+        for ename, exceptions in self.exceptions.items():
+            for n, exception in enumerate(exceptions):
+                positions[exception_index.add(ename, exception)] = (ename, n)
+
+        name_masks = defaultdict(int)
+        for name, slots in exception_index.slots.items():
+            name_masks[name] = sum(1 << slot for slot in slots)
+
+        overlaps = []
+        entries = exception_index.entries
+        for slot in sorted(entries):
+            rank, seq, ename, exception = entries[slot]
+            candidates = exception_index.overlapping(exception) & ~((2 << slot) - 1) & ~name_masks[ename]
+
+            for other in iter_bits(candidates):
+                example = exception.first_overlap(entries[other][3])
+                if example is not None:
+                    first, second = sorted([entries[slot][:2] + (slot,), entries[other][:2] + (other,)])
+                    overlaps.append(Overlap(positions[first[2]], positions[second[2]], example))
+
+        #Holidays come first, and can only shadow exceptions with another name
+        for key, hname in sorted(self.holiday_exceptions.items()):
+            d, m, y = key
+            try:
+                day = date(y, m, d)
+            except ValueError:
+                continue
+            mask = exception_index.year_mask(y) & exception_index.months[m] & exception_index.dom[d] &\
+                exception_index.dow[day.isoweekday()] & ~name_masks[hname]
+            for other in iter_bits(mask):
+                minutes = entries[other][3].sorted_field("minutes_of_day")
+                if not minutes or not entries[other][3].matches_date(day):
+                    continue
+                mod = minutes[0]
+                overlaps.append(Overlap((hname, key), positions[other], datetime(y, m, d, mod // 60, mod % 60)))
+
+        return sorted(overlaps, key=lambda overlap: overlap.example)
+
+
+    def get_matching_rules_batch(self, times):
+        """
+            Vectorized get_matching_rules for many timestamps at once.  Requires numpy.
+
+            times is an array (or list) of datetime64 / datetime objects, or of integer minutes since the epoch.
+
+            returns (names, matches), where matches is a boolean matrix with a row per timestamp and a column
+                per name, and matches[i, j] is True if names[j] is in get_matching_rules(times[i])
+                e.g. matches[:, names.index("open")].nonzero()[0] are the indexes of the timestamps that are open
+
+            If self.tz is defined, times are in UTC, and are shifted to local time with self.tz_table
+        """
+        self._parse_pending()
+        if self._batch_matcher is None:
+            from batch import BatchMatcher
+            self._batch_matcher = BatchMatcher(self)
+
+        return self._batch_matcher.names, self._batch_matcher.match(times)
+
+
+    def next_match(self, after, name=None):
+        """
+            Returns the first datetime (to the minute) strictly after `after` for which get_matching_rules is not
+                empty, or contains name if it is given.  Returns None if there is no such datetime.
+
+            e.g. scheduler.next_match(datetime.now(), "open") -> when the business opens next
+        """
+        return self._search(after, name, forward=True)
+
+
+    def previous_match(self, before, name=None):
+        """
+            Returns the last datetime (to the minute) strictly before `before` for which get_matching_rules is not
+                empty, or contains name if it is given.  Returns None if there is no such datetime.
+        """
+        return self._search(before, name, forward=False)
+
+
+    def _search(self, time_obj, name, forward):
+        """
+            Keeps a heap with the next (or previous) match of every rule and exception that could produce name,
+                and checks the earliest candidate against get_matching_rules.  Candidates that are shadowed by
+                an exception skip to the end of the exception's run of minutes, rather than going minute by minute.
+
+            Wildcard years repeat every YearCycle.calendar_cycle years (times their step), so the search gives up
+                once it is that far from time_obj: a name that is shadowed for a whole cycle is shadowed forever.
+        """
+        self._parse_pending()
+        flat_exceptions, flat_rules = self._flat or self._flatten()
+        ranked = [(rank, exception) for rank, (ename, exception) in enumerate(flat_exceptions) if name is None or ename == name]
+        ranked += [(len(flat_exceptions), rule) for rname, rule in flat_rules if name is None or rname == name]
+        candidates = [rule for rank, rule in ranked]
+        ranks = [rank for rank, rule in ranked] + [-1]
+        finders = [rule.next_match if forward else rule.previous_match for rule in candidates]
+        finders.append(lambda t: self._find_holiday(t, name, forward))
+
+        key = (lambda t: t) if forward else (lambda t: datetime.max - t)
+        steps = [rule.rulesets["year"].step for rule in candidates if rule.unbounded_years()]
+        if not steps:
+            limit = key(datetime.max if forward else datetime.min)
+        elif forward:
+            limit = key(datetime(min(time_obj.year + YearCycle.calendar_cycle * max(steps), 9999), 1, 1))
+        else:
+            limit = key(datetime(max(time_obj.year - YearCycle.calendar_cycle * max(steps), 1), 12, 31, 23, 59))
+
+        heap = []
+        for i, find in enumerate(finders):
+            found = find(time_obj)
+            if found is not None:
+                heap.append((key(found), i, found))
+        heapify(heap)
+
+        while heap and heap[0][0] <= limit:
+            found = heap[0][2]
+            result = self._get_local_matching_rules(found)
+            if result and (name is None or name in result):
+                return found
+
+            #Only candidates ranked after the shadowing exception are shadowed for the whole run, the others can
+            #   still match inside it
+            skipped, rank = self._skip_shadowed(found, forward)
+            popped = []
+            while heap and heap[0][0] <= key(skipped):
+                popped.append(heappop(heap))
+            for entry in popped:
+                i = entry[1]
+                since = found if ranks[i] < rank else skipped
+                if key(entry[2]) > key(since):
+                    heappush(heap, entry)
+                    continue
+                next_found = finders[i](since)
+                if next_found is not None:
+                    heappush(heap, (key(next_found), i, next_found))
+
+        return None
+
+
+    def _find_holiday(self, time_obj, name, forward):
+        """
+            next_match / previous_match for the holiday exceptions (called name, if it is given)
+        """
+        if self._holiday_dates is None:
+            holidays = []
+            for (d, m, y), hname in self.holiday_exceptions.items():
+                try:
+                    holidays.append((date(y, m, d), hname))
+                except ValueError:
+                    pass
+            holidays.sort()
+            self._holiday_dates = ([day for day, hname in holidays], [hname for day, hname in holidays])
+
+        days, names = self._holiday_dates
+
+        if forward:
+            t = minute_after(time_obj)
+            for i in xrange(bisect_left(days, t.date()), len(days)):
+                if name is None or names[i] == name:
+                    return t if days[i] == t.date() else datetime.combine(days[i], time(0, 0))
+        else:
+            t = minute_before(time_obj)
+            for i in xrange(bisect_right(days, t.date()) - 1, -1, -1):
+                if name is None or names[i] == name:
+                    return t if days[i] == t.date() else datetime.combine(days[i], time(23, 59))
+
+        return None
+
+
+    def _skip_shadowed(self, time_obj, forward):
+        """
+            If time_obj is covered by a holiday or exception, returns the last (or first, if not forward) minute of
+                the run of minutes it covers on that day, and its rank: -1 for a holiday, otherwise its position
+                among the exceptions.  Otherwise returns time_obj and the number of exceptions, i.e. the rank of
+                the rules.
+        """
+        flat_exceptions = (self._flat or self._flatten())[0]
+        if (time_obj.day, time_obj.month, time_obj.year) in self.holiday_exceptions:
+            return (time_obj.replace(hour=23, minute=59) if forward else time_obj.replace(hour=0, minute=0)), -1
+
+        for rank, (ename, exception) in enumerate(flat_exceptions):
+            if time_obj in exception:
+                start, stop = exception.interval_containing(time_obj.hour * 60 + time_obj.minute)
+                edge = stop if forward else start
+                return time_obj.replace(hour=edge // 60, minute=edge % 60), rank
+
+        return time_obj, len(flat_exceptions)
+
+
+    def get_timeline(self, start, end):
+        """
+            Returns the contiguous intervals from start to end (datetimes, to the minute) over which the result of
+                get_matching_rules does not change, as a list of (interval_start, interval_end, names).
+
+            interval_end is exclusive, i.e. it is the next interval's interval_start.  Intervals that match nothing
+                are included with names == [].
+
+            Intervals are computed from each day's field boundaries and HH:MM edges, not by sampling every minute.
+                e.g. [(datetime(2014, 12, 19, 0, 0), datetime(2014, 12, 19, 7, 0), ["closed"]),
+                      (datetime(2014, 12, 19, 7, 0), datetime(2014, 12, 19, 19, 31), ["open"]), ...]
+        """
+        start = start.replace(second=0, microsecond=0)
+        end = end.replace(second=0, microsecond=0)
+        if self._pending:
+            self._parse_pending(xrange(start.year, end.year + 1))
+
+        timeline = []
+        memo = {}
+        day = start.date()
+        while datetime.combine(day, time(0, 0)) < end:
+            midnight = datetime.combine(day, time(0, 0))
+            for seg_start, seg_stop, names in self._day_segments(day, memo):
+                seg_start = max(midnight + timedelta(minutes=seg_start), start)
+                seg_stop = min(midnight + timedelta(minutes=seg_stop), end)
+                if seg_start >= seg_stop:
+                    continue
+
+                if timeline and timeline[-1][1] == seg_start and timeline[-1][2] == names:
+                    timeline[-1] = (timeline[-1][0], seg_stop, names)
+                else:
+                    timeline.append((seg_start, seg_stop, list(names)))
+
+            day += timedelta(days=1)
+
+        return timeline
+
+
+    def count_matching(self, start, end, name=None):
+        """
+            Returns the number of minutes from start (inclusive) to end (exclusive), datetimes to the minute, at which
+                get_matching_rules contains name.  If name is None, returns {name: minutes} for every name instead.
+
+            Whole months are counted from their day classes: the rules whose year and month fields accept the month,
+                its first weekday and its length determine every day's segments, so months that agree on those are
+                only counted once.  Holidays are then swapped in date by date, and only the (partial) days and months
+                at the ends of the span are counted one day at a time.
+                e.g. scheduler.count_matching(datetime(2014, 7, 1), datetime(2014, 10, 1), "open") -> open minutes in Q3
+        """
+        start = start.replace(second=0, microsecond=0)
+        end = end.replace(second=0, microsecond=0)
+        if self._pending:
+            self._parse_pending(xrange(start.year, end.year + 1))
+
+        totals = defaultdict(int)
+        memo = {}
+        if start < end:
+            first, last = start.date(), end.date()
+            start_minute = start.hour * 60 + start.minute
+            end_minute = end.hour * 60 + end.minute
+
+            if first == last:
+                self._count_day(totals, first, memo, start_minute, end_minute)
+            else:
+                self._count_day(totals, first, memo, start_minute, 1440)
+                self._count_days(totals, first + timedelta(days=1), last, memo)
+                self._count_day(totals, last, memo, 0, end_minute)
+
+        if name is not None:
+            return totals.get(name, 0)
+        return dict(totals)
+
+
+    def _count_day(self, totals, day, memo, start=0, stop=1440, sign=1, holidays=True, entries=None):
+        """
+            Adds sign * the minutes from start to stop (minutes since midnight) of day to totals, per name
+        """
+        for seg_start, seg_stop, names in self._day_segments(day, memo, holidays, entries):
+            minutes = min(seg_stop, stop) - max(seg_start, start)
+            if minutes > 0:
+                for name in set(names):
+                    totals[name] += sign * minutes
+
+
+    def _count_days(self, totals, first, stop, memo):
+        """
+            Adds the minutes of every day from first (inclusive) to stop (exclusive), both dates, to totals
+        """
+        holidays = defaultdict(list)    # (yyyy, mm) -> [(date, name), ...]
+        for (d, m, y), hname in self.holiday_exceptions.items():
+            try:
+                holiday = date(y, m, d)
+            except ValueError:
+                continue
+            if first <= holiday < stop:
+                holidays[y, m].append((holiday, hname))
+
+        months = {}     # (exception ids, rule ids, first weekday, days) -> {name: minutes}
+
+        day = first
+        while day < stop:
+            first_dow, last_day = monthrange(day.year, day.month)
+            month_end = date(day.year, day.month, last_day) + timedelta(days=1)
+            if day.day != 1 or month_end > stop:
+                self._count_day(totals, day, memo)
+                day += timedelta(days=1)
+                continue
+
+            exceptions, rules = self._flat or self._flatten()
+            entries = (
+                [(ename, e) for ename, e in exceptions if day.year in e.rulesets["year"] and day.month in e.rulesets["month"]],
+                [(rname, r) for rname, r in rules if day.year in r.rulesets["year"] and day.month in r.rulesets["month"]]
+            )
+            key = tuple(id(e) for ename, e in entries[0]), tuple(id(r) for rname, r in entries[1]), first_dow, last_day
+            month = months.get(key)
+            if month is None:
+                month = months[key] = defaultdict(int)
+                for d in xrange(1, last_day + 1):
+                    self._count_day(month, day.replace(day=d), memo, holidays=False, entries=entries)
+            for name, minutes in month.items():
+                totals[name] += minutes
+
+            for holiday, hname in holidays.get((day.year, day.month), ()):
+                self._count_day(totals, holiday, memo, sign=-1, holidays=False, entries=entries)
+                totals[hname] += 1440
+
+            day = month_end
+
+
+    def get_matching_rules_with_expiry(self, time_obj):
+        """
+            Returns (get_matching_rules(time_obj), expires), where expires is the first datetime (to the minute) after
+                time_obj at which the result may change, so callers can reuse the result until then.
+
+            expires comes from the day's segments (see get_timeline), following runs that last into the next days
+                for at most expiry_horizon days, so it may be a midnight at which nothing actually changes.
+                The last result is kept, and calls for times from its start until it expires return it directly.
+
+            e.g. scheduler.get_matching_rules_with_expiry(datetime(2014, 12, 19, 12, 0))
+                -> (["open"], datetime(2014, 12, 19, 19, 31))
+
+            If self.tz is defined, time_obj is in UTC and expires is a naive datetime in UTC, at the latest when
+                the offset changes next.
+        """
+        if self.tz_table is not None:
+            start, stop, delta = self.tz_table.interval(time_obj)
+            names, expires = self._get_local_matching_rules_with_expiry(self.tz_table.local(time_obj))
+            expires -= delta
+            return names, (expires if stop is None or expires < stop else stop)
+        return self._get_local_matching_rules_with_expiry(time_obj)
+
+
+    def _get_local_matching_rules_with_expiry(self, time_obj):
+        """
+            get_matching_rules_with_expiry for time_obj in local time
+        """
+        memo = self._expiry_memo
+        if memo is not None and memo[0] <= time_obj < memo[1]:
+            return list(memo[2]), memo[1]
+
+        day = time_obj.date()
+        midnight = datetime.combine(day, time(0, 0))
+        horizon = midnight + timedelta(days=self.expiry_horizon)
+        if self._pending:
+            self._parse_pending(xrange(day.year, horizon.year + 1))
+
+        minute_of_day = time_obj.hour * 60 + time_obj.minute
+        segments = {}
+        for start, stop, names in self._day_segments(day, segments):
+            if start <= minute_of_day < stop:
+                break
+
+        begins = midnight + timedelta(minutes=start)
+        expires = midnight + timedelta(minutes=stop)
+        while stop == 1440 and expires < horizon:
+            day += timedelta(days=1)
+            start, stop, next_names = self._day_segments(day, segments)[0]
+            if next_names != names:
+                break
+            expires = datetime.combine(day, time(0, 0)) + timedelta(minutes=stop)
+
+        self._expiry_memo = (begins, expires, names)
+        return list(names), expires
+
+
+    def _day_segments(self, day, memo=None, holidays=True, entries=None):
+        """
+            Splits day (a date) into [(start, stop, names), ...], where start and stop are minutes since midnight
+                (stop exclusive) and names is what get_matching_rules returns for every minute in between.
+
+            Days with the same holiday / active exceptions / active rules share their segments through memo.
+                If holidays is False, holiday exceptions are ignored.  entries is an optional (exceptions, rules)
+                subset of self._flat to check, if the others are known not to match day.
+        """
+        if holidays:
+            hname = self.holiday_exceptions.get((day.day, day.month, day.year), None)
+            if hname is not None:
+                return [(0, 1440, [hname])]
+
+        exceptions, rules = entries or self._flat or self._flatten()
+        exceptions = [(ename, exception) for ename, exception in exceptions if exception.matches_date(day)]
+        rules = [(rname, rule) for rname, rule in rules if rule.matches_date(day)]
+
+        key = tuple(id(rule) for name, rule in exceptions), tuple(id(rule) for name, rule in rules)
+        if memo is not None and key in memo:
+            return memo[key]
+
+        bounds = {0, 1440}
+        for name, rule in exceptions + rules:
+            for start, stop in rule.minute_intervals():
+                bounds.update((start, stop + 1))
+        bounds = sorted(bounds)
+
+        segments = []
+        for start, stop in zip(bounds, bounds[1:]):
+            for ename, exception in exceptions:
+                if exception.interval_containing(start) is not None:
+                    names = [ename]
+                    break
+            else:
+                names = [rname for rname, rule in rules if rule.interval_containing(start) is not None]
+
+            if segments and segments[-1][2] == names:
+                segments[-1] = (segments[-1][0], stop, names)
+            else:
+                segments.append((start, stop, names))
+
+        if memo is not None:
+            memo[key] = segments
+        return segments
+
+
+    def cache_info(self):
+        """
+            Returns statistics for the per-day cache (see cache_size) as CacheInfo(hits, misses, maxsize, currsize)
+        """
+        return CacheInfo(self._day_cache_hits, self._day_cache_misses, self.cache_size, len(self._day_cache))
+
+
+    def cache_clear(self):
+        """
+            Empties the per-day cache and resets its statistics
+        """
+        self._changed()
+        self._day_cache_hits = 0
+        self._day_cache_misses = 0
+
+
+    def _get_cached_matching_rules(self, time_obj):
+        """
+            get_matching_rules through the per-day cache, least recently used days are evicted first
+        """
+        key = (time_obj.year, time_obj.month, time_obj.day)
+        profile = self._day_cache.pop(key, None)
+
+        if profile is None:
+            self._day_cache_misses += 1
+            profile = array("H", [0] * 1440)
+            for start, stop, names in self._day_segments(date(*key), self._day_cache_memo):
+                result_id = self._day_cache_ids.get(tuple(names))
+                if result_id is None:
+                    result_id = self._day_cache_ids[tuple(names)] = len(self._day_cache_results)
+                    self._day_cache_results.append(names)
+                profile[start:stop] = array("H", [result_id]) * (stop - start)
+
+            if len(self._day_cache) >= self.cache_size:
+                self._day_cache.popitem(last=False)
+        else:
+            self._day_cache_hits += 1
+
+        self._day_cache[key] = profile
+        return list(self._day_cache_results[profile[time_obj.hour * 60 + time_obj.minute]])
+
+
+    def dump(self, path):
+        """
+            Writes the compiled rules, exceptions and holidays to path in a flat binary format (see storage.py).
+                Rule names must be JSON serializable
+        """
+        import storage
+        self._parse_pending()
+        storage.dump(self, path)
+
+
+    @staticmethod
+    def load(path, mmap=True):
+        """
+            Loads a file written by dump() as a read-only storage.MappedScheduler, which answers get_matching_rules
+                straight from the file.  If mmap is True the file is memory mapped, so processes share its pages.
+        """
+        import storage
+        return storage.load(path, mmap)
+
+
+    def _get_compiled_matching_rules(self, time_obj):
+        """
+            Same as the exception and rule checks in get_matching_rules, but answered from the bitset indexes
+        """
+        ename = self._exception_index.first(self._exception_index.match(time_obj))
+        if ename is not None:
+            return [ename]
+
+        return self._rule_index.names(self._rule_index.match(time_obj))
@@ -0,0 +1,62 @@
+from collections import defaultdict
+
+
+class RuleStats(object):
+    """
+        How often one rule or exception was evaluated and matched, and the time spent evaluating it
+    """
+
+    def __init__(self):
+        self.evaluations = 0
+        self.matches = 0
+        self.seconds = 0.0
+
+
+    def as_dict(self):
+        return {"evaluations": self.evaluations, "matches": self.matches, "seconds": self.seconds}
+
+
+class SchedulerStats(object):
+    """
+        Counters collected by Scheduler.get_matching_rules while instrumentation is enabled,
+            see Scheduler.enable_stats()
+
+        rules is keyed by ("exception" or "rule", name, n), where n is the position of the rule among those
+            called name, e.g. ("exception", "closed", 0) is the first exception called "closed".
+
+        exception_depths counts, for the queries that were answered by an exception, how many exceptions were
+            checked before (and including) the one that matched.  Holidays have depth 0.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.holiday_lookups = 0
+        self.holiday_hits = 0
+        self.exception_depths = defaultdict(int)
+        self.rules = defaultdict(RuleStats)
+
+
+    @property
+    def holiday_hit_rate(self):
+        return float(self.holiday_hits) / self.holiday_lookups if self.holiday_lookups else 0.0
+
+
+    def slowest(self, n=10):
+        """
+            Returns the n [(key, RuleStats), ...] with the most time spent in them
+        """
+        return sorted(self.rules.items(), key=lambda item: item[1].seconds, reverse=True)[:n]
+
+
+    def as_dict(self):
+        return {
+            "queries": self.queries,
+            "seconds": self.seconds,
+            "holiday_lookups": self.holiday_lookups,
+            "holiday_hits": self.holiday_hits,
+            "holiday_hit_rate": self.holiday_hit_rate,
+            "exception_depths": dict(self.exception_depths),
+            "rules": [dict(kind=kind, name=name, n=n, **rule_stats.as_dict())
+                for (kind, name, n), rule_stats in sorted(self.rules.items())]
+        }
@@ -0,0 +1,229 @@
+"""
+    Compact binary format for compiled Schedulers.
+
+    Layout (all integers little-endian):
+
+        header      HEADER: magic, version, and the counts / offsets of the sections below
+        names       JSON list of every rule name, records refer to names by index
+        holidays    n_holidays x HOLIDAY: (yyyymmdd, name index), sorted by date
+        records     n_exceptions + n_rules x RECORD, exceptions first, each in Scheduler order.
+                        RECORD holds bitmasks for month, dom and dow, the location of the rule's year bitmap,
+                        followed by a 1440 bit (180 byte) bitmap of the minutes of the day the rule matches.
+                        Unbounded year fields (rules.YearCycle) have no bitmap, but a year step and the
+                        offset in place of the first year.  "#n" / "L" weekdays are a bitmask with bit
+                        (weekday - 1) * 6 + n - 1 for the n-th weekday of the month and n = 6 for the last
+        years       year bitmaps referenced by the records
+
+    MappedScheduler answers queries directly from the (optionally memory mapped) buffer,
+        so loading does not parse any cron strings or build any sets.
+"""
+from bisect import bisect_left
+from calendar import monthrange
+import json
+from mmap import mmap as MemoryMap, ACCESS_READ
+import struct
+
+
+MAGIC = b"PYCR"
+VERSION = 3
+
+HEADER = struct.Struct("<4sHHIIIIIII")  # magic, version, reserved, names offset, names size, n_holidays, holidays offset,
+                                        #   n_exceptions, n_rules, records offset
+HOLIDAY = struct.Struct("<II")          # yyyymmdd, name index
+RECORD = struct.Struct("<IIIIHHBB2xQ")  # name index, months, dom, years offset, first year (or year offset), n years,
+                                        #   dow, year step (0 for a year bitmap), nth weekdays (0 for none)
+MINUTES_SIZE = 1440 // 8
+RECORD_SIZE = RECORD.size + MINUTES_SIZE
+
+
+class InvalidFileError(Exception):
+    pass
+
+
+def _mask(values, size):
+    return sum(1 << v for v in set(values) if 0 <= v < size)
+
+
+def _nth_mask(nth):
+    if nth is None:
+        return 0
+    return sum(1 << ((dow - 1) * 6 + (5 if n == -1 else n - 1)) for dow, n in nth)
+
+
+def _bitmap(values, size):
+    bits = bytearray(size // 8 + (1 if size % 8 else 0))
+    for v in values:
+        if 0 <= v < size:
+            bits[v >> 3] |= 1 << (v & 7)
+    return bytes(bits)
+
+
+def dump(scheduler, path):
+    """
+        Writes scheduler's holidays, exceptions and rules to path.  Rule names must be JSON serializable.
+            The file has no timezone, so a scheduler with a tz can't be dumped: the loaded one would match UTC
+            timestamps as local time
+    """
+    if getattr(scheduler, "tz", None) is not None:
+        raise ValueError("a Scheduler with a tz can't be dumped, the file format stores no timezone")
+
+    names = []
+    name_index = {}
+    def index(name):
+        if name not in name_index:
+            name_index[name] = len(names)
+            names.append(name)
+        return name_index[name]
+
+    holidays = sorted((y * 10000 + m * 100 + d, index(name)) for (d, m, y), name in scheduler.holiday_exceptions.items())
+    entries = [(ename, exception) for ename, exceptions in scheduler.exceptions.items() for exception in exceptions]
+    n_exceptions = len(entries)
+    entries += [(rname, rule) for rname, rules in scheduler.rules.items() for rule in rules]
+
+    for name, rule in entries:
+        index(name)
+
+    names_data = json.dumps(names).encode("utf-8")
+    names_offset = HEADER.size
+    holidays_offset = names_offset + len(names_data)
+    records_offset = holidays_offset + HOLIDAY.size * len(holidays)
+    years_offset = records_offset + RECORD_SIZE * len(entries)
+
+    records = []
+    years_data = []
+    for name, rule in entries:
+        if rule.unbounded_years():
+            cycle = rule.rulesets["year"]
+            if cycle.step > 255:
+                raise ValueError("year steps above 255 can't be stored: {!r}".format(cycle))
+            years, first_year, n_years, year_step = [], cycle.offset, 0, cycle.step
+        else:
+            years = rule.sorted_field("year")
+            first_year = years[0] if years else 0
+            n_years = years[-1] - first_year + 1 if years else 0
+            year_step = 0
+        records.append(RECORD.pack(index(name), _mask(rule.rulesets["month"], 13), _mask(rule.rulesets["dom"], 32),
+            years_offset, first_year, n_years, _mask(rule.rulesets["dow"], 8), year_step, _nth_mask(rule.rulesets.get("nth"))))
+        records.append(_bitmap(rule.minutes_of_day(), 1440))
+
+        year_bitmap = _bitmap([y - first_year for y in years], n_years)
+        years_data.append(year_bitmap)
+        years_offset += len(year_bitmap)
+
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, names_offset, len(names_data), len(holidays), holidays_offset,
+            n_exceptions, len(entries) - n_exceptions, records_offset))
+        f.write(names_data)
+        for holiday in holidays:
+            f.write(HOLIDAY.pack(*holiday))
+        f.write(b"".join(records))
+        f.write(b"".join(years_data))
+
+
+def load(path, mmap=True):
+    """
+        Returns a MappedScheduler for a file written by dump().  If mmap is True, the file is mapped read-only,
+            so that processes loading the same file share its pages.  Otherwise it is read into memory.
+    """
+    with open(path, "rb") as f:
+        if mmap:
+            buf = MemoryMap(f.fileno(), 0, access=ACCESS_READ)
+        else:
+            buf = f.read()
+
+    return MappedScheduler(buf)
+
+
+class MappedScheduler(object):
+    """
+        Read-only Scheduler backed by a buffer in the format written by dump()
+    """
+
+    def __init__(self, buf):
+        if len(buf) < HEADER.size:
+            raise InvalidFileError("file is too short")
+
+        magic, version, _, names_offset, names_size, self.n_holidays, self.holidays_offset,\
+            self.n_exceptions, self.n_rules, self.records_offset = HEADER.unpack_from(buf, 0)
+
+        if magic != MAGIC:
+            raise InvalidFileError("not a pycronius file")
+        if version != VERSION:
+            raise InvalidFileError("unsupported version {}".format(version))
+
+        self.buf = buf
+        self.names = json.loads(buf[names_offset:names_offset + names_size].decode("utf-8"))
+        self.holiday_keys = _HolidayKeys(buf, self.holidays_offset, self.n_holidays)
+
+
+    def close(self):
+        if isinstance(self.buf, MemoryMap):
+            self.buf.close()
+
+
+    def _contains(self, record, time_obj):
+        """
+            Returns True/False if time_obj is contained in the rule stored in record (its index)
+        """
+        buf = self.buf
+        offset = self.records_offset + record * RECORD_SIZE
+        name, months, dom, years_offset, first_year, n_years, dow, year_step, nth = RECORD.unpack_from(buf, offset)
+
+        if not (months >> time_obj.month) & 1 or not (dom >> time_obj.day) & 1 or not (dow >> time_obj.isoweekday()) & 1:
+            return False
+
+        if nth:
+            base = (time_obj.isoweekday() - 1) * 6
+            if not (nth >> (base + (time_obj.day - 1) // 7)) & 1 and\
+                    not (time_obj.day + 7 > monthrange(time_obj.year, time_obj.month)[1] and (nth >> (base + 5)) & 1):
+                return False
+
+        if year_step:
+            if time_obj.year % year_step != first_year:
+                return False
+        else:
+            y = time_obj.year - first_year
+            if not 0 <= y < n_years or not (ord(buf[years_offset + (y >> 3)]) >> (y & 7)) & 1:
+                return False
+
+        mod = time_obj.hour * 60 + time_obj.minute
+        return bool((ord(buf[offset + RECORD.size + (mod >> 3)]) >> (mod & 7)) & 1)
+
+
+    def _name(self, record):
+        return self.names[struct.unpack_from("<I", self.buf, self.records_offset + record * RECORD_SIZE)[0]]
+
+
+    def get_matching_rules(self, time_obj):
+        """
+            Same as Scheduler.get_matching_rules
+        """
+        #Check holiday exceptions:
+        key = time_obj.year * 10000 + time_obj.month * 100 + time_obj.day
+        i = bisect_left(self.holiday_keys, key)
+        if i < self.n_holidays and self.holiday_keys[i] == key:
+            return [self.names[HOLIDAY.unpack_from(self.buf, self.holidays_offset + i * HOLIDAY.size)[1]]]
+
+        #Check exceptions
+        for record in xrange(self.n_exceptions):
+            if self._contains(record, time_obj):
+                return [self._name(record)]
+
+        #No exceptions match, so all rules are available
+        return [self._name(record) for record in xrange(self.n_exceptions, self.n_exceptions + self.n_rules)
+            if self._contains(record, time_obj)]
+
+
+class _HolidayKeys(object):
+    """
+        Sequence view of the dates in the holiday table, so that it can be searched with bisect
+    """
+
+    def __init__(self, buf, offset, n):
+        self.buf, self.offset, self.n = buf, offset, n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        return HOLIDAY.unpack_from(self.buf, self.offset + i * HOLIDAY.size)[0]
@@ -1,11 +1,53 @@
-from datetime import datetime
+from datetime import date, datetime, timedelta, tzinfo
+import json
+import os
+import pickle
+import tempfile
 import unittest
 
-from scheduler import Scheduler
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from annotate import annotate_stream
+from dispatch import Dispatcher
+from index import IntervalIndex, RuleIndex
+from registry import SchedulerRegistry
+import storage
+from scheduler import OverlappingExceptionsError, Scheduler
+from timezones import OffsetTable
 from rules import *
 
 
-#TODO: test tz-aware datetime strings
+class Eastern(tzinfo):
+    """
+        US Eastern time with the DST rules in use since 2007, for the timezone tests without pytz
+    """
+
+
+    def utcoffset(self, dt):
+        return timedelta(hours=-5) + self.dst(dt)
+
+
+    def dst(self, dt):
+        start = datetime(dt.year, 3, 8, 2) + timedelta(days=6 - date(dt.year, 3, 8).weekday())     # second Sunday of March
+        end = datetime(dt.year, 11, 1, 1) + timedelta(days=6 - date(dt.year, 11, 1).weekday())    # first Sunday of November
+        return timedelta(hours=1) if start <= dt.replace(tzinfo=None) < end else timedelta(0)
+
+
+    def tzname(self, dt):
+        return "EDT" if self.dst(dt) else "EST"
+
+
+class UTC(tzinfo):
+
+    def utcoffset(self, dt):
+        return timedelta(0)
+
+
+    def dst(self, dt):
+        return timedelta(0)
 
 
 class TestBasicCronRule(unittest.TestCase):
@@ -38,12 +80,47 @@ class TestBasicCronRule(unittest.TestCase):
         self.assertTrue( all([d in rule.rulesets["dow"] for d in xrange(1, 6)]) )
         self.assertTrue( all([y in rule.rulesets["year"] for y in xrange(1999, 2021, 2)]) )
         self.assertFalse( all([y in rule.rulesets["year"] for y in xrange(1999, 2021)]) )
-        self.assertFalse( all([y in rule.rulesets["year"] for y in xrange(1999, 2024, 2)]) )
+        # Wildcard years are not bounded by start_year and stop_year
+        self.assertTrue( all([y in rule.rulesets["year"] for y in xrange(1801, 2401, 2)]) )
+        self.assertEqual(rule.rulesets["year"], YearCycle(2, 1))
+        self.assertTrue( all([y in BasicCronRule("* * * * * *").rulesets["year"] for y in (1, 1999, 2026, 9999)]) )
 
         with self.assertRaises(InvalidCronStringError):
             BasicCronRule.parse("1-* * * * * *")
 
 
+    def test_parse_cached(self):
+        rule = BasicCronRule("* 7-19 * * 1-5 *")
+
+        self.assertIs(BasicCronRule("* 7-19 * * 1-5 *").rulesets, rule.rulesets)
+        self.assertIsNot(BasicCronRule("* 7-19 * * 1-5 *", stop_year=2030).rulesets, rule.rulesets)
+        self.assertIsInstance(rule.rulesets["hours"], frozenset)
+        self.assertEqual(rule.rulesets, BasicCronRule.parse("* 7-19 * * 1-5 *"))
+
+        # Range rules with the same string are cached separately
+        self.assertIn("start", CronRangeRule("7:30 19:00 * * * *").rulesets)
+
+        # Equal fields of different strings are the same object, and rules have no __dict__
+        other = BasicCronRule("0-59 7-19 1-31 * * *")
+        self.assertIs(other.rulesets["minutes"], rule.rulesets["minutes"])
+        self.assertIs(other.rulesets["year"], rule.rulesets["year"])
+        self.assertIs(CronRangeRule("7:30 19:00 * * 1-5 *").rulesets["dow"], rule.rulesets["dow"])
+        self.assertFalse(hasattr(rule, "__dict__") or hasattr(CronRangeRule("7:30 19:00 * * * *"), "__dict__"))
+
+
+    def test_pickle(self):
+        for rule in [BasicCronRule("* 7-19 * * 1-5 */2"), CronRangeRule("7:30 19:00 * * * 2014-2016"), NthWeekdayRule("* 9-17 * 11 4#4 *")]:
+            rule.selective_checks()
+            rule.minute_intervals()
+            for protocol in (0, 2):
+                copy = pickle.loads(pickle.dumps(rule, protocol))
+                self.assertIs(type(copy), type(rule))
+                self.assertEqual(copy.rulesets, rule.rulesets)
+                self.assertIs(copy.rulesets["dow"], rule.rulesets["dow"])
+                for time_obj in [datetime(2014, 11, 17) + timedelta(minutes=m) for m in xrange(0, 14 * 24 * 60, 53)]:
+                    self.assertEqual(time_obj in copy, time_obj in rule)
+
+
     def test_is_holiday(self):
         rule = BasicCronRule("* 7-19 * * 1-5 * ")
 
@@ -78,6 +155,45 @@ class TestBasicCronRule(unittest.TestCase):
         self.assertTrue(rule.contains(datetime(2014, 12, 25, 12, 0)))
 
 
+    def test_next_match(self):
+        rule = BasicCronRule("* * 29 2 * *")
+        self.assertEqual(rule.next_match(datetime(2014, 12, 19, 12, 0)), datetime(2016, 2, 29, 0, 0))
+        self.assertEqual(rule.next_match(datetime(2016, 2, 29, 0, 0)), datetime(2016, 2, 29, 0, 1))
+        self.assertEqual(rule.next_match(datetime(2024, 2, 29, 23, 59)), datetime(2028, 2, 29, 0, 0))
+        self.assertEqual(BasicCronRule("* * 29 2 * 2016-2024").next_match(datetime(2024, 2, 29, 23, 59)), None)
+        self.assertEqual(BasicCronRule("* * 30 2 * *").next_match(datetime(2014, 12, 19, 12, 0)), None)
+
+        rule = BasicCronRule("*/15 9-17 * * 1-5 *")
+        self.assertEqual(rule.next_match(datetime(2014, 12, 19, 17, 45)), datetime(2014, 12, 22, 9, 0))
+        self.assertEqual(rule.next_match(datetime(2014, 12, 19, 12, 0, 30)), datetime(2014, 12, 19, 12, 15))
+        self.assertEqual(rule.next_match(datetime(2014, 12, 31, 23, 0)), datetime(2015, 1, 1, 9, 0))
+
+        # Agrees with a minute by minute scan
+        rule = BasicCronRule("*/20 */5 1-3,30 * 6 *")
+        time_obj = datetime(2014, 12, 1)
+        while time_obj < datetime(2015, 3, 1):
+            found = rule.next_match(time_obj)
+            scan = time_obj + timedelta(minutes=1)
+            while scan not in rule:
+                scan += timedelta(minutes=1)
+            self.assertEqual(found, scan)
+            time_obj = found
+
+
+    def test_previous_match(self):
+        rule = BasicCronRule("* * 29 2 * *")
+        self.assertEqual(rule.previous_match(datetime(2016, 3, 1, 0, 0)), datetime(2016, 2, 29, 23, 59))
+        self.assertEqual(rule.previous_match(datetime(2016, 2, 29, 12, 0, 30)), datetime(2016, 2, 29, 12, 0))
+        self.assertEqual(rule.previous_match(datetime(2016, 2, 29, 12, 0)), datetime(2016, 2, 29, 11, 59))
+        self.assertEqual(rule.previous_match(datetime(2000, 2, 29, 0, 0)), datetime(1996, 2, 29, 23, 59))
+        self.assertEqual(BasicCronRule("* * 29 2 * 2000-2016").previous_match(datetime(2000, 2, 29, 0, 0)), None)
+        self.assertEqual(BasicCronRule("* * 30 2 * *").previous_match(datetime(2014, 12, 19, 12, 0)), None)
+
+        rule = BasicCronRule("*/15 9-17 * * 1-5 *")
+        self.assertEqual(rule.previous_match(datetime(2014, 12, 22, 9, 0)), datetime(2014, 12, 19, 17, 45))
+        self.assertEqual(rule.previous_match(datetime(2015, 3, 2, 0, 0)), datetime(2015, 2, 27, 17, 45))
+
+
 class TestCronRangeRule(unittest.TestCase):
 
     def test_parse_field(self):
@@ -136,6 +252,14 @@ class TestCronRangeRule(unittest.TestCase):
         self.assertFalse(rule.contains(datetime(2014, 12, 17, 7, 0)))
 
 
+    def test_next_match(self):
+        rule = CronRangeRule("7:30 19:15 * * 1-5 *")
+        self.assertEqual(rule.next_match(datetime(2014, 12, 19, 19, 15)), datetime(2014, 12, 22, 7, 30))
+        self.assertEqual(rule.next_match(datetime(2014, 12, 19, 12, 0)), datetime(2014, 12, 19, 12, 1))
+        self.assertEqual(rule.previous_match(datetime(2014, 12, 22, 7, 30)), datetime(2014, 12, 19, 19, 15))
+        self.assertEqual(rule.minute_intervals(), [(450, 1155)])
+
+
     def test_looks_like_range_rule(self):
         self.assertTrue(CronRangeRule.looks_like_range_rule("7:30 19:00 * * * *"))
         self.assertFalse(CronRangeRule.looks_like_range_rule("* * * * * *"))
@@ -151,6 +275,120 @@ class TestCronRangeRule(unittest.TestCase):
         self.assertFalse(CronRangeRule.is_valid("7:30 * * * * *"))
 
 
+class TestNthWeekdayRule(unittest.TestCase):
+
+    def test_parse(self):
+        rule = get_rule("* 9-17 * * 1#1,5L,3 *")
+        self.assertIsInstance(rule, NthWeekdayRule)
+        self.assertEqual(rule.rulesets["dow"], {1, 3, 5})
+        self.assertEqual(rule.rulesets["nth"], {(1, 1), (5, -1)} | {(3, n) for n in xrange(1, 6)})
+        self.assertIsInstance(get_rule("* 9-17 * * 1-5 *"), BasicCronRule)
+        self.assertNotIsInstance(get_rule("* 9-17 * * 1-5 *"), NthWeekdayRule)
+
+        for cron_string in ("* * * * 8#1 *", "* * * * 1#6 *", "* * * * #1 *", "* * * 4L *"):
+            self.assertFalse(NthWeekdayRule.is_valid(cron_string), cron_string)
+
+
+    def test_contains(self):
+        thanksgiving = NthWeekdayRule("* * * 11 4#4 *")
+        self.assertEqual(list(thanksgiving.iter_dates(range(2014, 2017))), [date(2014, 11, 27), date(2015, 11, 26), date(2016, 11, 24)])
+        self.assertEqual(NthWeekdayRule("* * * 5 1L *").next_match(datetime(2016, 1, 1)), datetime(2016, 5, 30, 0, 0))
+
+        rule = NthWeekdayRule("* 9-17 * * 5#3,1L *")
+        day = date(2014, 1, 1)
+        while day < date(2016, 1, 1):
+            expected = day.isoweekday() == 5 and 15 <= day.day <= 21 or\
+                day.isoweekday() == 1 and (day + timedelta(days=7)).month != day.month
+            for hour in (8, 12):
+                time_obj = datetime(day.year, day.month, day.day, hour, 0)
+                self.assertEqual(time_obj in rule, expected and hour == 12)
+                self.assertEqual(rule.contains_selective(time_obj), expected and hour == 12)
+            day += timedelta(days=1)
+
+
+class TestRuleIndex(unittest.TestCase):
+
+    def test_match(self):
+        index = RuleIndex()
+        index.add("open", CronRangeRule("7:30 19:00 * * 1-5 *"))
+        index.add("closed", BasicCronRule("* 0-6 * * * *"))
+        index.add("open", BasicCronRule("* * * * 6-7 *"))
+
+        self.assertEqual(index.names(index.match(datetime(2014, 12, 19, 7, 30))), ["open"])
+        self.assertEqual(index.names(index.match(datetime(2014, 12, 19, 7, 29))), [])
+        self.assertEqual(index.names(index.match(datetime(2014, 12, 20, 6, 0))), ["open", "closed"])
+        self.assertEqual(index.first(index.match(datetime(2014, 12, 20, 6, 0))), "open")
+        self.assertEqual(index.first(0), None)
+
+
+    def test_remove(self):
+        index = RuleIndex()
+        slot = index.add("a", BasicCronRule("* * * * * *"))
+        index.add("b", BasicCronRule("* * * * * *"))
+        index.remove(slot)
+
+        self.assertEqual(index.names(index.match(datetime(2014, 12, 19, 7, 30))), ["b"])
+
+        # A name that was removed completely goes to the back of the order when it is added again
+        self.assertEqual(index.add("a", BasicCronRule("* * * * * *")), slot)
+        self.assertEqual(index.names(index.match(datetime(2014, 12, 19, 7, 30))), ["b", "a"])
+        self.assertEqual(len(index), 2)
+
+
+class TestIntervalIndex(unittest.TestCase):
+
+    def test_match(self):
+        rules = [CronRangeRule("7:30 19:00 * * 1-5 *"), CronRangeRule("0:00 7:29 * * * *"), CronRangeRule("12:00 13:00 * * 1-5 *"),
+            CronRangeRule("19:01 23:59 * * * *"), CronRangeRule("10:00 22:00 * * 6-7 *")]
+        index = IntervalIndex(list(enumerate(rules)))
+
+        self.assertEqual(index.match(datetime(2014, 12, 19, 12, 30)), [0, 2])
+        self.assertEqual(index.match(datetime(2014, 12, 19, 7, 0)), [1])
+        self.assertEqual(index.match(datetime(2014, 12, 20, 20, 0)), [3, 4])
+        self.assertEqual(index.match(datetime(2014, 12, 20, 9, 0)), [])
+        self.assertEqual(index.first(datetime(2014, 12, 20, 20, 0)), 3)
+        self.assertEqual(index.first(datetime(2014, 12, 20, 9, 0)), None)
+
+
+    def test_overlapping(self):
+        rules = [CronRangeRule("%d:00 23:59 * * * *" % h) for h in xrange(24)]
+        index = IntervalIndex(list(enumerate(rules)))
+        self.assertIsNotNone(index.groups[0][6])
+
+        for h in xrange(24):
+            self.assertEqual(index.match(datetime(2014, 12, 19, h, 30)), range(h + 1))
+            self.assertEqual(index.first(datetime(2014, 12, 19, h, 30)), 0)
+
+
+class TestOffsetTable(unittest.TestCase):
+
+    def test_transitions(self):
+        table = OffsetTable(Eastern(), 2014, 2015)
+        self.assertEqual(table.starts[1:], [datetime(2014, 3, 9, 7, 0), datetime(2014, 11, 2, 6, 0),
+                                            datetime(2015, 3, 8, 7, 0), datetime(2015, 11, 1, 6, 0)])
+        self.assertEqual(table.deltas, [timedelta(hours=h) for h in (-5, -4, -5, -4, -5)])
+
+        tz = Eastern()
+        for utc in [datetime(2013, 6, 1, 12, 0) + timedelta(minutes=m) for m in xrange(0, 4 * 366 * 1440, 97)]:
+            self.assertEqual(table.local(utc), tz.fromutc(utc.replace(tzinfo=tz)).replace(tzinfo=None))
+        self.assertEqual(table.local(datetime(2014, 7, 1, 14, 0, tzinfo=UTC())), datetime(2014, 7, 1, 10, 0))
+
+
+    def test_utc(self):
+        table = OffsetTable(Eastern(), 2014, 2015)
+        self.assertEqual(table.utc(datetime(2014, 7, 1, 10, 0)), datetime(2014, 7, 1, 14, 0))
+        # Skipped: 2:30 becomes the change to 3:00
+        self.assertEqual(table.utc(datetime(2014, 3, 9, 2, 30)), datetime(2014, 3, 9, 7, 0))
+        # Repeated: the first 1:30
+        self.assertEqual(table.utc(datetime(2014, 11, 2, 1, 30)), datetime(2014, 11, 2, 5, 30))
+        self.assertEqual(table.local(datetime(2014, 11, 2, 6, 30)), datetime(2014, 11, 2, 1, 30))
+
+        for utc in [datetime(2014, 1, 1) + timedelta(minutes=m) for m in xrange(0, 2 * 365 * 1440, 41)]:
+            self.assertLessEqual(table.utc(table.local(utc)), utc)
+        with self.assertRaises(ValueError):
+            table.utc(datetime(2020, 1, 1))
+
+
 class TestScheduler(unittest.TestCase):
 
     def test_holiday_rules(self):
@@ -220,8 +458,640 @@ class TestScheduler(unittest.TestCase):
 
         self.assertEqual(cp.get_matching_rules(datetime(1991, 12, 19, 18, 31))[0], "odd_year")
         self.assertEqual(cp.get_matching_rules(datetime(1992, 12, 19, 18, 31))[0], "even_year")
-        self.assertEqual(cp.get_matching_rules(datetime(2000, 12, 19, 18, 31)), [])
+        # Wildcard years go on past stop_year, "*/2" counting from start_year
+        self.assertEqual(cp.get_matching_rules(datetime(2000, 12, 19, 18, 31)), ["even_year"])
+        self.assertEqual(cp.get_matching_rules(datetime(2101, 12, 19, 18, 31)), ["odd_year"])
+
+
+    def test_compiled(self):
+        rules = [("open", "7:00 19:30 * * * *"), ("closed", "* 6 * * * *"), ("closed", "19:31 23:59 * * * *"), ("lunch", "* 12 * * 1-5 *")]
+        exceptions = [("closed", "0:00 8:30 * * 6-7 *"), ("closed", "18:30 23:59 * * 6-7 *"), ("closed", "* * 24,25 12 * *"), ("closed", "* * 5 4 * 2015")]
+
+        cp = Scheduler(rules, exceptions)
+        compiled = Scheduler(rules, exceptions, compiled=True)
+
+        for d in xrange(17, 28):
+            for h in xrange(0, 24):
+                for m in (0, 29, 30, 31, 59):
+                    time_obj = datetime(2014, 12, d, h, m)
+                    self.assertEqual(compiled.get_matching_rules(time_obj), cp.get_matching_rules(time_obj))
+
+        self.assertEqual(compiled.get_matching_rules(datetime(2015, 4, 5, 12, 0)), ["closed"])
+        self.assertEqual(compiled.get_matching_rules(datetime(2030, 4, 6, 12, 0)), ["open"])
+        self.assertEqual(compiled.get_matching_rules(datetime(2030, 12, 25, 12, 0)), ["closed"])
+
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_get_matching_rules_batch(self):
+        rules = [("open", "7:00 19:30 * * * *"), ("closed", "* 6 * * * *"), ("closed", "19:31 23:59 * * * *"), ("lunch", "* 12 * * 1-5 *")]
+        exceptions = [("closed", "0:00 8:30 * * 6-7 *"), ("holiday", "* * 24,25 12 * *"), ("holiday", "* * 5 4 * 2015")]
+        cp = Scheduler(rules, exceptions)
+
+        times = [datetime(2014, 12, 17) + timedelta(minutes=m) for m in xrange(0, 14 * 24 * 60, 29)]
+        times += [datetime(2015, 4, 5, 12, 0), datetime(2030, 4, 5, 12, 0), datetime(1969, 12, 31, 23, 59)]
+
+        names, matches = cp.get_matching_rules_batch(numpy.array(times, dtype="datetime64[m]"))
+        for time_obj, row in zip(times, matches):
+            self.assertEqual(sorted(n for n, hit in zip(names, row) if hit), sorted(set(cp.get_matching_rules(time_obj))))
+
+        # Epoch minutes
+        names, matches = cp.get_matching_rules_batch([(datetime(2014, 12, 19, 12, 0) - datetime(1970, 1, 1)).total_seconds() // 60])
+        self.assertEqual([n for n, hit in zip(names, matches[0]) if hit], ["open", "lunch"])
+
+
+    def test_tz(self):
+        rules = [("open", "7:00 19:30 * * 1-5 *"), ("night", "2:00 2:59 * * * *")]
+        exceptions = [("holiday", "* * 25 12 * *"), ("holiday", "* * 4 7 * 2014")]
+        plain = Scheduler(rules, exceptions)
+        eastern = Scheduler(rules, exceptions, tz=Eastern())
+        compiled = Scheduler(rules, exceptions, compiled=True, cache_size=4, tz=Eastern())
+
+        # 12:00 UTC is 7:00 in summer and 7:00 EST is 12:00 UTC in winter
+        self.assertEqual(eastern.get_matching_rules(datetime(2014, 7, 1, 11, 0)), ["open"])
+        self.assertEqual(eastern.get_matching_rules(datetime(2014, 12, 1, 11, 0)), [])
+        self.assertEqual(eastern.get_matching_rules(datetime(2014, 7, 4, 12, 0)), ["holiday"])
+        self.assertEqual(eastern.get_matching_rules(datetime(2014, 7, 5, 3, 0)), ["holiday"])
+        self.assertEqual(eastern.get_matching_rules(datetime(2014, 7, 1, 11, 0, tzinfo=UTC())), ["open"])
+
+        # 2:00 - 2:59 never happens when the clocks go forward, and happens twice when they go back
+        night = [utc for utc in (datetime(2014, 3, 8, 12) + timedelta(minutes=m) for m in xrange(0, 1440))
+                 if eastern.get_matching_rules(utc) == ["night"]]
+        self.assertEqual(night, [])
+        night = [utc for utc in (datetime(2014, 11, 1, 12) + timedelta(minutes=m) for m in xrange(0, 1440))
+                 if eastern.get_matching_rules(utc) == ["night"]]
+        self.assertEqual((len(night), night[0]), (60, datetime(2014, 11, 2, 7, 0)))
+
+        tz = Eastern()
+        for utc in [datetime(2013, 12, 20, 3, 7) + timedelta(minutes=m) for m in xrange(0, 2 * 366 * 1440, 97)]:
+            result = plain.get_matching_rules(tz.fromutc(utc.replace(tzinfo=tz)).replace(tzinfo=None))
+            self.assertEqual(eastern.get_matching_rules(utc), result)
+            self.assertEqual(compiled.get_matching_rules(utc), result)
+
+        # Local times in and out
+        self.assertEqual(eastern.next_match(datetime(2014, 12, 24, 20, 0), "open"), datetime(2014, 12, 26, 7, 0))
+        self.assertEqual(eastern.tz_table.utc(datetime(2014, 12, 26, 7, 0)), datetime(2014, 12, 26, 12, 0))
+
+        # Expiry in UTC, and never past a change of offset
+        self.assertEqual(eastern.get_matching_rules_with_expiry(datetime(2014, 7, 1, 14, 0)), (["open"], datetime(2014, 7, 1, 23, 31)))
+        self.assertEqual(eastern.get_matching_rules_with_expiry(datetime(2014, 11, 1, 23, 40)), ([], datetime(2014, 11, 2, 6, 0)))
+        self.assertEqual(eastern.get_matching_rules_with_expiry(datetime(2014, 11, 2, 6, 0)), ([], datetime(2014, 11, 2, 7, 0)))
+
+        # The file format has no timezone, a loaded scheduler would read UTC timestamps as local time
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with self.assertRaises(ValueError):
+                eastern.dump(path)
+        finally:
+            os.remove(path)
+
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_tz_batch(self):
+        cp = Scheduler([("open", "7:00 19:30 * * 1-5 *"), ("night", "2:00 2:59 * * * *")], [("holiday", "* * 25 12 * *")], tz=Eastern())
+        times = [datetime(2014, 3, 1) + timedelta(minutes=m) for m in xrange(0, 300 * 24 * 60, 31)]
+        times += [datetime(1990, 7, 1, 12, 0), datetime(2030, 7, 1, 12, 0)]
+
+        names, matches = cp.get_matching_rules_batch(numpy.array(times, dtype="datetime64[m]"))
+        for time_obj, row in zip(times, matches):
+            self.assertEqual(sorted(n for n, hit in zip(names, row) if hit), sorted(cp.get_matching_rules(time_obj)))
+
+
+    def test_next_match(self):
+        cp = Scheduler(
+            [("open", "7:00 19:30 * * * *"), ("closed", "0:00 6:59 * * * *"), ("closed", "19:31 23:59 * * * *")],
+            [("closed", "0:00 8:30 * * 6-7 *"), ("closed", "18:30 23:59 * * 6-7 *"), ("holiday", "* * 24,25 12 * *"), ("holiday", "* * 22 12 * 2014")]
+        )
+
+        # Friday evening -> Saturday morning
+        self.assertEqual(cp.next_match(datetime(2014, 12, 19, 20, 0), "open"), datetime(2014, 12, 20, 8, 31))
+        # Sunday evening -> Tuesday morning, since Monday is a holiday
+        self.assertEqual(cp.next_match(datetime(2014, 12, 21, 20, 0), "open"), datetime(2014, 12, 23, 7, 0))
+        self.assertEqual(cp.next_match(datetime(2014, 12, 23, 20, 0), "holiday"), datetime(2014, 12, 24, 0, 0))
+        self.assertEqual(cp.next_match(datetime(2014, 12, 19, 20, 0)), datetime(2014, 12, 19, 20, 1))
+        self.assertEqual(cp.next_match(datetime(2014, 12, 19, 20, 0), "nonexistent"), None)
+
+        self.assertEqual(cp.previous_match(datetime(2014, 12, 23, 7, 0), "open"), datetime(2014, 12, 21, 18, 29))
+        self.assertEqual(cp.previous_match(datetime(2014, 12, 23, 7, 0), "holiday"), datetime(2014, 12, 22, 23, 59))
+        self.assertEqual(cp.previous_match(datetime(2014, 12, 26, 7, 0), "closed"), datetime(2014, 12, 26, 6, 59))
+
+        # Shadowed forever: the search gives up after a full calendar cycle instead of running off the calendar
+        leap = Scheduler([("open", "9:00 17:00 29 2 * */4"), ("open", "9:00 17:00 1 3 * 2014")], [("closed", "* * 29 2 * *")])
+        self.assertEqual(leap.next_match(datetime(2014, 3, 1), "open"), datetime(2014, 3, 1, 9, 0))
+        self.assertEqual(leap.next_match(datetime(2014, 3, 2), "open"), None)
+        self.assertEqual(leap.previous_match(datetime(2014, 3, 1), "open"), None)
+        shadowed = Scheduler([("open", "7:00 19:00 * * * *")], [("closed", "* * * * * *")])
+        self.assertEqual(shadowed.next_match(datetime(2014, 3, 1), "open"), None)
+
+        # An exception ranked before the shadowing one can still match inside its run
+        inner = Scheduler([("x", "* 12 * * * *")], [("x", "30-40 12 * * * *"), ("y", "* 12 * * * *")])
+        self.assertEqual(inner.next_match(datetime(2014, 12, 19, 11, 0), "x"), datetime(2014, 12, 19, 12, 30))
+        self.assertEqual(inner.previous_match(datetime(2014, 12, 19, 14, 0), "x"), datetime(2014, 12, 19, 12, 40))
+        self.assertEqual(inner.next_match(datetime(2014, 12, 19, 12, 35), "y"), datetime(2014, 12, 19, 12, 41))
+
+
+    def test_get_timeline(self):
+        cp = Scheduler(
+            [("open", "7:00 19:30 * * * *"), ("closed", "0:00 6:59 * * * *"), ("closed", "19:31 23:59 * * * *"), ("lunch", "* 12 * * 1-5 *")],
+            [("closed", "0:00 8:30 * * 6-7 *"), ("closed", "18:30 23:59 * * 6-7 *"), ("holiday", "* * 24,25 12 * *"), ("holiday", "* * 22 12 * 2014")]
+        )
+        start, end = datetime(2014, 12, 18, 13, 17), datetime(2014, 12, 27, 8, 45)
+        timeline = cp.get_timeline(start, end)
+
+        self.assertEqual(timeline[0][0], start)
+        self.assertEqual(timeline[-1][1], end)
+        self.assertEqual(timeline[:3], [
+            (datetime(2014, 12, 18, 13, 17), datetime(2014, 12, 18, 19, 31), ["open"]),
+            (datetime(2014, 12, 18, 19, 31), datetime(2014, 12, 19, 7, 0), ["closed"]),
+            (datetime(2014, 12, 19, 7, 0), datetime(2014, 12, 19, 12, 0), ["open"])
+        ])
+        self.assertIn((datetime(2014, 12, 24, 0, 0), datetime(2014, 12, 26, 0, 0), ["holiday"]), timeline)
+
+        # Agrees with a minute by minute scan
+        for interval_start, interval_end, names in timeline:
+            self.assertTrue(interval_start < interval_end)
+            time_obj = interval_start
+            while time_obj < interval_end:
+                self.assertEqual(cp.get_matching_rules(time_obj), names)
+                time_obj += timedelta(minutes=1)
+
+        self.assertEqual(Scheduler([("open", "* * * * * 2014")]).get_timeline(datetime(2030, 1, 1), datetime(2030, 1, 3)),
+            [(datetime(2030, 1, 1), datetime(2030, 1, 3), [])])
+
+
+    def test_count_matching(self):
+        cp = Scheduler(
+            [("open", "7:00 19:30 * * * *"), ("closed", "0:00 6:59 * * * *"), ("closed", "19:31 23:59 * * * *"), ("lunch", "* 12 * * 1-5 *"), ("lunch", "* 12-13 * * 5 *")],
+            [("closed", "0:00 8:30 * * 6-7 *"), ("inventory", "* * 1-7 1 1 *"), ("holiday", "* * 24,25 12 * *"), ("holiday", "* * 22 12 * 2014")]
+        )
+
+        def timeline_totals(start, end):
+            totals = {}
+            for interval_start, interval_end, names in cp.get_timeline(start, end):
+                for name in set(names):
+                    totals[name] = totals.get(name, 0) + int((interval_end - interval_start).total_seconds()) // 60
+            return totals
+
+        for start, end in [(datetime(2014, 12, 18, 13, 17), datetime(2015, 3, 2, 8, 45)), (datetime(2013, 11, 1), datetime(2016, 1, 1)),
+                           (datetime(2014, 12, 22, 3, 0), datetime(2014, 12, 22, 5, 1))]:
+            self.assertEqual(cp.count_matching(start, end), timeline_totals(start, end))
+
+        self.assertEqual(cp.count_matching(datetime(2014, 12, 24), datetime(2014, 12, 26), "holiday"), 2 * 1440)
+        self.assertEqual(cp.count_matching(datetime(2015, 1, 5, 12, 0), datetime(2015, 1, 5, 12, 30), "lunch"), 0)
+        self.assertEqual(cp.count_matching(datetime(2015, 1, 12, 12, 0), datetime(2015, 1, 12, 12, 30), "lunch"), 30)
+        self.assertEqual(cp.count_matching(datetime(2015, 1, 2), datetime(2015, 1, 1)), {})
+
+
+    def test_get_matching_rules_with_expiry(self):
+        cp = Scheduler(
+            [("open", "7:00 19:30 * * * *"), ("closed", "0:00 6:59 * * * *"), ("closed", "19:31 23:59 * * * *"), ("lunch", "* 12 * * 1-5 *")],
+            [("closed", "0:00 8:30 * * 6-7 *"), ("holiday", "* * 24,25 12 * *"), ("holiday", "* * 22 12 * 2014")]
+        )
+
+        self.assertEqual(cp.get_matching_rules_with_expiry(datetime(2014, 12, 19, 12, 30, 15)), (["open", "lunch"], datetime(2014, 12, 19, 13, 0)))
+        self.assertEqual(cp.get_matching_rules_with_expiry(datetime(2014, 12, 19, 12, 59)), (["open", "lunch"], datetime(2014, 12, 19, 13, 0)))
+        # Runs that go on past midnight
+        self.assertEqual(cp.get_matching_rules_with_expiry(datetime(2014, 12, 21, 21, 0)), (["closed"], datetime(2014, 12, 22, 0, 0)))
+        self.assertEqual(cp.get_matching_rules_with_expiry(datetime(2014, 12, 24, 3, 0)), (["holiday"], datetime(2014, 12, 26, 0, 0)))
+        self.assertEqual(cp.get_matching_rules_with_expiry(datetime(2014, 12, 19, 19, 31)), (["closed"], datetime(2014, 12, 20, 8, 31)))
+
+        time_obj = datetime(2014, 12, 17)
+        while time_obj < datetime(2014, 12, 29):
+            names, expires = cp.get_matching_rules_with_expiry(time_obj)
+            self.assertTrue(expires > time_obj)
+            self.assertEqual(cp.get_matching_rules(expires - timedelta(minutes=1)), names)
+            self.assertNotEqual(cp.get_matching_rules(expires), names)
+            time_obj = expires
+
+        # Changes drop the remembered result
+        cp.get_matching_rules_with_expiry(datetime(2014, 12, 19, 12, 0))
+        cp.add_exceptions([("meeting", "* 12 19 12 * 2014")])
+        self.assertEqual(cp.get_matching_rules_with_expiry(datetime(2014, 12, 19, 12, 0)), (["meeting"], datetime(2014, 12, 19, 13, 0)))
+
+
+    def test_nth_weekday(self):
+        rules = [("open", "7:00 19:30 * * * *"), ("meeting", "* 9-10 * * 1#1,3L *")]
+        exceptions = [("thanksgiving", "* * * 11 4#4 *"), ("memorial", "* * * 5 1L *"), ("closed", "0:00 8:30 * * 6-7 *")]
+        cp = Scheduler(rules, exceptions)
+        compiled = Scheduler(rules, exceptions, compiled=True)
+
+        self.assertEqual(cp.get_matching_rules(datetime(2014, 11, 27, 12, 0)), ["thanksgiving"])
+        self.assertEqual(cp.get_matching_rules(datetime(2014, 11, 20, 12, 0)), ["open"])
+        self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 1, 9, 30)), ["open", "meeting"])
+        self.assertEqual(cp.count_matching(datetime(2000, 1, 1), datetime(2030, 1, 1), "memorial"), 30 * 1440)
+        self.assertEqual(cp.find_overlaps(), [])
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            cp.dump(path)
+            mapped = Scheduler.load(path)
+            for time_obj in [datetime(2014, 1, 1, 9, 15) + timedelta(hours=h) for h in xrange(0, 2 * 366 * 24, 5)]:
+                result = cp.get_matching_rules(time_obj)
+                self.assertEqual(compiled.get_matching_rules(time_obj), result)
+                self.assertEqual(mapped.get_matching_rules(time_obj), result)
+            mapped.close()
+        finally:
+            os.remove(path)
+
+
+    def test_lazy(self):
+        rules = [("open", "7:00 19:30 * * * *"), ("lunch", "* 12 * * 1-5 2014"), ("lunch", "* 13 * * 1-5 2015-2016")]
+        exceptions = [("closed", "0:00 8:30 * * 6-7 *"), ("inventory", "* 9-12 5 1 * 2015"), ("holiday", "* * 24,25 12 * *"),
+                      ("holiday", "* * 22 12 * 2014"), ("inventory", "* 9-12 5 1 * 2016")]
+        eager = Scheduler(rules, exceptions)
+        cp = Scheduler(rules, exceptions, lazy=True)
+        self.assertEqual(sum(map(len, cp.exceptions.values())), 0)
+
+        self.assertEqual(cp.get_matching_rules(datetime(2015, 1, 5, 10, 0)), ["inventory"])
+        self.assertEqual(sum(map(len, cp.exceptions.values())), 3)   # 2016 is still unparsed
+        self.assertEqual(cp.exceptions.keys(), eager.exceptions.keys())
+
+        for time_obj in [datetime(2014, 1, 1) + timedelta(minutes=m) for m in xrange(0, 3 * 366 * 24 * 60, 997)]:
+            self.assertEqual(cp.get_matching_rules(time_obj), eager.get_matching_rules(time_obj))
+
+        cp = Scheduler(rules, exceptions, lazy=True)
+        cp.replace_exceptions("inventory", ["* 9-12 6 1 * 2016"])
+        self.assertEqual(cp.get_matching_rules(datetime(2016, 1, 5, 10, 0)), ["open"])
+        self.assertEqual(cp.next_match(datetime(2015, 1, 1), "inventory"), datetime(2016, 1, 6, 9, 0))
+
+        # Names keep their declaration order in the compiled indexes, whichever year is parsed first
+        rules = [("open", "* * * * * *"), ("late", "* 12 * * * 2015"), ("early", "* 12 * * * *")]
+        exceptions = [("x", "* 9-17 * * * 2015"), ("y", "* 12 * * * *")]
+        compiled = Scheduler(rules, exceptions, lazy=True, compiled=True)
+        compiled.get_matching_rules(datetime(2016, 6, 1, 12, 0))
+        self.assertEqual(compiled.get_matching_rules(datetime(2015, 6, 1, 12, 0)), ["x"])
+        compiled.remove_exceptions("x")
+        self.assertEqual(compiled.get_matching_rules(datetime(2015, 6, 1, 12, 0)), ["y"])
+        compiled.remove_exceptions("y")
+        self.assertEqual(compiled.get_matching_rules(datetime(2015, 6, 1, 12, 0)), ["open", "late", "early"])
+
+        cp = Scheduler([("open", "* * * * * 2015"), ("broken", "* * * * * 2016-x")], lazy=True)
+        with self.assertRaises(InvalidCronStringError):
+            cp.get_matching_rules(datetime(2015, 1, 5, 10, 0))
+
+
+    def test_cache(self):
+        rules = [("open", "7:00 19:30 * * * *"), ("closed", "0:00 6:59 * * * *"), ("closed", "19:31 23:59 * * * *"), ("lunch", "* 12 * * 1-5 *")]
+        exceptions = [("closed", "0:00 8:30 * * 6-7 *"), ("holiday", "* * 24,25 12 * *"), ("holiday", "* * 22 12 * 2014")]
+        cp = Scheduler(rules, exceptions)
+        cached = Scheduler(rules, exceptions, cache_size=2)
+
+        for d in (19, 20, 19, 22, 24, 19):
+            for h in xrange(0, 24):
+                for m in (0, 29, 30, 31, 59):
+                    time_obj = datetime(2014, 12, d, h, m)
+                    self.assertEqual(cached.get_matching_rules(time_obj), cp.get_matching_rules(time_obj))
+
+        # 19, 20, 22, 24, 19 are misses since the 19th was evicted by 22 and 24
+        self.assertEqual(cached.cache_info(), (6 * 24 * 5 - 5, 5, 2, 2))
+
+        cached.add_exceptions([("closed", "* * 19 12 * *")])
+        self.assertEqual(cached.get_matching_rules(datetime(2014, 12, 19, 12, 0)), ["closed"])
+        self.assertEqual(cached.cache_info().misses, 6)
+
+        cached.cache_clear()
+        self.assertEqual(cached.cache_info(), (0, 0, 2, 0))
+
+
+    def test_dump_load(self):
+        rules = [("open", "7:00 19:30 * * * *"), ("closed", "0:00 6:59 * * * *"), ("closed", "19:31 23:59 * * * *"), ("lunch", "* 12 * * 1-5 */2")]
+        exceptions = [("closed", "0:00 8:30 * * 6-7 *"), ("holiday", "* * 24,25 12 * *"), ("holiday", "* * 22 12 * 2014"), ("new year", "* * 1 1 * 2015")]
+        cp = Scheduler(rules, exceptions)
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            cp.dump(path)
+            for mapped in (Scheduler.load(path), Scheduler.load(path, mmap=False)):
+                for time_obj in [datetime(2014, 12, 17) + timedelta(minutes=m) for m in xrange(0, 20 * 24 * 60, 37)]:
+                    self.assertEqual(mapped.get_matching_rules(time_obj), cp.get_matching_rules(time_obj))
+                self.assertEqual(mapped.get_matching_rules(datetime(2040, 1, 2, 12, 0)), ["open", "lunch"])
+                self.assertEqual(mapped.get_matching_rules(datetime(2041, 1, 2, 12, 0)), ["open"])
+                mapped.close()
+
+            with open(path, "wb") as f:
+                f.write("not a scheduler" * 10)
+            with self.assertRaises(storage.InvalidFileError):
+                Scheduler.load(path)
+        finally:
+            os.remove(path)
+
+
+    def test_pickle(self):
+        rules = [("open", "7:00 19:30 * * * *"), ("closed", "0:00 6:59 * * * *"), ("lunch", "* 12 * * 1-5 */2")]
+        exceptions = [("closed", "0:00 8:30 * * 6-7 *"), ("holiday", "* * 24,25 12 * *"), ("holiday", "* * 22 12 * 2014")]
+        cp = Scheduler(rules, exceptions)
+        for protocol in (0, 2):
+            copy = pickle.loads(pickle.dumps(cp, protocol))
+
+            self.assertEqual(copy.rules.keys(), ["open", "closed", "lunch"])
+            self.assertEqual(copy.exceptions.keys(), ["closed", "holiday"])
+            for time_obj in [datetime(2014, 12, 17) + timedelta(minutes=m) for m in xrange(0, 10 * 24 * 60, 37)]:
+                self.assertEqual(copy.get_matching_rules(time_obj), cp.get_matching_rules(time_obj))
+            copy.add_rules([("late", "20:00 23:59 * * * *")])
+            self.assertEqual(copy.get_matching_rules(datetime(2014, 12, 19, 21, 0)), ["late"])
+
+
+    def test_remove_replace(self):
+        rules = [("open", "7:00 19:30 * * * *"), ("lunch", "* 12 * * 1-5 *"), ("closed", "0:00 6:59 * * * *"), ("closed", "19:31 23:59 * * * *")]
+        exceptions = [("closed", "0:00 8:30 * * 6-7 *"), ("holiday", "* * 24,25 12 * *"), ("holiday", "* * 22 12 * 2014")]
+
+        for compiled in (False, True):
+            cp = Scheduler(rules, exceptions, compiled=compiled)
+
+            self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 19, 12, 0)), ["open", "lunch"])
+            cp.replace_rules("open", ["6:00 20:00 * * * *", "* 23 * * * *"])
+            self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 19, 12, 0)), ["open", "lunch"])
+            self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 19, 6, 0)), ["open", "closed"])
+            self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 19, 23, 0)), ["open", "closed"])
+
+            cp.remove_rules("lunch")
+            self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 19, 12, 0)), ["open"])
+            with self.assertRaises(KeyError):
+                cp.remove_rules("lunch")
+
+            self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 22, 12, 0)), ["holiday"])
+            cp.replace_exceptions("holiday", ["* * 23 12 * 2014", "* * 26 12 * *"])
+            self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 22, 12, 0)), ["open"])
+            self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 23, 12, 0)), ["holiday"])
+            self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 26, 12, 0)), ["holiday"])
+            self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 25, 12, 0)), ["open"])
+
+            cp.remove_exceptions("holiday")
+            cp.remove_exceptions("closed")
+            self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 23, 12, 0)), ["open"])
+            self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 20, 7, 0)), ["open"])
+            self.assertEqual(cp.holiday_exceptions, {})
+            with self.assertRaises(KeyError):
+                cp.remove_exceptions("holiday")
+
+        # Each half of the range index is only rebuilt when its side changes
+        cp = Scheduler(rules, exceptions)
+        cp.get_matching_rules(datetime(2014, 12, 19, 12, 0))
+        exception_ranges, rule_ranges = cp._exception_ranges, cp._rule_ranges
+        cp.replace_rules("lunch", ["* 13 * * 1-5 *"])
+        self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 19, 13, 0)), ["open", "lunch"])
+        self.assertIs(cp._exception_ranges, exception_ranges)
+        self.assertIsNot(cp._rule_ranges, rule_ranges)
+        rule_ranges = cp._rule_ranges
+        cp.replace_exceptions("closed", ["0:00 9:30 * * 6-7 *"])
+        self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 20, 9, 0)), ["closed"])
+        self.assertIs(cp._rule_ranges, rule_ranges)
+        self.assertIsNot(cp._exception_ranges, exception_ranges)
+
+        # A date that several names have a holiday on goes back to the previous name when the last one is removed
+        holidays = [("A", "* * 1 1 * 2015"), ("B", "* * 1 1 * 2015"), ("B", "* * 2 1 * 2015"), ("A", "* * 3 1 * 2015")]
+        days = [datetime(2015, 1, d, 12, 0) for d in (1, 2, 3, 4)]
+        for kwargs in ({}, {"compiled": True}, {"lazy": True}):
+            cp = Scheduler([("open", "* * * * * *")], holidays, **kwargs)
+            self.assertEqual([cp.get_matching_rules(day) for day in days], [["B"], ["B"], ["A"], ["open"]])
+            cp.replace_exceptions("B", ["* * 4 1 * 2015"])
+            rebuilt = Scheduler([("open", "* * * * * *")], [("A", "* * 1 1 * 2015"), ("B", "* * 4 1 * 2015"), ("A", "* * 3 1 * 2015")], **kwargs)
+            self.assertEqual([cp.get_matching_rules(day) for day in days], [rebuilt.get_matching_rules(day) for day in days])
+            self.assertEqual(cp.holiday_exceptions, rebuilt.holiday_exceptions)
+            cp.remove_exceptions("B")
+            rebuilt = Scheduler([("open", "* * * * * *")], [("A", "* * 1 1 * 2015"), ("A", "* * 3 1 * 2015")], **kwargs)
+            self.assertEqual([cp.get_matching_rules(day) for day in days], [["A"], ["open"], ["A"], ["open"]])
+            self.assertEqual(cp.holiday_exceptions, rebuilt.holiday_exceptions)
+
+
+    def test_stats(self):
+        cp = Scheduler(
+            [("open", "7:00 19:30 * * * *"), ("closed", "0:00 6:59 * * * *"), ("closed", "19:31 23:59 * * * *")],
+            [("closed", "0:00 8:30 * * 6-7 *"), ("closed", "18:30 23:59 * * 6-7 *"), ("holiday", "* * 25 12 * 2014")],
+            cache_size=10
+        )
+        self.assertIsNone(cp.stats())
+
+        queries = []
+        cp.enable_stats(lambda time_obj, result, depth, seconds: queries.append((time_obj, result, depth)))
+
+        self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 19, 12, 0)), ["open"])
+        self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 20, 20, 0)), ["closed"])
+        self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 25, 20, 0)), ["holiday"])
+
+        stats = cp.stats()
+        self.assertEqual(stats.queries, 3)
+        self.assertEqual(stats.holiday_hits, 1)
+        self.assertAlmostEqual(stats.holiday_hit_rate, 1 / 3.0)
+        self.assertEqual(dict(stats.exception_depths), {0: 1, 2: 1})
+        self.assertEqual(stats.rules[("exception", "closed", 0)].evaluations, 2)
+        self.assertEqual(stats.rules[("exception", "closed", 1)].matches, 1)
+        self.assertEqual(stats.rules[("rule", "open", 0)].matches, 1)
+        self.assertEqual(stats.rules[("rule", "closed", 1)].evaluations, 1)
+        self.assertEqual(queries[1], (datetime(2014, 12, 20, 20, 0), ["closed"], 2))
+        self.assertEqual(stats.as_dict()["queries"], 3)
+
+        cp.disable_stats()
+        self.assertIsNone(cp.stats())
+        self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 19, 12, 0)), ["open"])
+        self.assertEqual(len(queries), 3)
+
+
+    def test_adaptive(self):
+        rules = [("open", "7:00 19:30 * * * *"), ("closed", "* 6 * * * *"), ("closed", "19:31 23:59 * * * *"), ("lunch", "* 12 * * 1-5 *")]
+        exceptions = [("closed", "0:00 8:30 * * 6-7 *"), ("closed", "18:30 23:59 * * 6-7 *"), ("maintenance", "* 3 * * 7 *"),
+            ("closed", "* * 24,25 12 * *"), ("closed", "* * 5 4 * 2015")]
+
+        cp = Scheduler(rules, exceptions)
+        adaptive = Scheduler(rules, exceptions, adaptive=True)
+        adaptive.adapt_every = 50
+
+        for d in xrange(1, 32):
+            for h in xrange(0, 24):
+                for m in (0, 30, 59):
+                    time_obj = datetime(2014, 12, d, h, m)
+                    self.assertEqual(adaptive.get_matching_rules(time_obj), cp.get_matching_rules(time_obj))
+
+        #"maintenance" overlaps weekend "closed" exceptions, so it must stay behind them
+        self.assertEqual(adaptive.get_matching_rules(datetime(2014, 12, 21, 3, 0)), ["closed"])
+        self.assertEqual(adaptive._adaptive_free, False)
+
+        adaptive.remove_exceptions("maintenance")
+        self.assertEqual(adaptive.get_matching_rules(datetime(2014, 12, 21, 3, 0)), ["closed"])
+
+        copy = pickle.loads(pickle.dumps(adaptive))
+        self.assertEqual(copy.get_matching_rules(datetime(2014, 12, 21, 3, 0)), ["closed"])
+
+        #Without it, only exceptions called "closed" are left, which may be reordered freely
+        for m in xrange(adaptive.adapt_every):
+            adaptive.get_matching_rules(datetime(2014, 12, 22, 0, m))
+        self.assertEqual(adaptive._adaptive_free, True)
+
+
+    def test_find_overlaps(self):
+        rules = [("open", "* 7-19 * * * *")]
+        exceptions = [("closed", "0:00 8:30 * * 6-7 *"), ("closed", "* 0-8 * * 6-7 *"), ("maintenance", "* 3 * * 7 *"),
+            ("inventory", "* * 30 2 * *"), ("inventory", "* * 13 * 5 *"), ("party", "18:00 23:59 * 2 * *"),
+            ("holiday", "* * 27 12 * 2014")]
+
+        cp = Scheduler(rules, exceptions)
+        self.assertEqual(cp.find_overlaps(), [
+            (("closed", 0), ("maintenance", 0), datetime(2000, 1, 2, 3, 0)),
+            (("closed", 1), ("maintenance", 0), datetime(2000, 1, 2, 3, 0)),
+            (("inventory", 1), ("party", 0), datetime(2004, 2, 13, 18, 0)),
+            (("holiday", (27, 12, 2014)), ("closed", 0), datetime(2014, 12, 27, 0, 0)),
+            (("holiday", (27, 12, 2014)), ("closed", 1), datetime(2014, 12, 27, 0, 0))
+        ])
+
+        self.assertRaises(OverlappingExceptionsError, Scheduler, rules, exceptions, strict=True)
+        Scheduler(rules, [("closed", "* 0-8 * * 6-7 *"), ("inventory", "* * 30 2 * *"), ("party", "* 18-23 * * 1 *")], strict=True)
+
+
+    def test_full_day_exceptions(self):
+        rules = [("open", "7:00 19:30 * * * *"), ("closed", "* 0-6 * * * *")]
+        exceptions = [("early", "* 0-9 24 12 * *"), ("closed", "* * 24-31 12 * 2014"), ("closed", "0:00 23:59 * * 7 *"),
+            ("late", "* 20-23 * * * *"), ("inventory", "* * 1,15 * * 2014-2015"), ("closed", "* * 1-2 1 * 1990")]
+
+        cp = Scheduler(rules, exceptions)
+        compiled = Scheduler(rules, exceptions, compiled=True)
+
+        days, partial = cp._index_day_exceptions()
+        self.assertEqual([ename for ename, exception in partial], ["early", "closed", "late"])
+        self.assertEqual(days[(28, 12, 2014)], (1, "closed"))
+        self.assertEqual(days[(15, 1, 2015)], (3, "inventory"))
+
+        for d in xrange(1, 32):
+            for h in (0, 9, 10, 12, 20, 23):
+                time_obj = datetime(2014, 12, d, h, 0)
+                self.assertEqual(cp.get_matching_rules(time_obj), compiled.get_matching_rules(time_obj))
+
+        self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 24, 8, 0)), ["early"])
+        self.assertEqual(cp.get_matching_rules(datetime(2014, 12, 24, 12, 0)), ["closed"])
+        self.assertEqual(cp.get_matching_rules(datetime(2015, 1, 15, 21, 0)), ["late"])
+        self.assertEqual(cp.get_matching_rules(datetime(2015, 1, 15, 12, 0)), ["inventory"])
+
+        # Rule edits keep the table, exception edits only swap the edited name's dates
+        cp.replace_rules("open", ["7:00 20:30 * * * *"])
+        self.assertIs(cp._day_exceptions[0], days)
+        cp.replace_exceptions("closed", ["* * 28-31 12 * 2014", "* * 1 1 * *", "* 22 * * * *"])
+        cp.remove_exceptions("early")
+        cp.add_exceptions([("early", "* * 26 12 * 2014"), ("late", "* * 27 12 * *")])
+        self.assertIs(cp._day_exceptions[0], days)
+
+        rules = [("open", "7:00 20:30 * * * *"), ("closed", "* 0-6 * * * *")]
+        exceptions = [("closed", "* * 28-31 12 * 2014"), ("closed", "* * 1 1 * *"), ("closed", "* 22 * * * *"), ("late", "* 20-23 * * * *"),
+            ("late", "* * 27 12 * *"), ("inventory", "* * 1,15 * * 2014-2015"), ("early", "* * 26 12 * 2014")]
+        fresh = Scheduler(rules, exceptions)
+        for time_obj in [datetime(2014, 12, 20) + timedelta(minutes=m) for m in xrange(0, 40 * 24 * 60, 67)]:
+            self.assertEqual(cp.get_matching_rules(time_obj), fresh.get_matching_rules(time_obj))
+        self.assertEqual(cp._day_exceptions[0], fresh._day_exceptions[0])
+        self.assertEqual([ename for ename, exception in cp._day_exceptions[1]], ["closed", "late"])
+
+
+class TestSchedulerRegistry(unittest.TestCase):
+
+    def test_match_all(self):
+        tenants = {
+            "bakery": ([("open", "6:00 14:00 * * 1-6 *"), ("closed", "14:01 23:59 * * * *"), ("closed", "0:00 5:59 * * * *")],
+                       [("closed", "* * 25 12 * *"), ("holiday", "* * 22 12 * 2014")]),
+            "bar": ([("open", "17:00 23:59 * * * *"), ("closed", "0:00 16:59 * * * *")],
+                    [("closed", "* * * * 1 *"), ("party", "20:00 23:59 24 12 * *")]),
+            "shop": ([("open", "* 9-17 * * 1-5 *"), ("open", "* 10-15 * * 6 *")],
+                     [("closed", "* * 24,25 12 * *")])
+        }
+        registry = SchedulerRegistry()
+        schedulers = {}
+        for tenant, (rules, exceptions) in tenants.items():
+            registry.add_tenant(tenant, rules, exceptions)
+            schedulers[tenant] = Scheduler(rules, exceptions)
+
+        def check():
+            for time_obj in [datetime(2014, 12, 19) + timedelta(minutes=m) for m in xrange(0, 8 * 24 * 60, 23)]:
+                for state in ("open", "closed", "holiday", "party"):
+                    expected = set(tenant for tenant, cp in schedulers.items() if state in cp.get_matching_rules(time_obj))
+                    self.assertEqual(registry.match_all(time_obj, state), expected)
+
+        check()
+        self.assertEqual(registry.match_all(datetime(2014, 12, 19, 12, 0), "open"), set(["bakery", "shop"]))
+
+        registry.remove_tenant("bakery")
+        del schedulers["bakery"]
+        self.assertEqual(len(registry), 2)
+        check()
+
+        registry.add_tenant("bar", [("open", "* * * * * *")])
+        schedulers["bar"] = Scheduler([("open", "* * * * * *")])
+        check()
+
+        with self.assertRaises(KeyError):
+            registry.remove_tenant("bakery")
+
+
+class TestAnnotate(unittest.TestCase):
+
+    config = {"rules": [["open", "7:30 19:00 * * 1-5 *"]], "exceptions": [["closed", "* * 25 12 * *"]], "stop_year": 2030}
+
+
+    def test_csv(self):
+        lines = ["1,2014-12-19T12:00:00\n", '2,"2014-12-25T12:00"\n', "3,2014-12-20T12:00\n", "4,2014-12-19T07:29\r\n"]
+        expected = ["1,2014-12-19T12:00:00,open\n", '2,"2014-12-25T12:00",closed\n', "3,2014-12-20T12:00,\n",
+                    "4,2014-12-19T07:29,\n"]
+        for processes in (0, 2):
+            chunks = list(annotate_stream(iter(lines), self.config, column=1, chunk_size=3, processes=processes))
+            self.assertEqual([len(chunk) for chunk in chunks], [3, 1])
+            self.assertEqual(sum(chunks, []), expected)
+
+
+    def test_jsonl(self):
+        lines = ['{"ts": 1418990400}\n', "\n", '{"ts": 1419508800, "id": 2}\n']
+        out = sum(annotate_stream(lines, self.config, "jsonl", "ts", "state", "epoch"), [])
+        self.assertEqual([json.loads(line)["state"] for line in out], [["open"], ["closed"]])
+
+
+class FakeClock(object):
+
+    def __init__(self, now):
+        self.current = now
+        self.sleeps = []
+
+
+    def now(self):
+        return self.current
+
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.current += timedelta(seconds=seconds)
+
+
+class TestDispatcher(unittest.TestCase):
+
+    def test_run(self):
+        clock = FakeClock(datetime(2014, 12, 19, 6, 58, 30))
+        fired = []
+        dispatcher = Dispatcher(clock, executor=lambda fn, args: fn(*args))
+
+        cp = Scheduler([("open", "7:00 7:02 * * 1-5 *"), ("report", "0 8 * * * *")], [("closed", "* * 25 12 * *")])
+        dispatcher.add(cp, "open", lambda name, fire_time: fired.append((name, fire_time)))
+        report = dispatcher.add(cp, "report", lambda name, fire_time: fired.append((name, fire_time)))
+        self.assertEqual(len(dispatcher), 2)
+
+        dispatcher.run(until=datetime(2014, 12, 20, 8, 0))
+        self.assertEqual(fired, [("open", datetime(2014, 12, 19, 7, m)) for m in xrange(3)] +
+            [("report", datetime(2014, 12, 19, 8, 0)), ("report", datetime(2014, 12, 20, 8, 0))])
+        self.assertEqual(clock.sleeps[0], 90)
+        self.assertEqual(len(clock.sleeps), 5)
+
+        #Only the jobs that fired are rescheduled, and a late dispatcher fires once for the minutes it missed
+        dispatcher.remove(report)
+        clock.current = datetime(2014, 12, 22, 7, 1, 30)
+        self.assertEqual(dispatcher.run_pending(), 1)
+        self.assertEqual(fired[-1], ("open", datetime(2014, 12, 22, 7, 0)))
+        self.assertEqual(dispatcher.next_fire_time(), datetime(2014, 12, 22, 7, 2))
+        self.assertEqual(len(dispatcher), 1)
+
+
+    def test_errors(self):
+        clock = FakeClock(datetime(2014, 12, 19, 7, 0))
+        errors = []
+        dispatcher = Dispatcher(clock, max_concurrency=2, on_error=lambda job, fire_time, exc_info: errors.append(exc_info[0]))
+        dispatcher.add(Scheduler([("tick", "* 7 * * * *")]), "tick", lambda name, fire_time: 1 / 0)
 
+        dispatcher.run(until=datetime(2014, 12, 19, 7, 4))
+        dispatcher.close()
+        self.assertEqual(errors, [ZeroDivisionError] * 5)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,129 @@
+"""
+    UTC offset transition tables, so that a Scheduler with a timezone can turn UTC timestamps into local time
+        with a bisect instead of a tzinfo call per timestamp.
+
+    Works with any tzinfo that implements fromutc, e.g. pytz.timezone("Europe/Berlin") or dateutil.tz.gettz(...),
+        neither of which is a dependency of pycronius.
+"""
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+
+class OffsetTable(object):
+    """
+        The offsets of tzinfo from UTC between start_year and stop_year (inclusive), as a sorted list of the
+            (naive, UTC) datetimes at which each offset starts:
+
+            table = OffsetTable(pytz.timezone("America/New_York"), 2014, 2015)
+            table.local(datetime(2014, 7, 1, 12, 0)) -> datetime(2014, 7, 1, 8, 0)
+
+        Converting from UTC is always unambiguous.  Around a change of offset this means that:
+            local times that are skipped (e.g. 2:30 when clocks go forward at 2:00) never happen, so rules that
+                only cover them never match
+            local times that are repeated (e.g. 1:30 when clocks go back at 2:00) happen twice, and match twice
+
+        Timestamps outside of the table's years are converted by tzinfo itself.
+    """
+    step = timedelta(days=1)    # offsets are sampled this often, changes closer together than this are missed
+
+    def __init__(self, tzinfo, start_year, stop_year):
+        self.tzinfo = tzinfo
+        self.start = datetime(start_year, 1, 1) - self.step
+        self.stop = datetime(stop_year + 1, 1, 1) + self.step
+
+        self.starts = [self.start]              # UTC datetimes at which self.deltas[i] starts to apply
+        self.deltas = [self._offset(self.start)]
+
+        previous = self.start
+        while previous < self.stop:
+            current = min(previous + self.step, self.stop)
+            if self._offset(current) != self.deltas[-1]:
+                self._add_transition(previous, current)
+            previous = current
+
+        self._widest = (min(self.deltas), max(self.deltas))
+        self._memo = (self.start, self.starts[1] if len(self.starts) > 1 else self.stop, self.deltas[0])
+
+
+    def _offset(self, utc):
+        return self.tzinfo.fromutc(utc.replace(tzinfo=self.tzinfo)).replace(tzinfo=None) - utc
+
+
+    def _add_transition(self, before, after):
+        """
+            Finds the first minute in (before, after] with a different offset than before, by bisection
+        """
+        lo, hi = 0, int((after - before).total_seconds()) // 60
+        delta = self._offset(before)
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self._offset(before + timedelta(minutes=mid)) == delta:
+                lo = mid
+            else:
+                hi = mid
+        transition = before + timedelta(minutes=hi)
+        self.starts.append(transition)
+        self.deltas.append(self._offset(transition))
+
+
+    def __len__(self):
+        return len(self.starts)
+
+
+    def interval(self, utc):
+        """
+            Returns (start, stop, delta): the UTC datetimes between which (stop exclusive) utc is shifted by delta.
+                stop is None outside of the table.
+
+            utc is a naive datetime in UTC, or an aware datetime.
+        """
+        if utc.tzinfo is not None:
+            utc = utc.replace(tzinfo=None) - utc.utcoffset()
+
+        memo = self._memo
+        if memo[0] <= utc < memo[1]:
+            return memo
+
+        if not self.start <= utc < self.stop:
+            return utc, None, self._offset(utc)
+
+        i = bisect_right(self.starts, utc) - 1
+        self._memo = memo = (self.starts[i], self.starts[i + 1] if i + 1 < len(self.starts) else self.stop, self.deltas[i])
+        return memo
+
+
+    def local(self, utc):
+        """
+            Returns utc (naive in UTC, or aware) as a naive datetime in local time
+        """
+        if utc.tzinfo is not None:
+            utc = utc.replace(tzinfo=None) - utc.utcoffset()
+
+        memo = self._memo
+        if memo[0] <= utc < memo[1]:
+            return utc + memo[2]
+        return utc + self.interval(utc)[2]
+
+
+    def utc(self, local):
+        """
+            Returns the naive UTC datetime for local (a naive datetime in local time), the inverse of self.local.
+
+            A repeated local time gives its first occurrence.  A skipped local time gives the moment the clocks
+                changed, i.e. the first moment that is later in local time.
+            Raises ValueError if local is outside of the table
+        """
+        if not self.start + self.deltas[0] <= local < self.stop + self.deltas[-1]:
+            raise ValueError("{} is outside of the offset table ({} - {})".format(local, self.start, self.stop))
+
+        lo = bisect_right(self.starts, local - self._widest[1]) - 1
+        hi = bisect_right(self.starts, local - self._widest[0])
+        for i in xrange(max(lo, 0), hi):
+            utc = local - self.deltas[i]
+            if self.starts[i] <= utc and (i + 1 == len(self.starts) or utc < self.starts[i + 1]):
+                return utc
+
+        #Skipped: the first transition after which local time is past local
+        for i in xrange(max(lo, 1), hi):
+            if self.starts[i] + self.deltas[i - 1] <= local < self.starts[i] + self.deltas[i]:
+                return self.starts[i]
@@ -1,3 +1,65 @@
+from collections import OrderedDict
+from datetime import timedelta
+import re
+
+
 class Bunch(object):
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
+
+
+class OrderedDefaultDict(OrderedDict):
+    """
+        collections.defaultdict that remembers insertion order, so that iterating over rules and exceptions
+            (and therefore which exception "wins") does not depend on hashing
+    """
+    def __init__(self, default_factory, *args, **kwargs):
+        super(OrderedDefaultDict, self).__init__(*args, **kwargs)
+        self.default_factory = default_factory
+
+    def __missing__(self, key):
+        self[key] = value = self.default_factory()
+        return value
+
+    def __reduce__(self):
+        #OrderedDict.__reduce__ would rebuild this as cls(items), passing the items as default_factory
+        return type(self), (self.default_factory,), None, None, iter(self.items())
+
+
+_nonzero_digit = re.compile("[^0]")
+
+def iter_bits(mask):
+    """
+        Yields the positions of the set bits in the integer mask, lowest first
+    """
+    if mask.bit_length() <= 1024:
+        while mask:
+            low = mask & -mask
+            yield low.bit_length() - 1
+            mask ^= low
+    else:
+        #Clearing bits one at a time is linear in the size of a wide mask, so scan its hex digits instead
+        digits = ("%x" % mask)[::-1]
+        for match in _nonzero_digit.finditer(digits):
+            base = match.start() * 4
+            value = int(match.group(), 16)
+            for bit in xrange(4):
+                if value >> bit & 1:
+                    yield base + bit
+
+
+def minute_after(time_obj):
+    """
+        Returns the first whole minute strictly after time_obj, as a naive datetime
+    """
+    return time_obj.replace(second=0, microsecond=0, tzinfo=None) + timedelta(minutes=1)
+
+
+def minute_before(time_obj):
+    """
+        Returns the last whole minute strictly before time_obj, as a naive datetime
+    """
+    t = time_obj.replace(second=0, microsecond=0, tzinfo=None)
+    if t == time_obj.replace(tzinfo=None):
+        t -= timedelta(minutes=1)
+    return t